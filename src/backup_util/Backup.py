@@ -5,20 +5,37 @@ import shutil
 from datetime import datetime
 from queue import Queue
 from time import sleep
-from typing import Tuple
+from typing import Tuple, Optional, Callable, List, Iterable
 
 from backup_util.exception.ValidationException import ValidationException
-from backup_util.utils.threading import AsyncUpdate, Threadable, threaded_func
+from backup_util.utils.copying import copy_file, CopyStats, default_copy_workers, default_small_file_size
+from backup_util.utils.datautils import tree_size, default_hash_algorithm
+from backup_util.utils.exclusions import Exclusions
+from backup_util.utils.scanner import scan_tree, ScanEntry
+from backup_util.utils.threading import AsyncUpdate, Threadable, threaded_func, default_workers, ProgressReporter, \
+    counter_scanned, counter_copied, counter_bytes, OrderedPool
 
 log = logging.getLogger(__name__)
 
 
 class Backup(Threadable):
 
-    def __init__(self, dry_run: bool = False, use_wrapper=False):
+    def __init__(self, dry_run: bool = False, use_wrapper=False, prescan: bool = False,
+                 copy_workers: int = default_copy_workers, small_file_size: int = default_small_file_size):
+        """
+        :param dry_run: if True, no files are copied
+        :param use_wrapper: if True, the sources are copied into a new folder named after the date
+        :param prescan: if True, the sources are counted before copying so progress is reported in bytes
+        :param copy_workers: the number of small files copied at once
+        :param small_file_size: files smaller than this many bytes are copied on the pool of `copy_workers`, larger
+        ones are copied one at a time as they are bound by bandwidth rather than latency
+        """
         super().__init__()
         self.dry_run: bool = dry_run
         self.use_wrapper = use_wrapper
+        self.prescan = prescan
+        self.copy_workers = copy_workers
+        self.small_file_size = small_file_size
         self.sources: list = []
         self.destination: str = ""
         self.exceptions: list = []
@@ -33,14 +50,22 @@ class Backup(Threadable):
         self.destination = dest
 
     @staticmethod
-    def save_to_json(path: str, src: list, exc: list, dest: str, dry: bool = False, wrap: bool = False) -> None:
+    def save_to_json(path: str, src: list, exc: list, dest: str, dry: bool = False, wrap: bool = False,
+                     hash_workers: int = default_workers(), hash_processes: bool = False,
+                     hardlink: bool = False, prescan: bool = False,
+                     hash_algorithm: str = default_hash_algorithm) -> None:
         with open(path, "w+") as jfile:
             data = {
                 "sources": src,
                 "exceptions": exc,
                 "destination": dest,
                 "dry_run": dry,
-                "use_wrapper": wrap
+                "use_wrapper": wrap,
+                "hash_workers": hash_workers,
+                "hash_processes": hash_processes,
+                "hardlink": hardlink,
+                "prescan": prescan,
+                "hash_algorithm": hash_algorithm
             }
             json.dump(data, jfile)
 
@@ -54,6 +79,24 @@ class Backup(Threadable):
                     data["dry_run"] if "dry_run" in data else False,
                     data["use_wrapper"] if "use_wrapper" in data else False)
 
+    @staticmethod
+    def load_options_from_json(path: str) -> dict:
+        """
+        Load the tuning options of a saved configuration. Options missing from the file are set to their defaults.
+
+        :param path: the path to the configuration file
+        :return: a dict of option name to value
+        """
+        with open(path, "r") as jfile:
+            data = json.load(jfile)
+            return {
+                "hash_workers": data["hash_workers"] if "hash_workers" in data else default_workers(),
+                "hash_processes": data["hash_processes"] if "hash_processes" in data else False,
+                "hardlink": data["hardlink"] if "hardlink" in data else False,
+                "prescan": data["prescan"] if "prescan" in data else False,
+                "hash_algorithm": data["hash_algorithm"] if "hash_algorithm" in data else default_hash_algorithm
+            }
+
     def execute(self) -> Queue:
         self.validate()
         log.info(f"Starting tree copy of {self.sources} to {self.destination}")
@@ -65,27 +108,126 @@ class Backup(Threadable):
 
     @threaded_func()
     def _backup_thread(self, data_queue: Queue):
-        ignore_func = shutil.ignore_patterns(*self.exceptions)
+        exclusions = Exclusions(self.exceptions)
         root_dest = self.destination
         if self.use_wrapper:
             root_dest = os.path.join(root_dest, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
             os.mkdir(root_dest)
 
-        def copy_func(src, dest):
-            data_queue.put(AsyncUpdate(src, minor=True))
-            shutil.copy2(src, dest)
+        progress = ProgressReporter(data_queue)
+        if self.prescan:
+            self._prescan(data_queue, progress, exclusions)
+
+        pool = OrderedPool(self.copy_workers, max_pending=self.copy_workers * 4)
+        stats = CopyStats()
+        errors = []
+
+        def finish_file(context, future):
+            entry, dest = context
+            try:
+                stats.add(future.result(), entry.stat.st_size)
+            except OSError as e:
+                errors.append((entry.path, dest, str(e)))
+                return
+            progress.count(counter_copied)
+            progress.count(counter_bytes, entry.stat.st_size)
+            progress.advance(size=entry.stat.st_size)
+
+        def copy_func(entry, dest):
+            self.token.check()
+            progress.count(counter_scanned, message=entry.path)
+            if entry.stat.st_size < self.small_file_size:
+                pool.submit((entry, dest), copy_file, entry.path, dest)
+            else:
+                pool.skip((entry, dest), copy_file(entry.path, dest))
+            for context, future in pool.collect():
+                finish_file(context, future)
+
+        def drain():
+            for context, future in pool.collect(wait=True):
+                finish_file(context, future)
 
+        with pool:
+            for index, source in enumerate(self.sources):
+                destination = os.path.join(root_dest, os.path.basename(source))
+                data_queue.put(AsyncUpdate(f"Copying {source} to {destination}", index, len(self.sources)))
+                log.info(f"Copying {source} to {destination}")
+                self._copy_tree(source, destination, exclusions.for_tree(source), copy_func, drain)
+                progress.flush()
+        if len(errors) > 0:
+            raise shutil.Error(errors)
+        data_queue.put(AsyncUpdate(f"Complete [{self._summary(progress, stats)}]", len(self.sources),
+                                   len(self.sources), counters=dict(progress.counters)))
+
+    @staticmethod
+    def _summary(progress: ProgressReporter, stats: CopyStats) -> str:
+        """
+        :return: the counters of a run followed by the methods files were copied with
+        """
+        methods = stats.summary()
+        return progress.summary() if methods is None else f"{progress.summary()}; {methods}"
+
+    @staticmethod
+    def _copy_tree(source: str, destination: str, ignore_func: Optional[Callable[[str, List[str]], Iterable[str]]],
+                   copy_func: Callable[[ScanEntry, str], None], drain: Optional[Callable[[], None]] = None) -> None:
+        """
+        Copy a source tree with `scan_tree`. Directories are created as they are found and get the permissions and
+        times of their source once the tree is copied. Like `shutil.copytree`, errors on single files do not stop the
+        copy and are raised together at the end.
+
+        :param source: the directory to copy
+        :param destination: the directory to copy to. It may already exist.
+        :param ignore_func: the function deciding which names are excluded
+        :param copy_func: the function copying a file entry to its destination path
+        :param drain: called once every file was handed to `copy_func`, to finish copies still running on a pool
+        before the directories get their times
+        """
+        os.makedirs(destination, exist_ok=True)
+        dirs = [(source, destination)]
+        errors = []
+        for entry in scan_tree(source, ignore_func):
+            dest = os.path.join(destination, entry.relpath)
+            try:
+                if entry.is_dir:
+                    os.makedirs(dest, exist_ok=True)
+                    dirs.append((entry.path, dest))
+                else:
+                    copy_func(entry, dest)
+            except OSError as e:
+                errors.append((entry.path, dest, str(e)))
+        if drain is not None:
+            drain()
+        for src, dest in reversed(dirs):  # Deepest first, as copying into a directory changes its times
+            try:
+                shutil.copystat(src, dest)
+            except OSError as e:
+                errors.append((src, dest, str(e)))
+        if len(errors) > 0:
+            raise shutil.Error(errors)
+
+    def _prescan(self, data_queue: Queue, progress: ProgressReporter, exclusions: Exclusions) -> None:
+        """
+        Count the files and bytes of every source so progress can be reported in bytes with a time left
+
+        :param data_queue: the queue to post updates to
+        :param progress: the reporter to set the totals of
+        :param exclusions: the exclusion rules of the backup
+        """
+        files = 0
+        size = 0
         for index, source in enumerate(self.sources):
-            destination = os.path.join(root_dest, os.path.basename(source))
-            data_queue.put(AsyncUpdate(f"Copying {source} to {destination}", index, len(self.sources)))
-            log.info(f"Copying {source} to {destination}")
-            shutil.copytree(source, destination, False, ignore_func, copy_function=copy_func,
-                            ignore_dangling_symlinks=True)
-        data_queue.put(AsyncUpdate("Complete", len(self.sources), len(self.sources)))
+            self.token.check()
+            data_queue.put(AsyncUpdate(f"Scanning {source}", index, len(self.sources)))
+            source_files, source_size = tree_size(source, exclusions.for_tree(source))
+            files += source_files
+            size += source_size
+        log.info(f"Pre-scan found {files} files totalling {size} bytes")
+        progress.set_totals(files, size)
 
     @threaded_func()
     def _backup_thread_dry(self, data_queue: Queue):
         for i in range(1, 11):
+            self.token.check()
             data_queue.put(AsyncUpdate("Update" + ("!" * i), i, 10))
             sleep(0.25)
             data_queue.put(AsyncUpdate("Minor Update 1", minor=True))
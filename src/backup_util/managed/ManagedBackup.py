@@ -1,14 +1,21 @@
 import logging
 import os
-import shutil
 from datetime import datetime
+from concurrent.futures import Future
 from queue import Queue
-from typing import Optional
+from typing import Optional, Dict, List, Tuple
 
 from backup_util.Backup import Backup
-from backup_util.utils.datautils import path_common_suffix, find_match
-from backup_util.utils.threading import AsyncUpdate, threaded_func
-from .records import Record, MetaRecord, NoRecordError
+from backup_util.utils.copying import copy_file, copy_file_and_hash, CopyStats
+from backup_util.utils.datautils import hash_file, default_hash_algorithm, remove_empty_dirs, sync_paths
+from backup_util.utils.exclusions import Exclusions
+from backup_util.utils.scanner import ScanEntry
+from backup_util.utils.threading import AsyncUpdate, threaded_func, OrderedPool, default_workers, ProgressReporter, \
+    counter_scanned, counter_copied, counter_skipped, counter_bytes, JobCancelled
+from .journal import RunJournal
+from .records import Record, MetaRecord, NoRecordError, FileData, layout_files, layout_chunks
+from .segments import read_and_hash
+from .compression import codec_none, file_codecs, stored_name, compress_and_hash
 
 log = logging.getLogger(__name__)
 record_folder = ".records"
@@ -17,58 +24,429 @@ code_check = "[#]"
 code_copy_new = "[+]"
 code_copy_changed = "[~]"
 
+_resumed = "resumed"  # Pool result of files finished by an interrupted run
+
 
 class ManagedBackup(Backup):
-    def __init__(self, dry_run: bool = False):
-        super().__init__(dry_run, True)
+    def __init__(self, dry_run: bool = False, paranoid: bool = False, hash_workers: int = default_workers(),
+                 hash_processes: bool = False, hash_algorithm: str = default_hash_algorithm, hardlink: bool = False,
+                 layout: str = layout_files, prescan: bool = False, pack_threshold: int = 0,
+                 file_compression: str = codec_none):
+        """
+        :param dry_run: if True, no files are copied
+        :param paranoid: if True, every file is rehashed even if its size, modification time and inode match the
+        previous record
+        :param hash_workers: the number of workers hashing files in parallel
+        :param hash_processes: if True, hash in worker processes instead of threads
+        :param hash_algorithm: the hash algorithm used if the destination is not managed yet. Managed destinations keep
+        the algorithm stored in their metarecord
+        :param hardlink: if True, unchanged files are hard linked from the previous backup so every data folder holds
+        a complete tree
+        :param layout: the storage layout used if the destination is not managed yet
+        :param prescan: if True, the sources are counted before copying so progress is reported in bytes
+        :param pack_threshold: used if the destination is not managed yet. Files smaller than this many bytes are
+        packed into segments instead of being copied one by one. 0 turns packing off
+        :param file_compression: the codec compressible files are stored with if the destination is not managed yet,
+        one of `file_codecs`
+        """
+        super().__init__(dry_run, True, prescan)
+        self.paranoid = paranoid
+        self.hash_workers = hash_workers
+        self.hash_processes = hash_processes
+        self.hash_algorithm = hash_algorithm
+        self.hardlink = hardlink
+        self.layout = layout
+        self.pack_threshold = pack_threshold
+        self.file_compression = file_compression
         self.last_record: Optional[Record] = None
 
     @threaded_func()
     def _backup_thread(self, data_queue: Queue) -> None:
         self.last_record = None
-        ignore_func = shutil.ignore_patterns(*self.exceptions)
-        date = datetime.now()
-        date_safe = date.strftime('%Y-%m-%d_%H-%M-%S')
-
+        exclusions = Exclusions(self.exceptions)
         mr = MetaRecord.load_from(self.destination)
         if mr is None:
-            mr = MetaRecord.create_new(self.destination)
+            mr = MetaRecord.create_new(self.destination, self.hash_algorithm, self.layout, self.pack_threshold,
+                                       self.file_compression)
+        run = _BackupRun(self, mr, data_queue)
         try:
-            latest_record = mr.load_latest_record()
+            run.start(datetime.now())
+            if self.prescan:
+                self._prescan(data_queue, run.progress, exclusions)
+            cancelled = None
+            with run.pool:
+                for index, source in enumerate(self.sources):
+                    destination = os.path.join(run.root_dest, os.path.basename(source))
+                    data_queue.put(AsyncUpdate(f"Copying {source} to {destination}", index, len(self.sources)))
+                    log.info(f"Copying {source} to {destination}")
+                    try:
+                        self._copy_tree(source, destination, exclusions.for_tree(source), run.copy_file, run.drain)
+                    except JobCancelled as e:
+                        cancelled = e
+                    except BaseException as e:
+                        log.error(f"Error during copy: {str(e)}")
+                    run.drain()
+                    run.progress.flush()
+                    if cancelled is not None:
+                        break
+            run.save(partial=cancelled is not None)
+            self.last_record = run.rec
+            if cancelled is not None:  # The record only lists the files copied before cancelling
+                raise cancelled
+            data_queue.put(AsyncUpdate(f"Complete [{self._summary(run.progress, run.stats)}]", len(self.sources),
+                                       len(self.sources), counters=dict(run.progress.counters)))
+        finally:  # Entries are kept on disk when the run fails, so the next one resumes from them
+            run.close()
+
+
+class _Pending:
+    """
+    A file handed to the pool of a run, with what is needed to record it once its work is done
+    """
+
+    def __init__(self, src: str, dest: str, relpath: str, stat: os.stat_result, previous: Optional[FileData],
+                 copied: bool = False, packed: bool = False):
+        """
+        :param src: the source file
+        :param dest: the path of the file in the data folder
+        :param relpath: the path of the file relative to the data folder
+        :param stat: the stat of the source file
+        :param previous: the file in the latest record, or the journaled file if it was finished by an interrupted run
+        :param copied: if the worker stores the file in the data folder while hashing it
+        :param packed: if the file is packed into a segment
+        """
+        self.src = src
+        self.dest = dest
+        self.relpath = relpath
+        self.stat = stat
+        self.previous = previous
+        self.copied = copied
+        self.packed = packed
+
+
+class _BackupRun:
+    """
+    A single run of a managed backup. Files are scheduled on a pool by `copy_file` and recorded in traversal order by
+    `finish_file`, which hands each result to the method of the layout the file is stored with: copied or compressed
+    into the data folder, packed into a segment, or split into chunks.
+    """
+
+    def __init__(self, backup: ManagedBackup, mr: MetaRecord, data_queue: Queue):
+        """
+        :param backup: the backup being run
+        :param mr: the metarecord of the destination
+        :param data_queue: the queue to post updates to
+        """
+        self.backup = backup
+        self.mr = mr
+        try:
+            self.latest_record: Optional[Record] = mr.load_latest_record()
         except NoRecordError:
-            latest_record = None
-        rec = Record(self.destination, f"Backup for {date_safe}", f"data_{date_safe}", date)
-
-        # Gen new backup folder
-        root_dest = rec.data_path()
-        os.mkdir(root_dest)
-
-        def copy_func(src, dest):
-            data_queue.put(AsyncUpdate(f"{code_check} {src}", minor=True))
-            fd = rec.add_file(src, path_common_suffix(src, dest))
-
-            i, f = find_match(latest_record.files,
-                              lambda x: x.file == fd.file) if latest_record is not None else (None, None)
-            if i is None:  # Not in past record.
-                shutil.copy2(src, dest)
-                data_queue.put(AsyncUpdate(f"{code_copy_new} {src}", minor=True))
-            else:  # In past record
-                if f.hash != fd.hash:  # Different contents
-                    shutil.copy2(src, dest)
-                    data_queue.put(AsyncUpdate(f"{code_copy_changed} {src}", minor=True))
-                else:  # Same contents
-                    fd.source = f.source
-
-        for index, source in enumerate(self.sources):
-            destination = os.path.join(root_dest, os.path.basename(source))
-            data_queue.put(AsyncUpdate(f"Copying {source} to {destination}", index, len(self.sources)))
-            log.info(f"Copying {source} to {destination}")
+            self.latest_record = None
+        self.rec: Optional[Record] = None
+        self.root_dest: Optional[str] = None
+        self.journal: Optional[RunJournal] = None
+        self.resumed: Dict[str, FileData] = {}
+        self.rehash = False
+        # Data is synced before the journal so every journaled file can be read back
+        self.writer = mr.segment_store().writer() if mr.packs_files() else None
+        self.unsynced: List[str] = []  # Files written or linked into the data folder since the journal was last synced
+        self.store = mr.chunk_store() if mr.layout == layout_chunks else None
+        self.codec = mr.file_compression if mr.compresses_files() else codec_none
+        self.pool = OrderedPool(backup.hash_workers, backup.hash_processes)
+        self.progress = ProgressReporter(data_queue)
+        self.stats = CopyStats()
+
+    def start(self, date: datetime) -> None:
+        """
+        Continue the record of an interrupted run, or start a new record and its journal
+
+        :param date: the time the run started
+        """
+        self.rec, self.journal = self._resume()
+        if self.rec is None:
+            date_safe = date.strftime('%Y-%m-%d_%H-%M-%S')
+            self.rec = Record(self.mr.path, f"Backup for {date_safe}", f"data_{date_safe}", date,
+                              hash_algorithm=self.mr.hash_algorithm)
+        # Hashes of the latest record cannot be compared, so files it has stored are only trusted by their stat
+        self.rehash = self.latest_record is not None and self.latest_record.hash_algorithm != self.rec.hash_algorithm
+        if self.rehash:
+            log.info(f"Latest record was hashed with {self.latest_record.hash_algorithm} instead of "
+                     f"{self.rec.hash_algorithm}. Unchanged files will be rehashed.")
+        self.root_dest = self.rec.data_path()
+        os.makedirs(self.root_dest, exist_ok=self.journal is not None)
+        if self.journal is None:
+            self.journal = RunJournal.create(self.rec, before_sync=self.before_sync)
+
+    def _resume(self) -> Tuple[Optional[Record], Optional[RunJournal]]:
+        """
+        Find the journal of an earlier run that was interrupted, so its record is continued
+
+        :return: the record and journal of the interrupted run, or (None, None) if there is none to continue
+        """
+        journal_path = RunJournal.find_unfinished(self.mr.path)
+        if journal_path is None:
+            return None, None
+        try:
+            header, resumed = RunJournal.read(journal_path)
+        except ValueError:  # The run crashed before its header was synced, so nothing was journaled
+            log.warning(f"Discarding the journal {journal_path}, it has no header")
+            os.remove(journal_path)
+            return None, None
+        if header["hash_algorithm"] != self.mr.hash_algorithm:
+            log.info(f"Discarding the journal of {header['name']}, it was hashed with {header['hash_algorithm']}")
+            os.remove(journal_path)
+            return None, None
+        log.info(f"Resuming {header['name']} with {len(resumed)} files already copied")
+        self.resumed = resumed
+        rec = Record(self.mr.path, header["name"], header["folder"], datetime.fromisoformat(header["timestamp"]),
+                     hash_algorithm=self.mr.hash_algorithm)
+        return rec, RunJournal.resume(journal_path, before_sync=self.before_sync)
+
+    def before_sync(self) -> None:
+        if self.writer is not None:
+            self.writer.sync()
+        try:
+            sync_paths(self.unsynced)
+        finally:
+            self.unsynced.clear()
+
+    def copy_file(self, entry: ScanEntry, dest: str) -> None:
+        """
+        Schedule a scanned file and record the files whose work is done
+        """
+        self.backup.token.check()
+        src = entry.path
+        stat = entry.stat
+        self.progress.count(counter_scanned, message=f"{code_check} {src}")
+        relpath = os.path.relpath(dest, self.root_dest)
+        f = self.latest_record.get_file(relpath) if self.latest_record is not None else None
+        done = self.resumed.pop(relpath, None)
+        packed = self.writer is not None and stat.st_size < self.mr.pack_threshold
+        if done is not None and self._resumable(relpath, done, stat, packed):  # Finished before interruption
+            self.pool.skip(_Pending(src, dest, relpath, stat, done, packed=packed), _resumed)
+        elif self.store is not None:
+            self._schedule_chunked(_Pending(src, dest, relpath, stat, f))
+        elif packed:
+            self._schedule_packed(_Pending(src, dest, relpath, stat, f, packed=True))
+        else:
+            self._schedule_copy(_Pending(src, dest, relpath, stat, f))
+        for pending, future in self.pool.collect():
+            self.finish_file(pending, future)
+
+    def drain(self) -> None:
+        for pending, future in self.pool.collect(wait=True):  # Work in flight is finished so it can be recorded
+            self.finish_file(pending, future)
+
+    def _resumable(self, relpath: str, done: FileData, stat: os.stat_result, packed: bool) -> bool:
+        """
+        Check if a file finished by an interrupted run can be kept: it is unchanged, stored with the layout it would
+        be stored with now, and its data is still there
+        """
+        return done.stat_matches(stat) and (self.store is None) == (done.chunks is None) \
+            and packed == (done.segment is not None) and self._stored_intact(relpath, done)
+
+    def _stored_intact(self, relpath: str, done: FileData) -> bool:
+        """
+        Check that the data of a file finished by an interrupted run is still there, as the journal may have reached
+        the disk before it
+        """
+        try:
+            if done.chunks is not None:
+                return all(self.store.has(c) for c in done.chunks)
+            if done.segment is not None:
+                segment_id, offset, length = done.segment
+                return os.path.getsize(self.mr.segment_store().segment_path(segment_id)) >= offset + length
+            if done.source != self.rec.name:
+                return os.path.isfile(self.mr.resolve_file(done))
+            size = os.path.getsize(os.path.join(self.root_dest, self._stored_path(relpath, done)))
+            return size == done.size if done.codec is None else size > 0
+        except (OSError, NoRecordError):
+            return False
+
+    def _stored_path(self, dest: str, fd: FileData) -> str:
+        return stored_name(dest, fd.codec, self.codec != codec_none)
+
+    def _trusted_stat(self, f: Optional[FileData], stat: os.stat_result) -> bool:
+        """
+        Check if a file is taken as unchanged from the latest record without reading it
+        """
+        return f is not None and not self.backup.paranoid and not self.rehash and f.stat_matches(stat)
+
+    def _schedule_chunked(self, pending: _Pending) -> None:
+        if self._trusted_stat(pending.previous, pending.stat):
+            self.pool.skip(pending)
+        else:  # Chunks that are already stored are not written again
+            self.pool.submit(pending, self.store.store_file, pending.src)
+
+    def _schedule_packed(self, pending: _Pending) -> None:
+        if self._trusted_stat(pending.previous, pending.stat):
+            self.pool.skip(pending)
+        else:
+            self.pool.submit(pending, read_and_hash, pending.src, self.rec.hash_algorithm)
+
+    def _schedule_copy(self, pending: _Pending) -> None:
+        f = pending.previous
+        if f is not None and f.stat_matches(pending.stat):
+            # Most likely unchanged, so only copy if the hash differs or, without comparable hashes, if paranoid
+            if self.backup.paranoid or self.rehash:
+                self.pool.submit(pending, hash_file, pending.src, self.rec.hash_algorithm)
+            else:
+                self.pool.skip(pending)
+            return
+        pending.copied = True
+        if self.codec != codec_none:  # New or modified, so hash while compressing to read the file once
+            self.pool.submit(pending, compress_and_hash, pending.src, pending.dest, self.codec,
+                             self.rec.hash_algorithm)
+        else:  # New or modified, so hash while copying to read the file once
+            self.pool.submit(pending, copy_file_and_hash, pending.src, pending.dest, self.rec.hash_algorithm)
+
+    def finish_file(self, pending: _Pending, future: Future) -> None:
+        """
+        Add a file to the record and the journal once its work is done
+        """
+        self.progress.advance(size=pending.stat.st_size)
+        try:
+            result = future.result()
+            if result is _resumed:  # Already in the journal
+                fd = self._finish_resumed(pending)
+            elif result is None:  # Unmodified since last record
+                f = pending.previous
+                fd = self.rec.add_file(pending.src, pending.relpath, f.source, f.hash, pending.stat)
+                self._reuse_file(fd, pending)
+                self.progress.count(counter_skipped)
+            elif pending.packed:
+                fd = self._finish_packed(pending, *result)
+            elif self.store is not None:
+                fd = self._finish_chunked(pending, *result)
+            else:
+                fd = self._finish_copy(pending, result)
+            self.journal.add_file(fd)
+        except OSError as e:
+            log.error(f"Error during copy of {pending.src}: {str(e)}")
+
+    def _finish_resumed(self, pending: _Pending) -> FileData:
+        done = pending.previous
+        fd = self.rec.add_file(pending.src, pending.relpath, done.source, done.hash, pending.stat)
+        _copy_location(done, fd)
+        self.progress.count(counter_skipped)
+        return fd
+
+    def _finish_packed(self, pending: _Pending, file_hash: str, data: bytes) -> FileData:
+        """
+        Record a file read by a worker. It is appended here so segments are written by one thread.
+        """
+        fd = self.rec.add_file(pending.src, pending.relpath, file_hash=file_hash, stat=pending.stat)
+        if pending.previous is not None and self._same_contents(pending.previous, fd, pending.stat):
+            self._reuse_file(fd, pending)
+            self.progress.count(counter_skipped)
+        else:
+            fd.segment = self.writer.append(data, self.rec.folder, pending.relpath,
+                                            {"hash": fd.hash, "size": fd.size, "mtime_ns": fd.mtime_ns})
+            self._count_copied(pending)
+        return fd
+
+    def _finish_chunked(self, pending: _Pending, file_hash: str, chunks: List[str]) -> FileData:
+        """
+        Record a file whose chunks were stored by a worker
+        """
+        fd = self.rec.add_file(pending.src, pending.relpath, file_hash=file_hash, stat=pending.stat)
+        fd.chunks = chunks
+        if pending.previous is not None and self._same_contents(pending.previous, fd, pending.stat):
+            fd.source = pending.previous.source
+            self.progress.count(counter_skipped)
+        else:
+            self._count_copied(pending)
+        return fd
+
+    def _finish_copy(self, pending: _Pending, result) -> FileData:
+        """
+        Record a file that was copied or compressed into the data folder, or only hashed if it looked unchanged
+        """
+        file_hash, method = result if pending.copied else (result, None)
+        if method is not None:  # Hashed while copying
+            self.stats.add(method, pending.stat.st_size)
+        fd = self.rec.add_file(pending.src, pending.relpath, file_hash=file_hash, stat=pending.stat)
+        if method in file_codecs:
+            fd.codec = method
+        if pending.previous is not None and self._same_contents(pending.previous, fd, pending.stat):
+            self._reuse_file(fd, pending)
+            self.progress.count(counter_skipped)
+            return fd
+        if not pending.copied:  # In past record with different contents
+            self._store_changed(pending, fd)
+        self.unsynced.append(self._stored_path(pending.dest, fd))
+        self._count_copied(pending)
+        return fd
+
+    def _store_changed(self, pending: _Pending, fd: FileData) -> None:
+        if self.codec != codec_none:
+            method = compress_and_hash(pending.src, pending.dest, self.codec, self.rec.hash_algorithm)[1]
+            fd.codec = method if method in file_codecs else None
+        else:
+            method = copy_file(pending.src, pending.dest)
+        self.stats.add(method, pending.stat.st_size)
+
+    def _same_contents(self, f: FileData, fd: FileData, stat: os.stat_result) -> bool:
+        """
+        Check if a file has the contents of the previous version. Without comparable hashes, only an unchanged stat is
+        trusted, and never in paranoid mode.
+        """
+        if self.rehash:
+            return not self.backup.paranoid and f.stat_matches(stat)
+        return f.hash == fd.hash
+
+    def _reuse_file(self, fd: FileData, pending: _Pending) -> None:
+        """
+        Point a file at the stored data of its previous version, or hard link that data if enabled
+        """
+        f = pending.previous
+        if pending.copied:  # The previous copy is used instead
+            os.remove(self._stored_path(pending.dest, fd))
+        _copy_location(f, fd)
+        if self.backup.hardlink and self.store is None and f.segment is None:
             try:
-                shutil.copytree(source, destination, False, ignore_func, copy_function=copy_func,
-                                ignore_dangling_symlinks=True)
-            except BaseException as e:
-                log.error(f"Error during copy: {str(e)}")
-        rec.save(mr)
-        mr.save()
-        self.last_record = rec
-        data_queue.put(AsyncUpdate("Complete", len(self.sources), len(self.sources)))
+                os.link(self.mr.resolve_file(f), self._stored_path(pending.dest, f))
+                self.unsynced.append(self._stored_path(pending.dest, f))
+                fd.source = self.rec.name
+                return
+            except (OSError, NoRecordError) as e:
+                log.debug(f"Could not link {fd.file} from {f.source}: {str(e)}")
+        fd.source = f.source
+
+    def _count_copied(self, pending: _Pending) -> None:
+        code = code_copy_new if pending.previous is None else code_copy_changed
+        self.progress.count(counter_copied, message=f"{code} {pending.src}")
+        self.progress.count(counter_bytes, pending.stat.st_size)
+
+    def save(self, partial: bool) -> None:
+        """
+        Save the record once every file is recorded, then mark the journal as finished
+
+        :param partial: if the run was cancelled, so the record only lists the files copied before
+        """
+        if self.store is not None or self.writer is not None:  # Folders only holding packed files are left empty
+            remove_empty_dirs(self.root_dest)
+        if self.writer is not None:
+            self.writer.close()
+            os.makedirs(self.root_dest, exist_ok=True)  # Kept so the folder is found when records are rebuilt
+        self.rec.partial = partial
+        self.journal.sync()  # Every file the record lists is on disk before the record is
+        self.rec.save(self.mr)
+        self.mr.save()
+        self.journal.finish()  # The record now lists every journaled file
+
+    def close(self) -> None:
+        if self.journal is not None:
+            self.journal.close()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def _copy_location(src: FileData, fd: FileData) -> None:
+    """
+    Make a file point at where the contents of another file are stored
+    """
+    fd.chunks = src.chunks
+    fd.segment = src.segment
+    fd.codec = src.codec
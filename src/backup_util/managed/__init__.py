@@ -1,3 +1,5 @@
 from .ManagedBackup import ManagedBackup
 from .records import MetaRecord, MetaRecordEntry, Record, NoRecordError, FileData
 from .rebuilder import Rebuilder
+from .chunkstore import ChunkStore
+from .journal import RunJournal
@@ -0,0 +1,169 @@
+import json
+import sqlite3
+from contextlib import closing
+from typing import List, Tuple, Any, Iterable, Optional
+
+catalog_name = "catalog.sqlite"
+_schema_version = 1  # Catalogs of an older version are emptied on open and filled again by the metarecord
+
+_schema = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    folder TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS hashes (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS files (
+    record_id INTEGER NOT NULL REFERENCES records(id) ON DELETE CASCADE,
+    path_id INTEGER NOT NULL REFERENCES paths(id),
+    hash_id INTEGER NOT NULL REFERENCES hashes(id),
+    source_id INTEGER NOT NULL REFERENCES sources(id),
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    chunks TEXT,
+    segment TEXT,
+    codec TEXT,
+    PRIMARY KEY (record_id, path_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_path ON files(path_id);
+CREATE INDEX IF NOT EXISTS files_hash ON files(hash_id);
+"""
+
+_file_columns = "r.name, p.path, h.hash, s.name, f.size, f.mtime_ns, f.inode, f.chunks, f.segment, f.codec"
+_file_joins = """
+    FROM files f
+    JOIN records r ON r.id = f.record_id
+    JOIN paths p ON p.id = f.path_id
+    JOIN hashes h ON h.id = f.hash_id
+    JOIN sources s ON s.id = f.source_id
+"""
+
+
+def _dump(value: Optional[list]) -> Optional[str]:
+    return json.dumps(value) if value is not None else None
+
+
+def _load(row: tuple) -> tuple:
+    """
+    Decode the chunk list and segment of a file row
+    """
+    return row[:7] + tuple(json.loads(v) if v is not None else None for v in row[7:9]) + row[9:]
+
+
+class Catalog:
+    """
+    SQLite index of every file in every record of a managed folder. Paths, hashes and sources are stored once in their
+    own tables so lookups by path or hash only touch an index instead of loading records.
+    """
+
+    def __init__(self, db_path: str):
+        """
+        :param db_path: the path to the catalog database. It is created on first use.
+        """
+        self.db_path = db_path
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path)
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.execute("PRAGMA journal_mode = WAL")
+        (version,) = connection.execute("PRAGMA user_version").fetchone()
+        if version < _schema_version:  # Files were stored without the columns needed to restore them
+            with connection:
+                connection.execute("DROP TABLE IF EXISTS files")
+                connection.execute("DROP TABLE IF EXISTS records")
+        connection.executescript(_schema)
+        connection.execute(f"PRAGMA user_version = {_schema_version}")
+        return connection
+
+    def is_empty(self) -> bool:
+        """
+        :return: True if no records are stored, e.g. because the catalog was created by an older version
+        """
+        with closing(self._connect()) as connection:
+            return connection.execute("SELECT 1 FROM records LIMIT 1").fetchone() is None
+
+    def put_record(self, name: str, folder: str, timestamp: str, files: Iterable[Any]) -> None:
+        """
+        Add a record to the catalog, replacing any files stored for it before
+
+        :param name: the name of the record
+        :param folder: the data folder of the record
+        :param timestamp: the ISO timestamp of the record
+        :param files: the `FileData` objects of the record
+        """
+        with closing(self._connect()) as connection, connection:
+            connection.execute("INSERT INTO records(name, folder, timestamp) VALUES (?, ?, ?) "
+                               "ON CONFLICT(name) DO UPDATE SET folder = excluded.folder, "
+                               "timestamp = excluded.timestamp", (name, folder, timestamp))
+            (record_id,) = connection.execute("SELECT id FROM records WHERE name = ?", (name,)).fetchone()
+            connection.execute("CREATE TEMP TABLE staging (path TEXT, hash TEXT, source TEXT, size INTEGER, "
+                               "mtime_ns INTEGER, inode INTEGER, chunks TEXT, segment TEXT, codec TEXT)")
+            connection.executemany("INSERT INTO staging VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   ((f.file, f.hash, f.source, f.size, f.mtime_ns, f.inode, _dump(f.chunks),
+                                     _dump(f.segment), f.codec) for f in files))
+            connection.execute("INSERT OR IGNORE INTO paths(path) SELECT path FROM staging")
+            connection.execute("INSERT OR IGNORE INTO hashes(hash) SELECT hash FROM staging")
+            connection.execute("INSERT OR IGNORE INTO sources(name) SELECT source FROM staging")
+            connection.execute("DELETE FROM files WHERE record_id = ?", (record_id,))
+            connection.execute("""
+                INSERT OR REPLACE INTO files(record_id, path_id, hash_id, source_id, size, mtime_ns, inode, chunks,
+                                             segment, codec)
+                SELECT ?, p.id, h.id, s.id, st.size, st.mtime_ns, st.inode, st.chunks, st.segment, st.codec
+                FROM staging st
+                JOIN paths p ON p.path = st.path
+                JOIN hashes h ON h.hash = st.hash
+                JOIN sources s ON s.name = st.source
+            """, (record_id,))
+            connection.execute("DROP TABLE staging")
+
+    def sync_records(self, entries: Iterable[Tuple[str, Optional[str], str]]) -> None:
+        """
+        Make the records table match a metarecord. Records that are no longer listed are removed with their files.
+
+        :param entries: the (name, folder, ISO timestamp) of every record in the metarecord
+        """
+        entries = list(entries)
+        with closing(self._connect()) as connection, connection:
+            connection.executemany("INSERT INTO records(name, folder, timestamp) VALUES (?, ?, ?) "
+                                   "ON CONFLICT(name) DO UPDATE SET folder = coalesce(excluded.folder, folder), "
+                                   "timestamp = excluded.timestamp", entries)
+            names = {e[0] for e in entries}
+            stale = [(n,) for (n,) in connection.execute("SELECT name FROM records") if n not in names]
+            connection.executemany("DELETE FROM records WHERE name = ?", stale)
+
+    def file_versions(self, path: str) -> List[tuple]:
+        """
+        Find every version of a file
+
+        :param path: the path of the file relative to the data folders
+        :return: a list of (record name, path, hash, source, size, mtime_ns, inode, chunks, segment, codec) ordered
+        from oldest to newest record
+        """
+        with closing(self._connect()) as connection:
+            return [_load(row) for row in connection.execute(
+                f"SELECT {_file_columns} {_file_joins} WHERE p.path = ? ORDER BY r.timestamp", (path,))]
+
+    def find_hash(self, file_hash: str) -> List[tuple]:
+        """
+        Find every file with the given contents
+
+        :param file_hash: the hash of the contents
+        :return: a list of (record name, path, hash, source, size, mtime_ns, inode, chunks, segment, codec) ordered
+        from oldest to newest record
+        """
+        with closing(self._connect()) as connection:
+            return [_load(row) for row in connection.execute(
+                f"SELECT {_file_columns} {_file_joins} WHERE h.hash = ? ORDER BY r.timestamp", (file_hash,))]
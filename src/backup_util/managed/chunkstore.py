@@ -0,0 +1,191 @@
+import hashlib
+import os
+import shutil
+import uuid
+from typing import List, Tuple, Iterator, BinaryIO, Set
+
+from backup_util.utils.datautils import new_hasher, default_hash_algorithm
+
+chunk_folder = "chunks"
+
+min_chunk_size = 256 * 1024
+avg_chunk_size = 1024 * 1024
+max_chunk_size = 4 * 1024 * 1024
+
+# Gear table for the rolling hash. Derived from a fixed seed so chunk boundaries are stable across runs and machines.
+_gear = tuple(int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=8).digest(), "little") for i in range(256))
+_hash_bits = 0xFFFFFFFFFFFFFFFF
+_window = 64  # Every byte is shifted out of the 64 bit hash after this many bytes
+tmp_ext = ".tmp"
+
+
+def _cut_point(buffer: bytearray, start: int, min_size: int, max_size: int, mask: int) -> int:
+    """
+    Find the end of the chunk starting at `start` using a gear rolling hash. The hash only depends on the last
+    `_window` bytes, so it is started just before `min_size` instead of at the start of the chunk. A cut is forced at
+    `max_size`.
+
+    :return: the length of the chunk
+    """
+    length = len(buffer) - start
+    if length <= min_size:
+        return length
+    end = min(length, max_size)
+    gear = _gear
+    h = 0
+    for byte in buffer[start + max(0, min_size - _window):start + min_size]:
+        h = ((h << 1) + gear[byte]) & _hash_bits
+    i = min_size
+    for byte in buffer[start + min_size:start + end]:
+        i += 1
+        h = ((h << 1) + gear[byte]) & _hash_bits
+        if not h & mask:
+            return i
+    return end
+
+
+def iter_chunks(file: BinaryIO, min_size: int = min_chunk_size, avg_size: int = avg_chunk_size,
+                max_size: int = max_chunk_size) -> Iterator[bytes]:
+    """
+    Split a stream into content-defined chunks. Boundaries depend on the data around them rather than on offsets, so
+    an insertion only changes the chunks around it.
+
+    :param file: a stream opened in binary mode
+    :param min_size: the smallest chunk produced, except for the last one
+    :param avg_size: the expected chunk size
+    :param max_size: the largest chunk produced
+    :return: an iterator of chunks
+    """
+    bits = max(1, (avg_size - min_size).bit_length() - 1)
+    mask = ((1 << bits) - 1) << (64 - bits)  # High bits depend on the widest window of input
+    buffer = bytearray()
+    start = 0  # Chunks before this offset were yielded. They are dropped when the buffer is refilled
+    eof = False
+    while True:
+        if not eof and len(buffer) - start < max_size:
+            del buffer[:start]
+            start = 0
+            while not eof and len(buffer) < max_size:
+                block = file.read(max_size)
+                if not block:
+                    eof = True
+                else:
+                    buffer += block
+        if len(buffer) == start:
+            break
+        cut = _cut_point(buffer, start, min_size, max_size, mask)
+        yield bytes(buffer[start:start + cut])
+        start += cut
+
+
+class ChunkStore:
+    """
+    Content addressed chunk storage in the `chunks` folder of a managed destination. Each chunk is stored once under
+    the hash of its contents, so identical data in different files or backups is only written once.
+    """
+
+    def __init__(self, path: str, hash_algorithm: str = default_hash_algorithm):
+        """
+        :param path: the managed folder
+        :param hash_algorithm: the algorithm chunks and files are hashed with
+        """
+        self.path = path
+        self.root = os.path.join(path, chunk_folder)
+        self.hash_algorithm = hash_algorithm
+
+    def chunk_path(self, chunk_id: str) -> str:
+        return os.path.join(self.root, chunk_id[:2], chunk_id)
+
+    def has(self, chunk_id: str) -> bool:
+        return os.path.isfile(self.chunk_path(chunk_id))
+
+    def put(self, data: bytes) -> str:
+        """
+        Store a chunk if it is not stored yet
+
+        :param data: the contents of the chunk
+        :return: the id of the chunk
+        """
+        hasher = new_hasher(self.hash_algorithm)
+        hasher.update(data)
+        chunk_id = hasher.hexdigest()
+        if not self.has(chunk_id):
+            path = self.chunk_path(chunk_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}{tmp_ext}"  # Concurrent writers of the same chunk must not collide
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())  # Files journaled as stored must not point to an empty chunk after a crash
+            os.replace(tmp_path, path)
+        return chunk_id
+
+    def read(self, chunk_id: str) -> bytes:
+        with open(self.chunk_path(chunk_id), "rb") as f:
+            return f.read()
+
+    def remove(self, chunk_id: str) -> int:
+        """
+        Remove a chunk from the store
+
+        :param chunk_id: the id of the chunk
+        :return: the number of bytes freed
+        """
+        path = self.chunk_path(chunk_id)
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+
+    def all_chunks(self, temporary: bool = False) -> Iterator[str]:
+        """
+        List every chunk in the store
+
+        :param temporary: list the partial chunks of interrupted writes instead
+        :return: an iterator of chunk ids
+        """
+        if not os.path.isdir(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            prefix_path = os.path.join(self.root, prefix)
+            if os.path.isdir(prefix_path):
+                for name in os.listdir(prefix_path):
+                    if name.endswith(tmp_ext) == temporary:
+                        yield name
+
+    def unreferenced(self, referenced: Set[str]) -> List[str]:
+        """
+        Find chunks that are not used by any file, along with partial chunks left behind by an interrupted write. Both
+        can be passed to `remove`.
+
+        :param referenced: the ids of all chunks used by records
+        :return: the ids of unused chunks
+        """
+        return [c for c in self.all_chunks() if c not in referenced] + list(self.all_chunks(temporary=True))
+
+    def store_file(self, path: str) -> Tuple[str, List[str]]:
+        """
+        Split a file into chunks and store any chunks that are not stored yet. The file is read once to both hash and
+        chunk it.
+
+        :param path: the file to store
+        :return: the hash of the whole file and the list of chunk ids making up the file
+        """
+        file_hasher = new_hasher(self.hash_algorithm)
+        chunks = []
+        with open(path, "rb") as f:
+            for data in iter_chunks(f):
+                file_hasher.update(data)
+                chunks.append(self.put(data))
+        return file_hasher.hexdigest(), chunks
+
+    def restore_file(self, chunks: List[str], dest: str) -> None:
+        """
+        Reassemble a file from its chunks
+
+        :param chunks: the chunk ids of the file, in order
+        :param dest: the path to write the file to
+        """
+        with open(dest, "wb") as f:
+            for chunk_id in chunks:
+                with open(self.chunk_path(chunk_id), "rb") as chunk:
+                    shutil.copyfileobj(chunk, f)
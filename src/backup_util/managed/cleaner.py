@@ -1,19 +1,107 @@
+from __future__ import annotations
+
+import json
+import logging
 import os
+from concurrent.futures import Future
 from queue import Queue
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Set, Iterator, Dict
+
+from backup_util.utils.datautils import prune_empty_parents
+from backup_util.utils.threading import ThrowingThread, AsyncUpdate, Threadable, threaded_func, default_workers, \
+    OrderedPool, ProgressReporter, JobCancelled
+from backup_util.managed import MetaRecord, MetaRecordEntry, NoRecordError
+from backup_util.managed.records import layout_chunks, diff_unchanged, record_folder
+from backup_util.managed.compression import stored_name
+from backup_util.managed.journal import RunJournal
+
+log = logging.getLogger(__name__)
+
+cleaner_state_name = "cleaner.json"
+default_delete_workers = 16
+
+
+def _remove_file(path: str) -> int:
+    """
+    Remove a file
+
+    :param path: the file to remove
+    :return: the number of bytes freed
+    """
+    try:
+        size = os.lstat(path).st_size
+        os.remove(path)
+    except FileNotFoundError:  # Removed by an earlier, interrupted clean
+        return 0
+    return size
+
+
+class CleanerState:
+    """
+    The record pairs a managed folder has already been cleaned for. Stored next to the metarecord so later cleans only
+    diff pairs involving new records.
+    """
+
+    def __init__(self, path: str, pairs: Optional[Set[Tuple[str, str]]] = None):
+        """
+        :param path: the managed folder
+        :param pairs: the (older, newer) record names of every cleaned pair
+        """
+        self.path = path
+        self.pairs: Set[Tuple[str, str]] = pairs if pairs is not None else set()
 
-from backup_util.utils.threading import ThrowingThread, AsyncUpdate, Threadable, threaded_func
-from backup_util.managed import MetaRecord, Record
+    @classmethod
+    def load_from(cls, path: str) -> CleanerState:
+        """
+        Load the clean state of a managed folder. A folder that was never cleaned has an empty state.
+
+        :param path: the managed folder
+        :return: the clean state
+        """
+        abspath = os.path.join(path, record_folder, cleaner_state_name)
+        if not os.path.isfile(abspath):
+            return cls(path)
+        with open(abspath, "r") as file:
+            data = json.load(file)
+            return cls(path, {(old, new) for old, new in data["pairs"]})
+
+    def save(self) -> None:
+        with open(os.path.join(self.path, record_folder, cleaner_state_name), "w+") as file:
+            json.dump(self.__jsonify__(), file)
+
+    def __jsonify__(self):
+        return {
+            "pairs": sorted(list(p) for p in self.pairs)
+        }
 
 
 class Cleaner(Threadable):
-    def __init__(self, mr: MetaRecord):
+    def __init__(self, mr: MetaRecord, incremental: bool = True, load_workers: int = default_workers(),
+                 load_processes: bool = False, delete_workers: int = default_delete_workers):
+        """
+        :param mr: the metarecord of the folder to clean
+        :param incremental: only diff record pairs that were not cleaned before. If False, every pair is diffed again.
+        :param load_workers: the number of records parsed at once
+        :param load_processes: parse records in worker processes instead of threads
+        :param delete_workers: the number of files removed at once. Removing is bound by the latency of the
+        destination rather than by the CPU, so this may be well above the number of cores
+        """
         super().__init__()
         self.metarecord: MetaRecord = mr
-        self.to_delete: List[Tuple[Record, List[str]]] = []
+        self.incremental = incremental
+        self.load_workers = load_workers
+        self.load_processes = load_processes
+        self.to_delete: List[Tuple[MetaRecordEntry, List[str]]] = []
+        self.orphan_chunks: List[str] = []
+        self.delete_size = 0  # Bytes held by the files in `to_delete` and `orphan_chunks`
+        self.state: CleanerState = CleanerState.load_from(mr.path) if incremental else CleanerState(mr.path)
+        self.pending_pairs: Set[Tuple[str, str]] = set()
+        self._pending_names: List[str] = []
+        self.delete_workers = delete_workers
+        self.reclaimed_bytes = 0
 
     def file_count(self) -> int:
-        count = 0
+        count = len(self.orphan_chunks)
         for rec, files in self.to_delete:
             count += len(files)
         return count
@@ -21,37 +109,196 @@ class Cleaner(Threadable):
     @threaded_func()
     def perform_clean(self, data_queue: Queue):
         """
-        Perform cleaning operations
+        Perform cleaning operations. Each record is written once with its sources moved to the earlier copies before
+        its files are removed, so an interrupted clean never leaves a record pointing at a removed file. Files are
+        removed on a pool of `delete_workers` threads, emptied directories are pruned and the metarecord is saved once
+        at the end. When small files are packed, the segments are compacted last. The bytes freed are kept in
+        `self.reclaimed_bytes`.
 
         :param data_queue: the queue for posting updates
         """
-        pmax = len(self.to_delete)
-        for i, v in enumerate(self.to_delete):
-            rec, files = v
-            data_queue.put(AsyncUpdate(f"Cleaning {rec.name}", i, pmax))
-            for file in files:
-                data_queue.put(AsyncUpdate(file, minor=True))
-                os.remove(os.path.join(rec.data_path(), file))
-            rec.save()
-        data_queue.put(AsyncUpdate("Complete", pmax, pmax))
+        pmax = len(self.to_delete) + (1 if len(self.orphan_chunks) > 0 else 0) + \
+            (1 if self.metarecord.packs_files() else 0)
+        deletions = {entry.name: files for entry, files in self.to_delete}
+        loader = self.metarecord.loader(self.load_workers, self.load_processes)
+        self.reclaimed_bytes = 0
+        progress = ProgressReporter(data_queue)
+        progress.set_totals(self.file_count(), self.delete_size)
+        i = 0
+        done_pairs = set()
+        cancelled = None
+        with OrderedPool(self.delete_workers, max_pending=self.delete_workers * 64) as pool:
+            try:
+                for older, newer in loader.iter_pairs(self._pending_names):
+                    self.token.check()
+                    pair = (older.name, newer.name)
+                    if pair not in self.pending_pairs:
+                        continue
+                    if newer.name not in deletions:
+                        done_pairs.add(pair)
+                        continue
+                    data_queue.put(AsyncUpdate(f"Cleaning {newer.name}", i, pmax))
+                    i += 1
+                    files = deletions[newer.name]
+                    stored = []
+                    for file in files:
+                        new = newer.get_file(file)
+                        old = older.get_file(file)
+                        if new.segment is None:  # Packed files are reclaimed by compacting the segments
+                            stored.append(stored_name(file, new.codec, self.metarecord.compresses_files()))
+                        new.source = old.source
+                        new.segment = old.segment
+                        new.codec = old.codec
+                    newer.write(self.metarecord)
+                    data_path = newer.data_path()
+                    dirs = set()
+                    try:
+                        for file in stored:
+                            self.token.check()
+                            path = os.path.join(data_path, file)
+                            dirs.add(os.path.dirname(path))
+                            pool.submit(path, _remove_file, path)
+                            self._collect_removed(pool.collect(), progress)
+                    finally:  # Removals in flight are finished even when cancelled
+                        self._collect_removed(pool.collect(wait=True), progress)
+                        prune_empty_parents(dirs, data_path)
+                    done_pairs.add(pair)
+                if len(self.orphan_chunks) > 0:
+                    data_queue.put(AsyncUpdate(f"Removing {len(self.orphan_chunks)} unreferenced chunks", i, pmax))
+                    store = self.metarecord.chunk_store()
+                    removed = []
+                    try:
+                        for chunk_id in self.orphan_chunks:
+                            self.token.check()
+                            pool.submit(chunk_id, store.remove, chunk_id)
+                            removed.append(chunk_id)
+                            self._collect_removed(pool.collect(), progress)
+                    finally:
+                        self._collect_removed(pool.collect(wait=True), progress)
+                        prune_empty_parents({os.path.dirname(store.chunk_path(c)) for c in removed}, store.root)
+                        self.orphan_chunks = self.orphan_chunks[len(removed):]
+                if self.metarecord.packs_files():
+                    data_queue.put(AsyncUpdate("Compacting segments", i, pmax))
+                    self._compact_segments()
+            except JobCancelled as e:
+                cancelled = e
+        progress.flush()
+        self.metarecord.save()
+        self.state.pairs.update(done_pairs)
+        self.state.save()
+        self.pending_pairs -= done_pairs
+        cleaned = {new for old, new in done_pairs}
+        self.to_delete = [(entry, files) for entry, files in self.to_delete if entry.name not in cleaned]
+        if cancelled is not None:  # Partly cleaned records are found again by the next diff
+            raise cancelled
+        data_queue.put(AsyncUpdate(f"Complete, {self.reclaimed_bytes / 1024 ** 2:.1f} MiB reclaimed", pmax, pmax))
+
+    def _compact_segments(self) -> None:
+        """
+        Reclaim the space of packed files no record uses any more. Segments without live entries are removed and
+        sparse segments are copied into new ones first. Records are rewritten to point at the copies before the old
+        segments are removed, so an interrupted compaction leaves at worst some unused segments for the next one.
+
+        Nothing is compacted while a backup is unfinished, as its journal may reference segments no record uses yet.
+        Entries packed for a data folder without a record are always kept, so the Rebuilder can still recover them.
+        """
+        if RunJournal.find_unfinished(self.metarecord.path) is not None:
+            log.info("Not compacting segments, a backup to this folder did not finish")
+            return
+        try:
+            recorded = {self.metarecord.folder_of(e.name) for e in self.metarecord.records}
+        except (NoRecordError, OSError) as e:
+            log.error(f"Not compacting segments, the data folders of the records are unknown: {str(e)}")
+            return
+        store = self.metarecord.segment_store()
+        loader = self.metarecord.loader(self.load_workers, self.load_processes)
+        live: Dict[str, Set[Tuple[int, int]]] = {}
+        for segment_id in store.all_segments():
+            for entry in store.index(segment_id):
+                if entry["folder"] not in recorded:
+                    live.setdefault(segment_id, set()).add((entry["offset"], entry["length"]))
+        for rec in loader.iter_records(self.metarecord.record_names()):
+            self.token.check()
+            for f in rec.files:
+                if f.segment is not None:
+                    live.setdefault(f.segment[0], set()).add((f.segment[1], f.segment[2]))
+        unused, sparse = store.plan_compaction(live)
+        if len(sparse) > 0:
+            moved = store.rewrite(sparse, live, self.token.check)
+            self.reclaimed_bytes -= sum(ref[2] for ref in moved.values())
+            for rec in loader.iter_records(self.metarecord.record_names()):
+                self.token.check()
+                changed = False
+                for f in rec.files:
+                    if f.segment is not None and (f.segment[0], f.segment[1]) in moved:
+                        f.segment = moved[(f.segment[0], f.segment[1])]
+                        changed = True
+                if changed:
+                    rec.write(self.metarecord)
+        for segment_id in unused + sparse:
+            self.reclaimed_bytes += store.remove(segment_id)
+
+    def _collect_removed(self, removed: Iterator[Tuple[str, Future]], progress: ProgressReporter) -> None:
+        for path, future in removed:
+            size = future.result()
+            self.reclaimed_bytes += size
+            progress.advance(size=size, message=f"Removed {path}")
 
     @threaded_func()
     def generate_diffs(self, data_queue: Queue):
         """
         Calculate the change history of all backups for the metarecord this class was created with. Redundant files are
-        collected and saved in `self.to_delete`
+        collected per record in `self.to_delete`. Records are loaded as a sliding window of two, so memory use does not
+        grow with the number of records. When incremental, only pairs of consecutive records that were not
+        cleaned before are loaded and diffed. Files hard linked to an earlier backup are left in place, as removing
+        them would not free any space. For chunked layouts, chunks no longer used by any record are collected in
+        `self.orphan_chunks`.
 
         :param data_queue: the queue to post updates to
         """
         data_queue.put(AsyncUpdate("Loading Records...", 0, 1))
-        recs = [Record.load_from(self.metarecord.path, r.name) for r in self.metarecord.records]
-        recs.sort(key=lambda r: r.timestamp)
-        for i in range(len(recs) - 1):
-            add, chg, rm, uchg = recs[i].file_diff(recs[i + 1])
-            if len(uchg) > 0:
-                files = []
-                for item in uchg:
-                    files.append(item[1].file)
-                    item[1].source = item[0].source
-                self.to_delete.append((recs[i + 1], files))
+        entries = sorted(self.metarecord.records, key=lambda r: r.timestamp)
+        pairs = [(entries[i].name, entries[i + 1].name) for i in range(len(entries) - 1)]
+        self.pending_pairs = {p for p in pairs if p not in self.state.pairs}
+        self._pending_names = [e.name for i, e in enumerate(entries)
+                               if (i > 0 and (entries[i - 1].name, e.name) in self.pending_pairs)
+                               or (i + 1 < len(entries) and (e.name, entries[i + 1].name) in self.pending_pairs)]
+        loader = self.metarecord.loader(self.load_workers, self.load_processes)
+        for older, newer in loader.iter_pairs(self._pending_names):  # Only two records are held at once
+            self.token.check()
+            if (older.name, newer.name) not in self.pending_pairs:
+                continue
+            files = []
+            for kind, old, new in older.iter_diff(newer):
+                if kind != diff_unchanged:
+                    continue
+                try:
+                    stored = stored_name(new.file, new.codec, self.metarecord.compresses_files())
+                    stat = os.stat(os.path.join(newer.data_path(), stored))
+                    links, size = stat.st_nlink, stat.st_size
+                except FileNotFoundError:
+                    links, size = 0, 0
+                if new.source != newer.name and links == 0:  # Only stored in an earlier record
+                    continue
+                if links > 1:  # Hard linked, removing frees no space
+                    continue
+                files.append(new.file)
+                self.delete_size += size
+                new.source = old.source
+            if len(files) > 0:
+                self.to_delete.append((MetaRecordEntry(newer.timestamp, newer.name, newer.folder), files))
+        if self.metarecord.layout == layout_chunks:  # Chunks may be shared by any record, so all of them are needed
+            referenced = set()
+            for rec in loader.iter_records(self.metarecord.record_names()):
+                self.token.check()
+                for f in rec.files:
+                    if f.chunks is not None:
+                        referenced.update(f.chunks)
+            store = self.metarecord.chunk_store()
+            self.orphan_chunks = store.unreferenced(referenced)
+            for chunk_id in self.orphan_chunks:
+                try:
+                    self.delete_size += os.path.getsize(store.chunk_path(chunk_id))
+                except FileNotFoundError:
+                    pass
         data_queue.put(AsyncUpdate("Diff complete!"))
@@ -0,0 +1,226 @@
+"""
+Compact binary encoding of records. The file list is stored column by column: paths as one NUL separated blob, hashes
+as raw digests, sources as indexes into a table of distinct names and stat data as fixed width integer arrays. The
+whole payload may be compressed with zlib or lzma.
+
+Layout::
+
+    magic (4 bytes) | version (u8) | compression (u8) | payload
+
+where the payload is a sequence of sections, each prefixed with its length as a little endian u64. The first section
+is a JSON header holding the record fields and everything needed to decode the columns that follow.
+"""
+import json
+import lzma
+import struct
+import sys
+import zlib
+from array import array
+from typing import List, Tuple, Any, Optional, Iterator
+
+compact_record_ext = ".rec.bin"
+
+format_json = "json"
+format_compact = "compact"
+record_formats = (format_json, format_compact)
+
+compression_none = "none"
+compression_zlib = "zlib"
+compression_lzma = "lzma"
+compressions = (compression_none, compression_zlib, compression_lzma)
+
+_magic = b"BURC"
+_version = 3  # Version 2 added the segment columns, version 3 the codec column
+_section_len = struct.Struct("<Q")
+_missing = 0xFFFFFFFFFFFFFFFF  # Marks missing unsigned values in integer columns
+_missing32 = 0xFFFFFFFF
+_missing8 = 0xFF
+
+
+class CompactFormatError(Exception):
+    def __init__(self, *args):
+        super().__init__(*args)
+
+
+def _int_column(values: List[int], typecode: str) -> bytes:
+    column = array(typecode, values)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column.tobytes()
+
+
+def _read_int_column(data: bytes, typecode: str) -> List[int]:
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column.tolist()
+
+
+def _is_digest(value: str, digest_size: int) -> bool:
+    if len(value) != digest_size * 2:
+        return False
+    try:
+        bytes.fromhex(value)
+        return True
+    except ValueError:
+        return False
+
+
+def _digest_column(values: List[str]) -> Tuple[Optional[int], bytes]:
+    """
+    Pack hex digests as raw bytes. Falls back to a NUL separated string blob if any value is not a hex digest of the
+    same size as the first one.
+    """
+    digest_size = len(values[0]) // 2 if len(values) > 0 else 0
+    if digest_size > 0 and all(_is_digest(v, digest_size) for v in values):
+        return digest_size, b"".join(bytes.fromhex(v) for v in values)
+    return None, "\0".join(values).encode("utf-8")
+
+
+def _read_digest_column(data: bytes, digest_size: Optional[int], count: int) -> List[str]:
+    if count == 0:
+        return []
+    if digest_size is None:
+        return data.decode("utf-8").split("\0")
+    return [data[i:i + digest_size].hex() for i in range(0, len(data), digest_size)]
+
+
+def _sections(payload: bytes) -> Iterator[bytes]:
+    pos = 0
+    while pos < len(payload):
+        (length,) = _section_len.unpack_from(payload, pos)
+        pos += _section_len.size
+        yield payload[pos:pos + length]
+        pos += length
+
+
+def encode_record(header: dict, files: List[Any], compression: str = compression_zlib) -> bytes:
+    """
+    Encode a record in the compact format
+
+    :param header: the JSON compatible record fields other than the files
+    :param files: the `FileData` objects of the record
+    :param compression: how to compress the payload, one of `compressions`
+    :return: the encoded record
+    """
+    if compression not in compressions:
+        raise ValueError(f"Unsupported compression {compression}. Expected one of {compressions}")
+    sources = []
+    source_index = {}
+    source_column = []
+    for f in files:
+        if f.source not in source_index:
+            source_index[f.source] = len(sources)
+            sources.append(f.source)
+        source_column.append(source_index[f.source])
+    hash_size, hashes = _digest_column([f.hash for f in files])
+    chunked = [f for f in files if f.chunks is not None]
+    chunk_size, chunks = _digest_column([c for f in chunked for c in f.chunks])
+    segments = []
+    segment_index = {}
+    segment_column = []
+    for f in files:
+        if f.segment is None:
+            segment_column.append(_missing32)
+            continue
+        if f.segment[0] not in segment_index:
+            segment_index[f.segment[0]] = len(segments)
+            segments.append(f.segment[0])
+        segment_column.append(segment_index[f.segment[0]])
+    packed = [f for f in files if f.segment is not None]
+    codecs = sorted({f.codec for f in files if f.codec is not None})
+
+    header = dict(header)
+    header["count"] = len(files)
+    header["sources"] = sources
+    header["hash_size"] = hash_size
+    header["chunk_size"] = chunk_size
+    header["segments"] = segments
+    header["codecs"] = codecs
+    sections = [
+        json.dumps(header).encode("utf-8"),
+        "\0".join(f.file for f in files).encode("utf-8", "surrogateescape"),
+        hashes,
+        _int_column(source_column, "I"),
+        _int_column([f.size if f.size is not None else _missing for f in files], "Q"),
+        _int_column([f.mtime_ns if f.mtime_ns is not None else 0 for f in files], "q"),
+        _int_column([f.inode if f.inode is not None else _missing for f in files], "Q"),
+        _int_column([len(f.chunks) if f.chunks is not None else _missing for f in files], "Q"),
+        chunks,
+        _int_column(segment_column, "I"),
+        _int_column([f.segment[1] for f in packed], "Q"),
+        _int_column([f.segment[2] for f in packed], "Q"),
+        _int_column([codecs.index(f.codec) if f.codec is not None else _missing8 for f in files], "B")
+    ]
+    payload = b"".join(_section_len.pack(len(s)) + s for s in sections)
+    if compression == compression_zlib:
+        payload = zlib.compress(payload, 6)
+    elif compression == compression_lzma:
+        payload = lzma.compress(payload)
+    return _magic + bytes([_version, compressions.index(compression)]) + payload
+
+
+def decode_record(data: bytes) -> Tuple[dict, List[tuple]]:
+    """
+    Decode a record in the compact format
+
+    :param data: the encoded record
+    :return: the record fields and a list of argument tuples for `FileData`
+    """
+    if data[:4] != _magic:
+        raise CompactFormatError("Not a compact record")
+    version = data[4]
+    if version < 1 or version > _version:
+        raise CompactFormatError(f"Unsupported compact record version {version}")
+    compression = compressions[data[5]]
+    payload = data[6:]
+    if compression == compression_zlib:
+        payload = zlib.decompress(payload)
+    elif compression == compression_lzma:
+        payload = lzma.decompress(payload)
+    sections = list(_sections(payload))
+    header_data, paths, hashes, source_column, sizes, mtimes, inodes, chunk_counts, chunks = sections[:9]
+    header = json.loads(header_data.decode("utf-8"))
+    count = header.pop("count")
+    sources = header.pop("sources")
+    paths = paths.decode("utf-8", "surrogateescape").split("\0") if count > 0 else []
+    hashes = _read_digest_column(hashes, header.pop("hash_size"), count)
+    source_column = _read_int_column(source_column, "I")
+    sizes = _read_int_column(sizes, "Q")
+    mtimes = _read_int_column(mtimes, "q")
+    inodes = _read_int_column(inodes, "Q")
+    chunk_counts = _read_int_column(chunk_counts, "Q")
+    chunk_ids = _read_digest_column(chunks, header.pop("chunk_size"), sum(c for c in chunk_counts if c != _missing))
+    segments = header.pop("segments", [])
+    if version >= 2:
+        segment_column = _read_int_column(sections[9], "I")
+        offsets = _read_int_column(sections[10], "Q")
+        lengths = _read_int_column(sections[11], "Q")
+    else:
+        segment_column = [_missing32] * count
+        offsets = []
+        lengths = []
+    codecs = header.pop("codecs", [])
+    codec_column = _read_int_column(sections[12], "B") if version >= 3 else [_missing8] * count
+
+    rows = []
+    chunk_pos = 0
+    segment_pos = 0
+    for i in range(count):
+        file_chunks = None
+        if chunk_counts[i] != _missing:
+            file_chunks = chunk_ids[chunk_pos:chunk_pos + chunk_counts[i]]
+            chunk_pos += chunk_counts[i]
+        file_segment = None
+        if segment_column[i] != _missing32:
+            file_segment = [segments[segment_column[i]], offsets[segment_pos], lengths[segment_pos]]
+            segment_pos += 1
+        file_codec = codecs[codec_column[i]] if codec_column[i] != _missing8 else None
+        if sizes[i] != _missing:
+            rows.append((paths[i], hashes[i], sources[source_column[i]], sizes[i], mtimes[i],
+                         inodes[i] if inodes[i] != _missing else None, file_chunks, file_segment, file_codec))
+        else:
+            rows.append((paths[i], hashes[i], sources[source_column[i]], None, None, None, file_chunks, file_segment,
+                         file_codec))
+    return header, rows
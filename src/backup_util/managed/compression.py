@@ -0,0 +1,210 @@
+import bz2
+import lzma
+import os
+import shutil
+import zlib
+from typing import Tuple, Optional, Iterator
+
+from backup_util.utils.copying import copy_file_and_hash
+from backup_util.utils.datautils import new_hasher, default_hash_algorithm, default_block_size, _read_blocks
+
+codec_none = "none"
+codec_zlib = "zlib"
+codec_lzma = "lzma"
+codec_bz2 = "bz2"
+file_codecs = (codec_none, codec_zlib, codec_lzma, codec_bz2)
+
+compressed_ext = ".compressed"  # Appended to the names of compressed files in data folders
+escaped_ext = ".stored"  # Appended to raw files whose names end in one of these extensions, so names never collide
+
+_file_magic = b"BUCF"  # Starts every compressed file, followed by the index of its codec in `file_codecs`
+
+min_compress_size = 4096  # Smaller files take at most a block on disk, so compressing them saves nothing
+probe_size = 64 * 1024
+default_probe_ratio = 0.9  # Files whose probe does not shrink below this fraction of its size are stored raw
+
+# Extensions of formats that are compressed already
+incompressible_exts = frozenset((
+    ".7z", ".aac", ".apk", ".avi", ".br", ".bz2", ".cab", ".docx", ".epub", ".flac", ".gif", ".gz", ".heic",
+    ".jar", ".jpeg", ".jpg", ".lz", ".lz4", ".lzma", ".m4a", ".m4v", ".mkv", ".mov", ".mp3", ".mp4", ".odp",
+    ".ods", ".odt", ".ogg", ".opus", ".png", ".pptx", ".rar", ".tbz2", ".tgz", ".txz", ".webm", ".webp", ".whl",
+    ".woff", ".woff2", ".xlsx", ".xz", ".zip", ".zst", compressed_ext
+))
+
+
+def _compressor(codec: str):
+    if codec == codec_zlib:
+        return zlib.compressobj(6)
+    if codec == codec_lzma:
+        return lzma.LZMACompressor()
+    if codec == codec_bz2:
+        return bz2.BZ2Compressor()
+    raise ValueError(f"Unsupported codec {codec}. Expected one of {file_codecs}")
+
+
+def _decompressor(codec: str):
+    if codec == codec_zlib:
+        return zlib.decompressobj()
+    if codec == codec_lzma:
+        return lzma.LZMADecompressor()
+    if codec == codec_bz2:
+        return bz2.BZ2Decompressor()
+    raise ValueError(f"Unsupported codec {codec}. Expected one of {file_codecs}")
+
+
+def stored_name(path: str, codec: Optional[str], escape: bool = True) -> str:
+    """
+    Get the name a file is stored under. Compressed files get `compressed_ext` appended. In folders that compress,
+    raw files already ending in `compressed_ext` or `escaped_ext` get `escaped_ext` appended, so no source file can
+    take the name of another one.
+
+    :param path: the path of a file relative to its data folder
+    :param codec: the codec the file was compressed with, or None if it is stored raw
+    :param escape: True if the data folder is written by backups that compress, False for raw names
+    :return: the path the file is stored at
+    """
+    if codec is not None:
+        return path + compressed_ext
+    if escape and path.endswith((compressed_ext, escaped_ext)):
+        return path + escaped_ext
+    return path
+
+
+def original_name(stored: str) -> Tuple[str, bool]:
+    """
+    Reverse `stored_name` for a data folder written by backups that compress
+
+    :param stored: the name a file is stored under
+    :return: the path of the file and True if its name marks it as compressed
+    """
+    if stored.endswith(escaped_ext):
+        return stored[:-len(escaped_ext)], False
+    if stored.endswith(compressed_ext):
+        return stored[:-len(compressed_ext)], True
+    return stored, False
+
+
+def read_codec(path: str) -> Optional[str]:
+    """
+    :param path: a stored file
+    :return: the codec named in the header of the file, or None if it is not a compressed file
+    """
+    with open(path, "rb") as f:
+        header = f.read(len(_file_magic) + 1)
+    if len(header) != len(_file_magic) + 1 or header[:len(_file_magic)] != _file_magic \
+            or not 0 < header[-1] < len(file_codecs):
+        return None
+    return file_codecs[header[-1]]
+
+
+def is_compressible(path: str, size: int, ratio: float = default_probe_ratio) -> bool:
+    """
+    Guess if compressing a file is worth it. Small files and files with the extension of a compressed format are
+    rejected without being opened. Otherwise the start of the file is compressed with fast zlib, which costs a
+    fraction of compressing the whole file.
+
+    :param path: the file
+    :param size: the size of the file
+    :param ratio: the file is compressible if its probe shrinks below this fraction of its size
+    :return: True if the file should be compressed
+    """
+    if size < min_compress_size or os.path.splitext(path)[1].lower() in incompressible_exts:
+        return False
+    with open(path, "rb") as f:
+        probe = f.read(probe_size)
+    return len(probe) > 0 and len(zlib.compress(probe, 1)) < len(probe) * ratio
+
+
+def compress_and_hash(src: str, dest: str, codec: str, algorithm: str = default_hash_algorithm,
+                      block_size: int = default_block_size) -> Tuple[str, str]:
+    """
+    Store a file in a data folder, compressed if it is compressible and copied otherwise, and hash its contents
+    while reading it once. Compressed files are written to `dest` with `compressed_ext` appended. Runs on the hash
+    workers of a backup, so files are compressed in parallel. Compressed files start with a header naming the codec.
+
+    :param src: the file to store
+    :param dest: the path to copy the file to
+    :param codec: the codec to compress with, one of `file_codecs`. `codec_none` always copies
+    :param algorithm: the hash algorithm to use
+    :param block_size: the size of the buffer the file is read into
+    :return: the hash of the contents and how they were stored: the codec if compressed, otherwise the copy method
+    """
+    if codec == codec_none or not is_compressible(src, os.stat(src).st_size):
+        return copy_file_and_hash(src, stored_name(dest, None, codec != codec_none), algorithm)
+    hasher = new_hasher(algorithm)
+    compressor = _compressor(codec)
+    path = stored_name(dest, codec)
+    with open(src, "rb", buffering=0) as fsrc, open(path, "wb") as fdest:
+        fdest.write(_file_magic + bytes([file_codecs.index(codec)]))
+        for block in _read_blocks(fsrc, block_size):
+            hasher.update(block)
+            fdest.write(compressor.compress(block))
+        fdest.write(compressor.flush())
+    shutil.copystat(src, path)
+    return hasher.hexdigest(), codec
+
+
+def _iter_decompressed(path: str, codec: Optional[str], block_size: int = default_block_size) -> Iterator[bytes]:
+    """
+    Decompress a file in blocks of at most `block_size` bytes, so a highly compressed file does not fill the memory
+    """
+    stored_codec = read_codec(path)
+    if stored_codec is None:
+        raise ValueError(f"{path} is not a compressed file")
+    if codec is not None and codec != stored_codec:
+        raise ValueError(f"{path} was compressed with {stored_codec}, not {codec}")
+    codec = stored_codec
+    decompressor = _decompressor(codec)
+    with open(path, "rb") as f:
+        f.seek(len(_file_magic) + 1)
+        data = b""
+        while not decompressor.eof:
+            if codec == codec_zlib:
+                if len(data) == 0:
+                    data = f.read(block_size)
+                    if len(data) == 0:
+                        break
+                block = decompressor.decompress(data, block_size)
+                data = decompressor.unconsumed_tail
+            else:
+                if decompressor.needs_input:
+                    data = f.read(block_size)
+                    if len(data) == 0:
+                        break
+                else:
+                    data = b""
+                block = decompressor.decompress(data, block_size)
+            yield block
+    if not decompressor.eof:
+        raise EOFError(f"{path} ends before the end of its {codec} stream")
+
+
+def decompress_file(src: str, dest: str, codec: Optional[str] = None) -> None:
+    """
+    Write the original contents of a compressed file
+
+    :param src: the compressed file
+    :param dest: the path to write the contents to
+    :param codec: the codec the file is expected to be compressed with, or None to take the one in its header
+    """
+    with open(dest, "wb") as f:
+        for data in _iter_decompressed(src, codec):
+            f.write(data)
+
+
+def hash_compressed(path: str, codec: Optional[str] = None, algorithm: str = default_hash_algorithm) \
+        -> Tuple[str, int]:
+    """
+    Hash the original contents of a compressed file
+
+    :param path: the compressed file
+    :param codec: the codec the file is expected to be compressed with, or None to take the one in its header
+    :param algorithm: the hash algorithm to use
+    :return: the hash and size of the original contents
+    """
+    hasher = new_hasher(algorithm)
+    size = 0
+    for data in _iter_decompressed(path, codec):
+        hasher.update(data)
+        size += len(data)
+    return hasher.hexdigest(), size
@@ -0,0 +1,45 @@
+import logging
+from queue import Queue
+
+from backup_util.managed import MetaRecord, Record
+from backup_util.managed.compact import compression_zlib
+from backup_util.utils.threading import AsyncUpdate, Threadable, threaded_func
+
+log = logging.getLogger(__name__)
+
+
+class RecordConverter(Threadable):
+    """
+    Rewrites every record of a metarecord in another format on a background thread
+    """
+
+    def __init__(self, mr: MetaRecord, record_format: str, compression: str = compression_zlib):
+        """
+        :param mr: the metarecord whose records are converted
+        :param record_format: the format to convert to, one of `record_formats`
+        :param compression: the compression of compact records, one of `compressions`
+        """
+        super().__init__()
+        self.metarecord = mr
+        self.record_format = record_format
+        self.compression = compression
+
+    @threaded_func()
+    def convert(self, data_queue: Queue) -> None:
+        """
+        Convert the records. A cancelled conversion leaves the records written so far in the new format.
+
+        :param data_queue: the queue for posting updates
+        """
+        count = len(self.metarecord.records)
+        done = 0
+
+        def on_record(rec: Record):
+            nonlocal done
+            done += 1
+            data_queue.put(AsyncUpdate(f"Converted {rec.name}", done, count))
+            self.token.check()
+
+        log.info(f"Converting {count} records of {self.metarecord.path} to {self.record_format}")
+        self.metarecord.convert_records(self.record_format, self.compression, on_record)
+        data_queue.put(AsyncUpdate("Complete!", count, count))
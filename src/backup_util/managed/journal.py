@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import json
+import os
+from time import monotonic
+from typing import Dict, Optional, Tuple, TextIO, Callable
+
+from backup_util.managed.records import FileData, Record, record_folder
+from backup_util.utils.datautils import CustomJSONEncoder
+
+journal_ext = ".journal"
+
+default_sync_every = 256  # Entries written between fsyncs
+default_sync_interval = 5.0  # Seconds between fsyncs while entries are pending
+
+
+class RunJournal:
+    """
+    Append-only log of a managed backup in progress, kept in the records folder until the record is saved. The first
+    line describes the record and every following line is a file that was completely copied and hashed, so a run that
+    was interrupted can be resumed without copying or hashing those files again. Lines are fsynced in batches; a line
+    cut off by a crash is ignored.
+    """
+
+    def __init__(self, path: str, file: TextIO, sync_every: int = default_sync_every,
+                 sync_interval: float = default_sync_interval, before_sync: Optional[Callable[[], None]] = None):
+        """
+        :param path: the path of the journal file
+        :param file: the journal file, opened for appending
+        :param sync_every: the number of entries written between fsyncs
+        :param sync_interval: the number of seconds between fsyncs while entries are pending
+        :param before_sync: called before each fsync to make the data the entries point to durable first, e.g. the
+        segments files were packed into
+        """
+        self.path = path
+        self.file = file
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.before_sync = before_sync
+        self._unsynced = 0
+        self._last_sync = monotonic()
+
+    @staticmethod
+    def journal_path(path: str, name: str) -> str:
+        return os.path.join(path, record_folder, f"{name}{journal_ext}")
+
+    @staticmethod
+    def find_unfinished(path: str) -> Optional[str]:
+        """
+        Find the journal of a run that did not finish
+
+        :param path: the managed folder
+        :return: the path of the journal, or None if every run finished
+        """
+        recpath = os.path.join(path, record_folder)
+        if not os.path.isdir(recpath):
+            return None
+        journals = sorted(n for n in os.listdir(recpath) if n.endswith(journal_ext))
+        return os.path.join(recpath, journals[-1]) if len(journals) > 0 else None
+
+    @classmethod
+    def create(cls, rec: Record, **kwargs) -> RunJournal:
+        """
+        Start the journal of a new run
+
+        :param rec: the record the run is building
+        :return: the journal
+        """
+        path = cls.journal_path(rec.path, rec.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        journal = cls(path, open(path, "w", encoding="utf-8"), **kwargs)
+        journal._write({
+            "name": rec.name,
+            "folder": rec.folder,
+            "timestamp": rec.timestamp.isoformat(),
+            "hash_algorithm": rec.hash_algorithm
+        })
+        journal.sync()
+        return journal
+
+    @classmethod
+    def resume(cls, path: str, **kwargs) -> RunJournal:
+        """
+        Continue writing the journal of an interrupted run
+
+        :param path: the path of the journal
+        :return: the journal
+        """
+        with open(path, "rb") as file:
+            file.seek(0, os.SEEK_END)
+            cut_off = file.tell() > 0 and file.seek(-1, os.SEEK_END) >= 0 and file.read(1) != b"\n"
+        journal = cls(path, open(path, "a", encoding="utf-8"), **kwargs)
+        if cut_off:  # Keep the partial line from swallowing the next entry
+            journal.file.write("\n")
+        return journal
+
+    @staticmethod
+    def read(path: str) -> Tuple[dict, Dict[str, FileData]]:
+        """
+        Read a journal
+
+        :param path: the path of the journal
+        :return: the record fields and the finished files keyed by their relative path
+        """
+        header = None
+        files = {}
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    data = json.loads(line)
+                except ValueError:  # Cut off by a crash
+                    continue
+                if header is None:
+                    header = data
+                else:
+                    fd = FileData.__objectify__(data)
+                    files[fd.file] = fd
+        if header is None:
+            raise ValueError(f"The journal {path} has no header")
+        return header, files
+
+    def _write(self, data) -> None:
+        self.file.write(json.dumps(data, cls=CustomJSONEncoder) + "\n")
+
+    def add_file(self, fd: FileData) -> None:
+        """
+        Log a file that was completely copied and hashed
+
+        :param fd: the file
+        """
+        self._write(fd)
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        if self.before_sync is not None:
+            self.before_sync()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._unsynced = 0
+        self._last_sync = monotonic()
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    def finish(self) -> None:
+        """
+        Close and remove the journal once the record is saved
+        """
+        self.close()
+        os.remove(self.path)
@@ -1,19 +1,58 @@
 import logging
 import os
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 from queue import Queue
-from typing import List, Optional, Union
+from typing import List, Optional, Union, Dict, Tuple, Set
 
-from backup_util.managed import Record, MetaRecord, records
-from backup_util.utils.datautils import find_match
-from backup_util.utils.threading import AsyncUpdate, Threadable, threaded_func
+from backup_util.managed import Record, MetaRecord, MetaRecordEntry, FileData, NoRecordError, records, chunkstore, \
+    segments
+from backup_util.managed.records import layout_chunks
+from backup_util.managed.compression import original_name, read_codec, hash_compressed
+from backup_util.utils.datautils import find_match, hash_file, tree_size
+from backup_util.utils.scanner import scan_tree
+from backup_util.utils.threading import AsyncUpdate, Threadable, threaded_func, OrderedPool, default_workers, \
+    ProgressReporter, counter_scanned, counter_skipped, counter_bytes
 
 log = logging.getLogger(__name__)
 
+default_folder_workers = 2
+
+
+def _same_stat(stat: os.stat_result, other_path: str) -> bool:
+    try:
+        other = os.stat(other_path)
+    except OSError:
+        return False
+    return stat.st_size == other.st_size and stat.st_mtime_ns == other.st_mtime_ns
+
+
+def _hash_stored(path: str, codec: Optional[str], algorithm: str) -> str:
+    return hash_compressed(path, codec, algorithm)[0] if codec is not None else hash_file(path, algorithm)
+
 
 class Rebuilder(Threadable):
-    def __init__(self, mr: MetaRecord = None):
+    def __init__(self, mr: MetaRecord = None, hash_workers: int = default_workers(), hash_processes: bool = False,
+                 reuse_hashes: bool = True, folder_workers: int = default_folder_workers, prescan: bool = False):
+        """
+        Records of chunked destinations cannot be rebuilt, as the chunks making up each file are only listed in its
+        record.
+
+        :param mr: the metarecord to rebuild records for
+        :param hash_workers: the number of files hashed at once, shared by all folders
+        :param hash_processes: hash in worker processes instead of threads
+        :param reuse_hashes: reuse the hash of the previous folder for files with the same size and modification time
+        :param folder_workers: the number of folders scanned at once
+        :param prescan: if True, the folders are counted before hashing so progress is reported in bytes
+        """
         super().__init__()
+        if mr.layout == layout_chunks:
+            raise ValueError(f"Records of {mr.path} cannot be rebuilt, its files are stored as chunks")
+        self.hash_workers = hash_workers
+        self.hash_processes = hash_processes
+        self.reuse_hashes = reuse_hashes
+        self.folder_workers = folder_workers
+        self.prescan = prescan
         self.path = mr.path
         self.directories: List[List[Union[Record, bool]]] = []
         self.metarecord = mr
@@ -22,35 +61,212 @@ class Rebuilder(Threadable):
     def records(self) -> List[Record]:
         return list(map(lambda x: x[0], self.directories))
 
+    def _recorded_folders(self, folders: Optional[Set[str]] = None) -> Dict[str, MetaRecordEntry]:
+        """
+        Map data folders to the records of the metarecord. Entries saved before folders were tracked are looked up in
+        their record file, which is only done while some of `folders` are still unmatched. A record that cannot be
+        read is logged and its folder is left unrecorded.
+
+        :param folders: the data folders to match, or None to match every entry
+        :return: the entries keyed by their data folder
+        """
+        recorded = {e.folder: e for e in self.metarecord.records if e.folder is not None}
+        for entry in self.metarecord.records:
+            if entry.folder is not None:
+                continue
+            if folders is not None and folders.issubset(recorded):
+                break
+            try:
+                recorded[self.metarecord.folder_of(entry.name)] = entry
+            except (NoRecordError, OSError, ValueError) as e:
+                log.warning(f"Could not read the record {entry.name}, its data folder is treated as unrecorded: {e}")
+        return recorded
+
+    def _stored_codec(self, abspath: str, relpath: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Find out how a file is stored. The codec is read from the header of the file, the name only tells compressed
+        files from raw files whose names were escaped.
+
+        :param abspath: the absolute path of a file in a data folder
+        :param relpath: the path of the file relative to its data folder
+        :return: the path the file was backed up from, or None if it cannot have been written by a backup, and the codec
+            it is compressed with, or None if it is raw
+        """
+        if not self.metarecord.compresses_files():
+            return relpath, None
+        path, compressed = original_name(relpath)
+        if not compressed:
+            return path, None
+        codec = read_codec(abspath)
+        if codec is None:
+            log.warning(f"{abspath} is named as a compressed file but has no compression header, skipping it")
+            return None, None
+        return path, codec
+
     def _discover_directories(self):
+        """
+        Find the data folders of the managed folder. Folders that already have a record are listed with that record and
+        excluded, so a rebuild that was interrupted continues where it stopped.
+        """
         if os.path.exists(self.path):
-            for dir in os.listdir(self.path):
-                if dir == records.record_folder or not os.path.isdir(os.path.join(self.path, dir)):
-                    continue
+            dirs = [d for d in os.listdir(self.path)
+                    if d not in (records.record_folder, chunkstore.chunk_folder, segments.segment_folder) and
+                    os.path.isdir(os.path.join(self.path, d))]
+            recorded = self._recorded_folders({d.rstrip("/\\") for d in dirs})
+            for dir in dirs:
                 basename = dir.rstrip("/\\")
+                if basename in recorded:
+                    entry = recorded[basename]
+                    self.directories.append([Record(self.path, entry.name, basename, entry.timestamp,
+                                                    hash_algorithm=self.metarecord.hash_algorithm), False])
+                    continue
                 ts = datetime.fromtimestamp(os.path.getctime(os.path.join(self.path, dir)))
                 date_safe = ts.strftime('%Y-%m-%d_%H-%M-%S')
-                self.directories.append([Record(self.path, f"Backup for {date_safe}", basename, ts), True])
+                self.directories.append([Record(self.path, f"Backup for {date_safe}", basename, ts,
+                                                hash_algorithm=self.metarecord.hash_algorithm), True])
 
     @threaded_func()
     def generate_records(self, data_queue: Queue):
-        dirs: List[Record] = list(map(lambda d: d[0], filter(lambda d: d[1], self.directories)))
-        for index, rec in enumerate(dirs):
-            destination = os.path.join(self.path, rec.folder)
-            data_queue.put(AsyncUpdate(f"Building {destination}", index, len(dirs)))
-            log.info(f"Building {destination}")
-            count = 0
-            for dirpath, dirnames, filenames in os.walk(destination):
-                for file in filenames:
-                    count += 1
-                    abspath = os.path.join(dirpath, file)
-                    relpath = os.path.relpath(abspath, destination)
-                    data_queue.put(AsyncUpdate(f"[{count}] {relpath}", minor=True))
-                    rec.add_file(abspath, relpath)
-            rec.save(self.metarecord)
-        self.metarecord.save()
+        """
+        Create records for the included directories that do not have one yet. Up to `folder_workers` directories are
+        scanned at once while their files are hashed on a shared pool. Records are committed to the metarecord from
+        oldest to newest as soon as their directory and every older one are done, so an interrupted rebuild keeps the
+        finished records.
+
+        Each directory is compared with the one before it, which may be a record that already existed. A file with the
+        same size and modification time as the same path in the previous directory reuses its hash instead of being
+        read, and a file with the same contents gets the source of the previous one, so identical files point at their
+        earliest copy as they would after a managed backup.
+
+        :param data_queue: the queue to post updates to
+        """
+        recorded = self._recorded_folders()
+        dirs: List[Record] = sorted((d[0] for d in self.directories if d[1] and d[0].folder not in recorded),
+                                    key=lambda r: r.timestamp)
+        building = {id(rec) for rec in dirs}
+        packed = self.metarecord.segment_store().entries_by_folder({rec.folder for rec in dirs})
+        chain = sorted(dirs + [e for e in recorded.values()], key=lambda r: r.timestamp)
+        previous: Dict[int, Union[Record, MetaRecordEntry]] = {id(chain[i]): chain[i - 1] for i in range(1, len(chain))}
+        built: Dict[str, Record] = {}
+
+        def previous_record(rec: Record) -> Optional[Record]:
+            prev = previous.get(id(rec))
+            if prev is None:
+                return None
+            if id(prev) in building:
+                return prev
+            if prev.name not in built:
+                built[prev.name] = Record.load_from(self.path, prev.name)
+            return built[prev.name]
+
+        progress = ProgressReporter(data_queue)
+        if self.prescan:
+            files = 0
+            size = 0
+            for index, rec in enumerate(dirs):
+                self.token.check()
+                data_queue.put(AsyncUpdate(f"Scanning {rec.folder}", index, len(dirs)))
+                folder_files, folder_size = tree_size(os.path.join(self.path, rec.folder))
+                files += folder_files
+                size += folder_size
+            progress.set_totals(files, size)
+        hash_executor = ProcessPoolExecutor(max(1, self.hash_workers)) if self.hash_processes else \
+            ThreadPoolExecutor(max(1, self.hash_workers))
+        with hash_executor, ThreadPoolExecutor(max(1, self.folder_workers)) as folder_executor:
+            scans = [folder_executor.submit(self._scan_folder, rec, previous.get(id(rec)), hash_executor, progress)
+                     for rec in dirs]
+            try:
+                for index, (rec, scan) in enumerate(zip(dirs, scans)):
+                    self.token.check()
+                    data_queue.put(AsyncUpdate(f"Building {os.path.join(self.path, rec.folder)}", index, len(dirs)))
+                    self._commit_record(rec, scan.result(), previous_record(rec), packed.get(rec.folder, []))
+                    progress.flush()
+                    data_queue.put(AsyncUpdate(f"Saved {rec.name}", index + 1, len(dirs)))
+            except Exception:  # Scans still running stop at their next check instead of hashing folders for nothing
+                self.token.cancel()
+                raise
+            finally:  # When cancelled, committed records are kept so a later run continues from there
+                for scan in scans:
+                    scan.cancel()
         data_queue.put(AsyncUpdate("Complete!", len(dirs), len(dirs)))
 
+    def _scan_folder(self, rec: Record, previous: Optional[Union[Record, MetaRecordEntry]], hash_executor: Executor,
+                     progress: ProgressReporter) \
+            -> List[Tuple[str, str, os.stat_result, Optional[str], Optional[str]]]:
+        """
+        Walk a data folder and hash its files. Files that look unchanged from the same path in the previous folder
+        are not hashed; their hash is taken from the previous record once it is committed.
+
+        :return: a list of (absolute path, path backed up from, stat, codec, hash or None if unchanged) in walk order
+        """
+        destination = os.path.join(self.path, rec.folder)
+        log.info(f"Building {destination}")
+        prev_folder = None
+        if self.reuse_hashes and previous is not None:
+            prev_folder = os.path.join(self.path, previous.folder if isinstance(previous, Record)
+                                       else self.metarecord.folder_of(previous.name))
+        scanned = []
+        with OrderedPool(self.hash_workers, executor=hash_executor) as pool:
+            for entry in scan_tree(destination):
+                if entry.is_dir:
+                    continue
+                self.token.check()
+                abspath, stat = entry.path, entry.stat
+                progress.count(counter_scanned, message=entry.relpath)
+                progress.advance(size=stat.st_size)
+                relpath, codec = self._stored_codec(abspath, entry.relpath)
+                if relpath is None:
+                    continue
+                if prev_folder is not None and _same_stat(stat, os.path.join(prev_folder, entry.relpath)):
+                    pool.skip((abspath, relpath, stat, codec), None)
+                    progress.count(counter_skipped)
+                else:
+                    pool.submit((abspath, relpath, stat, codec), _hash_stored, abspath, codec, rec.hash_algorithm)
+                    progress.count(counter_bytes, stat.st_size)
+                for context, future in pool.collect():
+                    scanned.append((*context, future.result()))
+            for context, future in pool.collect(wait=True):
+                scanned.append((*context, future.result()))
+        return scanned
+
+    def _commit_record(self, rec: Record,
+                       scanned: List[Tuple[str, str, os.stat_result, Optional[str], Optional[str]]],
+                       previous: Optional[Record], packed: List[Tuple[str, dict]]) -> None:
+        """
+        Add scanned files and the files packed into segments for the folder to a record and save it with the
+        metarecord. The previous record must already be complete. Compressed files are recorded without stat data,
+        as the stat of the stored file does not describe the original, so the next backup hashes them once.
+        """
+        comparable = previous is not None and previous.hash_algorithm == rec.hash_algorithm
+        on_disk = set()
+        for abspath, relpath, stat, codec, file_hash in scanned:
+            on_disk.add(relpath)
+            prev = previous.get_file(relpath) if comparable else None
+            if file_hash is None:  # Unchanged from the previous folder
+                file_hash = prev.hash if prev is not None else _hash_stored(abspath, codec, rec.hash_algorithm)
+            same = prev is not None and prev.hash == file_hash
+            fd = rec.add_file(abspath, relpath, prev.source if same else None, file_hash, stat)
+            fd.codec = codec
+            if codec is not None:
+                fd.size = fd.mtime_ns = fd.inode = None
+            if same:
+                fd.segment = prev.segment
+                fd.codec = prev.codec
+        for segment_id, entry in packed:
+            if entry["file"] in on_disk:
+                continue
+            on_disk.add(entry["file"])  # An entry copied by an interrupted compaction may be listed twice
+            fd = FileData(entry["file"], entry["hash"], rec.name, entry.get("size"), entry.get("mtime_ns"),
+                          segment=[segment_id, entry["offset"], entry["length"]])
+            prev = previous.get_file(fd.file) if comparable else None
+            if prev is not None and prev.hash == fd.hash and prev.segment is not None:
+                fd.source = prev.source
+                fd.segment = prev.segment  # The copy in this folder's segment is reclaimed by the next clean
+            rec.files.append(fd)
+        rec.reindex()
+        rec.save(self.metarecord)
+        self.metarecord.save()
+
     def configure_directory(self, folder: str, name: Optional[str] = None, timestamp: Optional[datetime] = None,
                             included: Optional[bool] = None):
         i: int
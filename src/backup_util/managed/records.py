@@ -3,35 +3,103 @@ from __future__ import annotations
 import datetime
 import json
 import os
+import shutil
 from functools import reduce
-from typing import List, Tuple, Optional
-
-from backup_util.utils.datautils import hash_file, find_match, CustomJSONEncoder
+from typing import List, Tuple, Optional, Dict, Iterator, Iterable, Callable
+
+from backup_util.managed.catalog import Catalog, catalog_name
+from backup_util.managed.chunkstore import ChunkStore
+from backup_util.managed.segments import SegmentStore
+from backup_util.managed.compression import codec_none, file_codecs, stored_name, decompress_file
+from backup_util.managed.compact import compact_record_ext, encode_record, decode_record, format_json, \
+    format_compact, record_formats, compression_zlib, compressions
+from backup_util.utils.datautils import hash_file, CustomJSONEncoder, default_hash_algorithm, legacy_hash_algorithm, \
+    new_hasher
+from backup_util.utils.threading import OrderedPool, default_workers
 
 record_ext = ".rec.json"
 record_folder = "records"
 metarecord_name = f"metarecord{record_ext}"
 
+layout_files = "files"  # Changed files are copied whole into the data folder of each record
+layout_chunks = "chunks"  # Changed files are split into deduplicated chunks in the chunk store
+layouts = (layout_files, layout_chunks)
+
+diff_added = "added"
+diff_changed = "changed"
+diff_removed = "removed"
+diff_unchanged = "unchanged"
+
 
 class FileData:
-    def __init__(self, file: str, file_hash: str, source: str):
+    def __init__(self, file: str, file_hash: str, source: str, size: Optional[int] = None,
+                 mtime_ns: Optional[int] = None, inode: Optional[int] = None, chunks: Optional[List[str]] = None,
+                 segment: Optional[List] = None, codec: Optional[str] = None):
         self.file = file
         self.hash = file_hash
         self.source = source
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+        self.chunks = chunks
+        self.segment = segment  # [segment id, offset, length] if the contents are packed in a segment
+        self.codec = codec  # The codec the stored file was compressed with, None if it is stored raw
 
     @classmethod
     def __objectify__(cls, data: dict):
         return cls(
             data["file"],
             data["hash"],
-            data["source"])
+            data["source"],
+            data.get("size"),
+            data.get("mtime_ns"),
+            data.get("inode"),
+            data.get("chunks"),
+            data.get("segment"),
+            data.get("codec"))
 
     def __jsonify__(self):
-        return {
+        data = {
             "file": self.file,
             "hash": self.hash,
             "source": self.source
         }
+        if self.size is not None:
+            data["size"] = self.size
+            data["mtime_ns"] = self.mtime_ns
+            data["inode"] = self.inode
+        if self.chunks is not None:
+            data["chunks"] = self.chunks
+        if self.segment is not None:
+            data["segment"] = self.segment
+        if self.codec is not None:
+            data["codec"] = self.codec
+        return data
+
+    def set_stat(self, stat: os.stat_result) -> None:
+        """
+        Store the size, modification time and inode of the file this object describes
+
+        :param stat: the stat result of the source file
+        """
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.inode = stat.st_ino
+
+    def stat_matches(self, stat: os.stat_result, inode: bool = True) -> bool:
+        """
+        Check if a stat result describes the same, unmodified file as this object. Files recorded without stat data
+        never match.
+
+        :param stat: the stat result of the file to compare against
+        :param inode: compare inodes too. Turn off to match copies of the file that kept its modification time
+        :return: True if size, modification time and inode are all the same
+        """
+        return \
+            self.size is not None and \
+            self.size == stat.st_size and \
+            self.mtime_ns == stat.st_mtime_ns and \
+            (not inode or self.inode == stat.st_ino)
 
     def __eq__(self, other: FileData) -> bool:
         return self.file == other.file and self.hash == other.hash and self.source == other.source
@@ -41,29 +109,43 @@ class FileData:
 
 
 class MetaRecordEntry:
-    def __init__(self, timestamp: datetime.datetime, name: str):
+    def __init__(self, timestamp: datetime.datetime, name: str, folder: Optional[str] = None):
         self.timestamp: datetime.datetime = timestamp
         self.name: str = name
+        self.folder: Optional[str] = folder
 
     @classmethod
     def __objectify__(cls, data: dict):
         return cls(
             datetime.datetime.fromisoformat(data["timestamp"]),
-            data["name"]
+            data["name"],
+            data.get("folder")
         )
 
     def __jsonify__(self):
-        return {
+        data = {
             "name": self.name,
             "timestamp": self.timestamp
         }
+        if self.folder is not None:
+            data["folder"] = self.folder
+        return data
 
 
 class MetaRecord:
     def __init__(self, data: dict, path: str):
         self.latest: MetaRecordEntry = MetaRecordEntry.__objectify__(data["latest"]) if "latest" in data else None
         self.records: List[MetaRecordEntry] = [MetaRecordEntry.__objectify__(r) for r in data["records"]]
+        self.hash_algorithm: str = data["hash_algorithm"] if "hash_algorithm" in data else legacy_hash_algorithm
+        self.layout: str = data["layout"] if "layout" in data else layout_files
+        self.record_format: str = data["record_format"] if "record_format" in data else format_json
+        self.record_compression: str = \
+            data["record_compression"] if "record_compression" in data else compression_zlib
+        self.catalog: bool = data["catalog"] if "catalog" in data else False
+        self.pack_threshold: int = data["pack_threshold"] if "pack_threshold" in data else 0
+        self.file_compression: str = data["file_compression"] if "file_compression" in data else codec_none
         self.path = path
+        self._folders: Dict[str, str] = {}
 
     @classmethod
     def load_from(cls, path: str) -> Optional[MetaRecord]:
@@ -83,8 +165,73 @@ class MetaRecord:
         return os.path.exists(abspath) and os.path.isfile(abspath)
 
     @classmethod
-    def create_new(cls, path: str):
-        return cls({"records": []}, path)
+    def create_new(cls, path: str, hash_algorithm: str = default_hash_algorithm, layout: str = layout_files,
+                   pack_threshold: int = 0, file_compression: str = codec_none):
+        """
+        Create a metarecord for a folder that is not managed yet
+
+        :param path: the managed folder
+        :param hash_algorithm: the algorithm used to hash files in records of this folder
+        :param layout: how backups store changed files, one of `layouts`
+        :param pack_threshold: files smaller than this many bytes are packed into segments instead of being copied
+        into the data folder. 0 turns packing off. Only used by the files layout
+        :param file_compression: the codec compressible files are stored with, one of `file_codecs`. Only used by the
+        files layout
+        :return: the new metarecord
+        """
+        new_hasher(hash_algorithm)  # Fail early on unsupported algorithms
+        if layout not in layouts:
+            raise ValueError(f"Unsupported layout {layout}. Expected one of {layouts}")
+        if file_compression not in file_codecs:
+            raise ValueError(f"Unsupported codec {file_compression}. Expected one of {file_codecs}")
+        return cls({"records": [], "hash_algorithm": hash_algorithm, "layout": layout,
+                    "pack_threshold": pack_threshold, "file_compression": file_compression}, path)
+
+    def record_names(self) -> List[str]:
+        """
+        Get the names of the records of this metarecord
+
+        :return: the record names ordered from oldest to newest
+        """
+        return [e.name for e in sorted(self.records, key=lambda e: e.timestamp)]
+
+    def loader(self, workers: int = default_workers(), processes: bool = False) -> RecordLoader:
+        """
+        Get a loader for the records of this managed folder
+
+        :param workers: the number of records parsed at once
+        :param processes: parse in worker processes instead of threads
+        :return: the loader
+        """
+        return RecordLoader(self.path, workers, processes)
+
+    def chunk_store(self) -> ChunkStore:
+        """
+        Get the chunk store of this managed folder
+
+        :return: the chunk store
+        """
+        return ChunkStore(self.path, self.hash_algorithm)
+
+    def segment_store(self) -> SegmentStore:
+        """
+        Get the store of the segments small files are packed into
+
+        :return: the segment store
+        """
+        return SegmentStore(self.path)
+
+    def packs_files(self) -> bool:
+        """
+        :return: True if backups to this folder pack small files into segments
+        """
+        return self.layout == layout_files and self.pack_threshold > 0
+
+    def compresses_files(self) -> bool:
+        """
+        :return: True if backups to this folder compress the files they copy
+        """
+        return self.layout == layout_files and self.file_compression != codec_none
 
     def load_latest_record(self) -> Record:
         """
@@ -104,34 +251,205 @@ class MetaRecord:
                 os.mkdir(recpath)
             with open(os.path.join(recpath, metarecord_name), "w+") as file:
                 json.dump(self, file, cls=CustomJSONEncoder)
+            if self.catalog:
+                self.open_catalog().sync_records((r.name, r.folder, r.timestamp.isoformat()) for r in self.records)
         else:
             raise FileNotFoundError(f"The path {self.path} does not exist")
 
+    def open_catalog(self) -> Catalog:
+        """
+        Get the SQLite catalog of this managed folder. The catalog is only kept up to date if `catalog` is set.
+
+        :return: the catalog
+        """
+        return Catalog(os.path.join(self.path, record_folder, catalog_name))
+
+    def enable_catalog(self) -> None:
+        """
+        Turn on the SQLite catalog for this managed folder and fill it from every existing record
+        """
+        self.catalog = True
+        self.save()
+        self._fill_catalog(self.open_catalog())
+
+    def _fill_catalog(self, catalog: Catalog) -> None:
+        for rec in self.loader().iter_records(self.record_names()):
+            catalog.put_record(rec.name, rec.folder, rec.timestamp.isoformat(), rec.files)
+
+    def _filled_catalog(self) -> Catalog:
+        """
+        Get the catalog, filling it first if it was emptied because an older version created it
+        """
+        catalog = self.open_catalog()
+        if len(self.records) > 0 and catalog.is_empty():
+            self._fill_catalog(catalog)
+        return catalog
+
+    def file_history(self, path: str) -> List[Tuple[str, FileData]]:
+        """
+        Find every version of a file across all records. Uses the catalog if enabled, otherwise every record is loaded.
+
+        :param path: the path of the file relative to the data folders
+        :return: a list of (record name, `FileData`) ordered from oldest to newest record
+        """
+        if self.catalog:
+            return [(row[0], FileData(*row[1:])) for row in self._filled_catalog().file_versions(path)]
+        history = []
+        for rec in self.loader().iter_records(self.record_names()):
+            f = rec.get_file(path)
+            if f is not None:
+                history.append((rec.name, f))
+        return history
+
+    def records_containing(self, path: str) -> List[str]:
+        """
+        Find the records that contain a file
+
+        :param path: the path of the file relative to the data folders
+        :return: the names of the records, ordered from oldest to newest
+        """
+        return [name for name, f in self.file_history(path)]
+
+    def find_hash(self, file_hash: str) -> List[Tuple[str, FileData]]:
+        """
+        Find every file with the given contents across all records
+
+        :param file_hash: the hash of the contents
+        :return: a list of (record name, `FileData`) ordered from oldest to newest record
+        """
+        if self.catalog:
+            return [(row[0], FileData(*row[1:])) for row in self._filled_catalog().find_hash(file_hash)]
+        found = []
+        for rec in self.loader().iter_records(self.record_names()):
+            found.extend((rec.name, f) for f in rec.files if f.hash == file_hash)
+        return found
+
+    def folder_of(self, name: str) -> str:
+        """
+        Get the data folder of a record in this metarecord. Entries saved before folders were tracked are looked up
+        in their record file once.
+
+        :param name: the name of the record
+        :return: the data folder of the record, relative to the managed folder
+        """
+        if name not in self._folders:
+            entry = next((e for e in self.records if e.name == name), None)
+            if entry is None:
+                raise NoRecordError(f"No record named {name} exists in this MetaRecord")
+            if entry.folder is None:
+                entry.folder = Record.load_from(self.path, name).folder
+            self._folders[name] = entry.folder
+        return self._folders[name]
+
+    def resolve_file(self, file: FileData) -> str:
+        """
+        Get the absolute path where the contents of a file are stored
+
+        :param file: a file from one of the records of this metarecord
+        :return: the path to the stored file
+        """
+        stored = stored_name(file.file, file.codec, self.compresses_files())
+        return os.path.join(self.path, self.folder_of(file.source), stored)
+
+    def restore_file(self, file: FileData, dest: str) -> None:
+        """
+        Restore the contents of a file from any record of this metarecord
+
+        :param file: the file to restore
+        :param dest: the path to write the file to
+        """
+        if file.chunks is not None:
+            self.chunk_store().restore_file(file.chunks, dest)
+        elif file.segment is not None:
+            self.segment_store().restore_file(file.segment, dest)
+        elif file.codec is not None:
+            decompress_file(self.resolve_file(file), dest, file.codec)
+        else:
+            shutil.copyfile(self.resolve_file(file), dest)
+
+    def convert_records(self, record_format: str, compression: str = compression_zlib,
+                        on_record: Optional[Callable[[Record], None]] = None) -> None:
+        """
+        Rewrite every record of this metarecord in another format. Later saves use the new format too. Records are
+        loaded by their file, so stopping halfway leaves a mix of formats that still loads.
+
+        :param record_format: the format to convert to, one of `record_formats`
+        :param compression: the compression of compact records, one of `compressions`
+        :param on_record: called after each record is rewritten, e.g. to report progress or to stop by raising
+        """
+        if record_format not in record_formats:
+            raise ValueError(f"Unsupported record format {record_format}. Expected one of {record_formats}")
+        if compression not in compressions:
+            raise ValueError(f"Unsupported compression {compression}. Expected one of {compressions}")
+        previous = self.record_format, self.record_compression
+        self.record_format = record_format
+        self.record_compression = compression
+        try:
+            for rec in self.loader().iter_records(self.record_names()):
+                rec.write(self)
+                if on_record is not None:
+                    on_record(rec)
+        except BaseException:  # Records saved after a stopped conversion keep the old format
+            self.record_format, self.record_compression = previous
+            raise
+        self.save()
+
     def add_record(self, record: Record):
-        mre = MetaRecordEntry(record.timestamp, record.name)
+        """
+        Register a record in this metarecord. A record that is already registered has its entry replaced.
+
+        :param record: the record to add
+        """
+        mre = MetaRecordEntry(record.timestamp, record.name, record.folder)
+        self.records = [e for e in self.records if e.name != record.name]
         self.records.append(mre)
-        if self.latest is None or mre.timestamp >= self.latest.timestamp:
-            self.latest = mre
+        self._folders.pop(record.name, None)
+        if self.latest is None or self.latest.name == record.name or mre.timestamp >= self.latest.timestamp:
+            self.latest = max(self.records, key=lambda e: e.timestamp)
 
     def __jsonify__(self):
         data = {}
         if self.latest is not None:
             data["latest"] = self.latest
         data["records"] = self.records
+        data["hash_algorithm"] = self.hash_algorithm
+        data["layout"] = self.layout
+        data["record_format"] = self.record_format
+        data["record_compression"] = self.record_compression
+        data["catalog"] = self.catalog
+        data["pack_threshold"] = self.pack_threshold
+        data["file_compression"] = self.file_compression
         return data
 
 
 class Record:
     def __init__(self, path: str, name: str, folder: str, timestamp: Optional[datetime.datetime] = None,
-                 files: Optional[List[FileData]] = None):
+                 files: Optional[List[FileData]] = None, hash_algorithm: str = default_hash_algorithm,
+                 partial: bool = False):
         self.name = name
         self.folder = folder
         self.timestamp = timestamp if timestamp is not None else datetime.datetime.now()
         self.files = files if files is not None else []
+        self.hash_algorithm = hash_algorithm
+        self.partial = partial  # True if the backup was cancelled before every source was copied
         self.path = path
+        self._index: Optional[Dict[str, FileData]] = None
 
     @staticmethod
     def load_from(path: str, name: str) -> Record:
+        compact_path = os.path.join(path, record_folder, f"{name}{compact_record_ext}")
+        if os.path.isfile(compact_path):
+            with open(compact_path, "rb") as file:
+                header, rows = decode_record(file.read())
+                return Record(
+                    path,
+                    header["name"],
+                    header["folder"],
+                    datetime.datetime.fromisoformat(header["timestamp"]),
+                    [FileData(*row) for row in rows],
+                    header["hash_algorithm"],
+                    header.get("partial", False))
+
         file_path = os.path.join(path, record_folder, f"{name}{record_ext}")
         if not os.path.exists(file_path) or not os.path.isfile(file_path):
             raise FileNotFoundError(f"The file {file_path} does not exist or is a directory")
@@ -147,7 +465,9 @@ class Record:
             data["name"],
             data["folder"],
             datetime.datetime.fromisoformat(data["timestamp"]),
-            [FileData.__objectify__(f) for f in data["files"]] if "files" in data else None
+            [FileData.__objectify__(f) for f in data["files"]] if "files" in data else None,
+            data["hash_algorithm"] if "hash_algorithm" in data else legacy_hash_algorithm,
+            data["partial"] if "partial" in data else False
         )
 
     def save(self, metarecord: MetaRecord = None) -> None:
@@ -156,16 +476,45 @@ class Record:
         """
         mr = MetaRecord.load_from(self.path) if metarecord is None else metarecord
         mr.add_record(self)
+        self.write(mr)
+
+    def write(self, metarecord: MetaRecord) -> None:
+        """
+        Write this record to its record file in the format used by the metarecord, replacing a file in any other format
+
+        :param metarecord: the metarecord this record belongs to
+        """
         if os.path.exists(self.path) and os.path.isdir(self.path):
             recpath = os.path.join(self.path, record_folder)
             if not os.path.exists(recpath):
                 os.mkdir(recpath)
-            with open(os.path.join(recpath, f"{self.name}{record_ext}"), "w+") as file:
-                json.dump(self, file, cls=CustomJSONEncoder)
+            json_path = os.path.join(recpath, f"{self.name}{record_ext}")
+            compact_path = os.path.join(recpath, f"{self.name}{compact_record_ext}")
+            if metarecord.record_format == format_compact:
+                header = {
+                    "name": self.name,
+                    "folder": self.folder,
+                    "timestamp": self.timestamp.isoformat(),
+                    "hash_algorithm": self.hash_algorithm
+                }
+                if self.partial:
+                    header["partial"] = True
+                with open(compact_path, "wb") as file:
+                    file.write(encode_record(header, self.files, metarecord.record_compression))
+                stale_path = json_path
+            else:
+                with open(json_path, "w+") as file:
+                    json.dump(self, file, cls=CustomJSONEncoder)
+                stale_path = compact_path
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+            if metarecord.catalog:
+                metarecord.open_catalog().put_record(self.name, self.folder, self.timestamp.isoformat(), self.files)
         else:
             raise NotADirectoryError(f"The path {self.path} does not exist or is not a directory")
 
-    def add_file(self, abs_path: str, relative_path: str, source: str = None) -> FileData:
+    def add_file(self, abs_path: str, relative_path: str, source: str = None, file_hash: Optional[str] = None,
+                 stat: Optional[os.stat_result] = None) -> FileData:
         """
         Add a file to this record.
 
@@ -173,12 +522,45 @@ class Record:
         :param relative_path: the path to the file relative to the data folder it is contained in
         (e.g. Documents/file.txt not X:/backups/data/Documents/file.txt)
         :param source: the name of the backup where this file is located
+        :param file_hash: the hash of the file if already known. The file is hashed if this is not provided
+        :param stat: the stat result of the file if already known
         :return: a `FileData` object for the new file
         """
-        file = FileData(relative_path, hash_file(abs_path), source if source is not None else self.name)
+        file = FileData(relative_path,
+                        file_hash if file_hash is not None else hash_file(abs_path, self.hash_algorithm),
+                        source if source is not None else self.name)
+        file.set_stat(stat if stat is not None else os.stat(abs_path))
         self.files.append(file)
+        if self._index is not None:
+            self._index[file.file] = file
         return file
 
+    def file_index(self) -> Dict[str, FileData]:
+        """
+        Get the files of this record keyed by their relative path. The index is built once and kept up to date by
+        `add_file`. Call `reindex` if `files` is modified directly.
+
+        :return: a dict of relative path to `FileData`
+        """
+        if self._index is None:
+            self._index = {f.file: f for f in self.files}
+        return self._index
+
+    def reindex(self) -> None:
+        """
+        Discard the file index so it is rebuilt from `files` on next use
+        """
+        self._index = None
+
+    def get_file(self, relative_path: str) -> Optional[FileData]:
+        """
+        Find a file in this record by its relative path
+
+        :param relative_path: the path of the file relative to the data folder
+        :return: the `FileData` for the path or None if this record does not contain it
+        """
+        return self.file_index().get(relative_path)
+
     def data_path(self) -> str:
         """
         Get the absolute path of the data folder for this record
@@ -188,41 +570,67 @@ class Record:
         return os.path.join(self.path, self.folder)
 
     def __jsonify__(self) -> dict:
-        return {
+        data = {
             "name": self.name,
             "folder": self.folder,
             "timestamp": self.timestamp,
+            "hash_algorithm": self.hash_algorithm,
             "files": self.files
         }
+        if self.partial:
+            data["partial"] = True
+        return data
 
     def file_diff(self, rec: Record) -> Tuple[
         List[FileData], List[Tuple[FileData, FileData]], List[FileData], List[Tuple[FileData, FileData]]]:
         """
         Returns the added, changed, removed, and unchanged files as a tuple (in that order)
-        between this record and the previous. A change is considered with self being older
+        between this record and the previous. A change is considered with self being older. If the records were hashed
+        with different algorithms, files present in both are always considered changed.
 
         :param rec: the record to diff against
         :return: the added, changed, removed, and unchanged FileData objects
         """
-        removed = []
+        added = []
         changed = []
+        removed = []
         unchanged = []
-        sfiles = self.files.copy()
-        recfiles = rec.files.copy()
-        for i, f in enumerate(sfiles):
-            p, v = find_match(recfiles, lambda x: x.file == f.file)
-            if p is None:
-                removed.append(f)
+        for kind, old, new in self.iter_diff(rec):
+            if kind == diff_added:
+                added.append(new)
+            elif kind == diff_changed:
+                changed.append((old, new))
+            elif kind == diff_removed:
+                removed.append(old)
             else:
-                if v.hash != f.hash:
-                    changed.append((f, v))
-                else:
-                    unchanged.append((f, v))
-                recfiles.remove(v)
-        added = recfiles
-
+                unchanged.append((old, new))
         return added, changed, removed, unchanged
 
+    def iter_diff(self, rec: Record) -> Iterator[Tuple[str, Optional[FileData], Optional[FileData]]]:
+        """
+        Stream the differences between this record and a newer one without building lists. Files of this record are
+        yielded first in order as removed, changed or unchanged, followed by the files only in `rec` as added. Both
+        records are joined through their path indexes, so this runs in linear time.
+
+        :param rec: the record to diff against
+        :return: an iterator of (kind, old `FileData` or None, new `FileData` or None) where kind is one of
+        `diff_added`, `diff_changed`, `diff_removed` or `diff_unchanged`
+        """
+        recindex = rec.file_index()
+        comparable = self.hash_algorithm == rec.hash_algorithm
+        for f in self.files:
+            v = recindex.get(f.file)
+            if v is None:
+                yield diff_removed, f, None
+            elif not comparable or v.hash != f.hash:
+                yield diff_changed, f, v
+            else:
+                yield diff_unchanged, f, v
+        selfindex = self.file_index()
+        for v in rec.files:
+            if v.file not in selfindex:
+                yield diff_added, None, v
+
     def __eq__(self, other) -> bool:
         def file_reduce(acc, v):
             i, fd = v
@@ -234,6 +642,7 @@ class Record:
             self.folder == other.folder and \
             self.path == other.path and \
             self.timestamp == other.timestamp and \
+            self.hash_algorithm == other.hash_algorithm and \
             len(self.files) == len(other.files) and \
             reduce(file_reduce, enumerate(self.files), True)
 
@@ -241,3 +650,65 @@ class Record:
 class NoRecordError(Exception):
     def __init__(self, *args):
         super().__init__(*args)
+
+
+class RecordLoader:
+    """
+    Parses the records of a managed folder on a worker pool. Records are handed back in the order they were asked for
+    and only a bounded number are loaded ahead of the consumer, so operations over many large records do not need to
+    hold all of them in memory.
+    """
+
+    def __init__(self, path: str, workers: int = default_workers(), processes: bool = False):
+        """
+        :param path: the managed folder
+        :param workers: the number of records parsed at once
+        :param processes: parse in worker processes instead of threads. Parsing is CPU bound, so this is faster for
+        large records at the cost of sending the parsed records back to this process
+        """
+        self.path = path
+        self.workers = workers
+        self.processes = processes
+
+    def iter_records(self, names: Iterable[str], prefetch: Optional[int] = None) -> Iterator[Record]:
+        """
+        Load records in order
+
+        :param names: the names of the records to load
+        :param prefetch: the number of records loaded ahead of the consumer. Defaults to the number of workers
+        :return: an iterator of records in the order of `names`
+        """
+        prefetch = max(1, prefetch if prefetch is not None else self.workers)
+        with OrderedPool(min(self.workers, prefetch + 1), self.processes, max_pending=prefetch) as pool:
+            for name in names:
+                pool.submit(name, Record.load_from, self.path, name)
+                for _, future in pool.collect():
+                    yield future.result()
+            for _, future in pool.collect(wait=True):
+                yield future.result()
+
+    def iter_pairs(self, names: Iterable[str], prefetch: int = 1) -> Iterator[Tuple[Record, Record]]:
+        """
+        Load consecutive records as a sliding window of two. Only the current pair and `prefetch` records are kept in
+        memory. The newer record of a pair is the same object as the older record of the next pair, so changes made to
+        it carry over.
+
+        :param names: the names of the records to load, ordered from oldest to newest
+        :param prefetch: the number of records loaded ahead of the consumer
+        :return: an iterator of (older, newer) records
+        """
+        previous = None
+        for rec in self.iter_records(names, prefetch):
+            if previous is not None:
+                yield previous, rec
+            previous = rec
+
+    def load_all(self, names: Iterable[str]) -> List[Record]:
+        """
+        Load records with every worker busy
+
+        :param names: the names of the records to load
+        :return: the records in the order of `names`
+        """
+        names = list(names)
+        return list(self.iter_records(names, max(1, len(names))))
@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import json
+import os
+import uuid
+from typing import List, Tuple, Dict, Iterator, Optional, Set, Callable, BinaryIO, TextIO
+
+from backup_util.utils.datautils import new_hasher, default_hash_algorithm
+
+segment_folder = "segments"
+segment_ext = ".seg"
+segment_index_ext = ".idx"
+
+default_pack_threshold = 64 * 1024  # Files smaller than this are packed when packing is turned on
+max_segment_size = 64 * 1024 * 1024
+default_compact_ratio = 0.5  # Segments with less live data than this fraction of their size are rewritten
+
+
+def read_and_hash(path: str, algorithm: str = default_hash_algorithm) -> Tuple[str, bytes]:
+    """
+    Read a small file whole and hash it, so it can be appended to a segment by another thread
+
+    :param path: the file to read
+    :param algorithm: the hash algorithm to use
+    :return: the hash and contents of the file
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest(), data
+
+
+class SegmentStore:
+    """
+    Archives of small files in the `segments` folder of a managed destination. Files are appended to large segment
+    files, so a file costs a few bytes of an existing file rather than an inode of its own, and referenced from
+    `FileData.segment` as [segment id, offset, length]. Next to every segment, an index lists the folder, path, hash
+    and stat of each entry so records can be rebuilt from the segments alone.
+
+    Segments are never modified once written. Space taken by entries no records use any more is reclaimed by
+    `compact`, which copies the remaining entries of sparse segments into new ones.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: the managed folder
+        """
+        self.path = path
+        self.root = os.path.join(path, segment_folder)
+
+    def segment_path(self, segment_id: str) -> str:
+        return os.path.join(self.root, f"{segment_id}{segment_ext}")
+
+    def index_path(self, segment_id: str) -> str:
+        return os.path.join(self.root, f"{segment_id}{segment_index_ext}")
+
+    def writer(self, max_size: int = max_segment_size) -> SegmentWriter:
+        """
+        :param max_size: the size at which a new segment is started
+        :return: a writer appending to new segments of this store
+        """
+        return SegmentWriter(self, max_size)
+
+    def read(self, segment: List) -> bytes:
+        """
+        Read the contents of a packed file
+
+        :param segment: the [segment id, offset, length] of the file
+        :return: the contents
+        """
+        segment_id, offset, length = segment
+        with open(self.segment_path(segment_id), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise EOFError(f"Segment {segment_id} ends before {offset + length}")
+        return data
+
+    def restore_file(self, segment: List, dest: str) -> None:
+        """
+        Write a packed file out
+
+        :param segment: the [segment id, offset, length] of the file
+        :param dest: the path to write the file to
+        """
+        with open(dest, "wb") as f:
+            f.write(self.read(segment))
+
+    def all_segments(self) -> Iterator[str]:
+        """
+        List every segment in the store
+
+        :return: an iterator of segment ids
+        """
+        if not os.path.isdir(self.root):
+            return
+        for name in sorted(os.listdir(self.root)):
+            if name.endswith(segment_ext):
+                yield name[:-len(segment_ext)]
+
+    def index(self, segment_id: str) -> List[dict]:
+        """
+        Read the index of a segment. An entry cut off while it was written is skipped.
+
+        :param segment_id: the segment
+        :return: the entries, each with the folder, file, offset, length, hash, size and mtime_ns of a packed file
+        """
+        entries = []
+        try:
+            with open(self.index_path(segment_id), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def entries_by_folder(self, folders: Set[str]) -> Dict[str, List[Tuple[str, dict]]]:
+        """
+        Find the files packed for some data folders
+
+        :param folders: the data folders to look for
+        :return: the (segment id, index entry) of the files of each folder, in the order they were packed
+        """
+        found: Dict[str, List[Tuple[str, dict]]] = {}
+        for segment_id in self.all_segments():
+            for entry in self.index(segment_id):
+                if entry["folder"] in folders:
+                    found.setdefault(entry["folder"], []).append((segment_id, entry))
+        return found
+
+    def remove(self, segment_id: str) -> int:
+        """
+        Remove a segment and its index
+
+        :param segment_id: the segment
+        :return: the number of bytes freed
+        """
+        size = 0
+        for path in (self.segment_path(segment_id), self.index_path(segment_id)):
+            try:
+                size += os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def plan_compaction(self, live: Dict[str, Set[Tuple[int, int]]], ratio: float = default_compact_ratio) \
+            -> Tuple[List[str], List[str]]:
+        """
+        Decide which segments to reclaim
+
+        :param live: the (offset, length) of every entry records still use, by segment id
+        :param ratio: segments with less live data than this fraction of their size are rewritten
+        :return: the segments to remove as they have no live entries and the segments to rewrite
+        """
+        unused = []
+        sparse = []
+        for segment_id in self.all_segments():
+            entries = live.get(segment_id)
+            if entries is None or len(entries) == 0:
+                unused.append(segment_id)
+                continue
+            size = os.path.getsize(self.segment_path(segment_id))
+            if size > 0 and sum(length for offset, length in entries) < size * ratio:
+                sparse.append(segment_id)
+        return unused, sparse
+
+    def rewrite(self, segment_ids: List[str], live: Dict[str, Set[Tuple[int, int]]],
+                check: Optional[Callable[[], None]] = None) -> Dict[Tuple[str, int], List]:
+        """
+        Copy the live entries of segments into new segments. The old segments are left in place until the records
+        using them are rewritten.
+
+        :param segment_ids: the segments to rewrite
+        :param live: the (offset, length) of every entry records still use, by segment id
+        :param check: called before each segment, e.g. to stop when cancelled
+        :return: the new [segment id, offset, length] of each moved entry, keyed by its old segment id and offset
+        """
+        moved = {}
+        writer = self.writer()
+        try:
+            for segment_id in segment_ids:
+                if check is not None:
+                    check()
+                index = {e["offset"]: e for e in self.index(segment_id)}
+                with open(self.segment_path(segment_id), "rb") as f:
+                    for offset, length in sorted(live[segment_id]):
+                        f.seek(offset)
+                        entry = dict(index.get(offset, {}))
+                        moved[(segment_id, offset)] = writer.append(f.read(length), entry.pop("folder", None),
+                                                                    entry.pop("file", None), entry)
+        finally:
+            writer.close()
+        return moved
+
+
+class SegmentWriter:
+    """
+    Appends files to the segments of a store. Not thread safe: files are read on workers and appended by one thread.
+    """
+
+    def __init__(self, store: SegmentStore, max_size: int = max_segment_size):
+        self.store = store
+        self.max_size = max_size
+        self.segment_id: Optional[str] = None
+        self._data: Optional[BinaryIO] = None
+        self._index: Optional[TextIO] = None
+        self._size = 0
+
+    def _start_segment(self) -> None:
+        self.close()
+        os.makedirs(self.store.root, exist_ok=True)
+        self.segment_id = uuid.uuid4().hex
+        self._data = open(self.store.segment_path(self.segment_id), "xb")
+        self._index = open(self.store.index_path(self.segment_id), "x", encoding="utf-8")
+        self._size = 0
+
+    def append(self, data: bytes, folder: Optional[str], file: Optional[str], info: Optional[dict] = None) -> List:
+        """
+        Append a file to the current segment, starting a new one when it is full
+
+        :param data: the contents of the file
+        :param folder: the data folder of the record the file is packed for
+        :param file: the path of the file relative to the data folder
+        :param info: more fields for the index entry, e.g. the hash, size and mtime_ns of the file
+        :return: the [segment id, offset, length] of the file
+        """
+        if self._data is None or (self._size > 0 and self._size + len(data) > self.max_size):
+            self._start_segment()
+        offset = self._size
+        self._data.write(data)
+        self._size += len(data)
+        entry = {"folder": folder, "file": file, "offset": offset, "length": len(data)}
+        if info is not None:
+            entry.update(info)
+        self._index.write(json.dumps(entry) + "\n")
+        return [self.segment_id, offset, len(data)]
+
+    def sync(self) -> None:
+        """
+        Make sure everything appended so far is on disk
+        """
+        for f in (self._data, self._index):
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def close(self) -> None:
+        if self._data is not None:
+            self.sync()
+            self._data.close()
+            self._index.close()
+        self._data = None
+        self._index = None
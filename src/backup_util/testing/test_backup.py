@@ -129,3 +129,42 @@ def test_file_tree(filetree):
         .file("A2_F1") \
         .file("A2_F2") \
         .build()
+
+
+def test_save_json_options(filetree):
+    filetree.build()
+    path = filetree.relpath("config.json")
+    Backup.save_to_json(path, ["src"], ["ex*"], "dest", hash_workers=3, hash_processes=True, prescan=True,
+                        hash_algorithm="sha256")
+    src, exc, dest, dry, wrapped = Backup.load_from_json(path)
+    assert src == ["src"] and exc == ["ex*"] and dest == "dest"
+    options = Backup.load_options_from_json(path)
+    assert options["hash_workers"] == 3
+    assert options["hash_processes"]
+    assert options["prescan"]
+    assert options["hash_algorithm"] == "sha256"
+
+
+def test_backup_prescan(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("testfile1", value="a" * 1000) \
+        .file("testfile2", value="b" * 500) \
+        .file("skipped.tmp", value="c" * 300) \
+        .up() \
+        .dir("dest1") \
+        .build()
+    b = Backup(prescan=True)
+    b.add_source(filetree.relpath("testdir1"))
+    b.add_exception("*.tmp")
+    b.set_destination(filetree.relpath("dest1"))
+    data_queue = b.execute()
+    b.wait_for_completion()
+    updates = []
+    while not data_queue.empty():
+        updates.append(data_queue.get_nowait())
+    progress = [u for u in updates if u.is_minor() and u.has_bytes()]
+    assert len(progress) > 0
+    assert progress[-1].bytes_total == 1500
+    assert progress[-1].bytes_done == 1500
+    assert progress[-1].get_byte_completion() == 100
@@ -0,0 +1,99 @@
+import datetime
+import logging
+import sqlite3
+
+import pytest
+
+from backup_util.managed import MetaRecord, Record, FileData
+from backup_util.managed.catalog import catalog_name
+from backup_util.managed.records import record_folder, layout_chunks
+from backup_util.testing.FileTree import FileTree
+
+log = logging.getLogger(__name__)
+
+
+@pytest.fixture()
+def filetree(tmp_path):
+    return FileTree(str(tmp_path))
+
+
+def make_records(filetree, mr: MetaRecord):
+    start = datetime.datetime(2020, 6, 10)
+    recA = Record(filetree.path, "Rec A", "rec_a_data", start, [
+        FileData("Dir A/file1.txt", "aa01", "Rec A", 1, 10, 100),
+        FileData("Dir A/file2.txt", "aa02", "Rec A", 2, 20, 200)
+    ])
+    recB = Record(filetree.path, "Rec B", "rec_b_data", start + datetime.timedelta(days=1), [
+        FileData("Dir A/file1.txt", "bb01", "Rec B", 3, 30, 100),
+        FileData("Dir A/file2.txt", "aa02", "Rec A", 2, 20, 200),
+        FileData("Dir B/file3.txt", "aa01", "Rec B", 1, 40, 300)
+    ])
+    recB.save(mr)
+    recA.save(mr)
+    mr.save()
+    return recA, recB
+
+
+@pytest.mark.parametrize("catalog", [True, False])
+def test_file_history(filetree, catalog):
+    filetree.build()
+    mr = MetaRecord.create_new(filetree.path)
+    mr.catalog = catalog
+    make_records(filetree, mr)
+    assert filetree.exists(f"{record_folder}/{catalog_name}") == catalog
+    history = mr.file_history("Dir A/file1.txt")
+    assert [name for name, f in history] == ["Rec A", "Rec B"]
+    assert [f.hash for name, f in history] == ["aa01", "bb01"]
+    assert history[1][1].size == 3
+    assert mr.records_containing("Dir B/file3.txt") == ["Rec B"]
+    assert mr.records_containing("Dir C/missing.txt") == []
+    found = mr.find_hash("aa01")
+    assert [(name, f.file) for name, f in found] == [("Rec A", "Dir A/file1.txt"), ("Rec B", "Dir B/file3.txt")]
+
+
+def test_enable_catalog(filetree):
+    filetree.build()
+    mr = MetaRecord.create_new(filetree.path)
+    recA, recB = make_records(filetree, mr)
+    assert not filetree.exists(f"{record_folder}/{catalog_name}")
+    mr.enable_catalog()
+    assert MetaRecord.load_from(filetree.path).catalog
+    assert mr.records_containing("Dir A/file2.txt") == ["Rec A", "Rec B"]
+    recB.files.pop()  # Updates replace the files of a record
+    recB.save(mr)
+    mr.save()
+    assert mr.records_containing("Dir B/file3.txt") == []
+    mr.records = [r for r in mr.records if r.name != "Rec A"]  # Records removed from the metarecord are dropped
+    mr.save()
+    assert mr.records_containing("Dir A/file2.txt") == ["Rec B"]
+
+
+def test_catalog_keeps_stored_location(filetree):
+    filetree.build()
+    mr = MetaRecord.create_new(filetree.path, layout=layout_chunks)
+    mr.catalog = True
+    store = mr.chunk_store()
+    chunks = [store.put(b"first "), store.put(b"second")]
+    rec = Record(filetree.path, "Rec A", "rec_a_data", datetime.datetime(2020, 6, 10), [
+        FileData("Dir A/file1.txt", "aa01", "Rec A", 12, 10, 100, chunks=chunks),
+        FileData("Dir A/file2.txt", "aa02", "Rec A", 3, 20, 200, segment=["seg1", 0, 3], codec="zlib")
+    ])
+    rec.save(mr)
+    mr.save()
+    (name, f), = mr.file_history("Dir A/file1.txt")
+    assert (f.chunks, f.inode, f.segment, f.codec) == (chunks, 100, None, None)
+    mr.restore_file(f, filetree.relpath("restored"))
+    assert filetree.content("restored") == ["first second"]
+    (name, f), = mr.find_hash("aa02")
+    assert (f.chunks, f.inode, f.segment, f.codec) == (None, 200, ["seg1", 0, 3], "zlib")
+
+
+def test_catalog_refilled_after_upgrade(filetree):
+    filetree.build()
+    mr = MetaRecord.create_new(filetree.path)
+    mr.catalog = True
+    make_records(filetree, mr)
+    with sqlite3.connect(filetree.relpath(record_folder, catalog_name)) as connection:
+        connection.execute("PRAGMA user_version = 0")  # Written before files kept their stored location
+    assert mr.records_containing("Dir A/file1.txt") == ["Rec A", "Rec B"]
+    assert mr.file_history("Dir A/file1.txt")[0][1].inode == 100
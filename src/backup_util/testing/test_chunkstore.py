@@ -0,0 +1,120 @@
+import io
+import logging
+import os
+import random
+
+import pytest
+
+from backup_util.managed import MetaRecord, ChunkStore, Rebuilder
+from backup_util.managed.chunkstore import iter_chunks
+from backup_util.managed.cleaner import Cleaner
+from backup_util.managed.records import layout_chunks
+from backup_util.testing.FileTree import FileTree
+from backup_util.testing.testutils import run_backup
+
+log = logging.getLogger(__name__)
+
+chunk_sizes = {"min_size": 1024, "avg_size": 4096, "max_size": 16384}
+
+
+@pytest.fixture()
+def filetree(tmp_path):
+    return FileTree(str(tmp_path))
+
+
+def random_bytes(size: int, seed: int) -> bytes:
+    rnd = random.Random(seed)
+    return bytes(rnd.getrandbits(8) for _ in range(size))
+
+
+def test_chunks_are_content_defined():
+    data = random_bytes(200000, 1)
+    chunks = list(iter_chunks(io.BytesIO(data), **chunk_sizes))
+    assert b"".join(chunks) == data
+    assert all(chunk_sizes["min_size"] <= len(c) <= chunk_sizes["max_size"] for c in chunks[:-1])
+    shifted = list(iter_chunks(io.BytesIO(b"inserted" + data), **chunk_sizes))
+    # An insertion at the start only changes the chunks around it
+    assert len(set(chunks) & set(shifted)) >= len(chunks) - 2
+
+
+@pytest.mark.parametrize("kind", ["log", "zeros"])
+def test_chunks_survive_insertion_in_low_entropy_data(kind):
+    rnd = random.Random(4)
+    if kind == "log":
+        lines = [b"2026-10-%02d 12:%02d:%02d INFO worker %d processed request %d\n" % (
+            rnd.randint(1, 28), rnd.randint(0, 59), rnd.randint(0, 59), rnd.randint(1, 8), rnd.randint(0, 10 ** 6))
+            for _ in range(8000)]
+        data = b"".join(lines)
+    else:
+        data = bytes(rnd.getrandbits(8) if i % 64 == 0 else 0 for i in range(400000))
+    chunks = list(iter_chunks(io.BytesIO(data), **chunk_sizes))
+    middle = len(data) // 3
+    shifted = set(iter_chunks(io.BytesIO(data[:middle] + b"inserted" + data[middle:]), **chunk_sizes))
+    reused = sum(len(c) for c in chunks if c in shifted)
+    assert reused >= 0.9 * len(data)
+
+
+def test_store_deduplicates(filetree):
+    data = random_bytes(10000, 2)
+    filetree.build()
+    store = ChunkStore(filetree.path)
+    first = store.put(data)
+    second = store.put(data)
+    assert first == second
+    assert list(store.all_chunks()) == [first]
+    assert store.read(first) == data
+    assert store.unreferenced({first}) == []
+    assert store.remove(first) == len(data)
+    assert not store.has(first)
+
+
+def test_store_lists_interrupted_writes(filetree):
+    filetree.build()
+    store = ChunkStore(filetree.path)
+    chunk_id = store.put(b"kept")
+    partial = f"{chunk_id}.0123.tmp"  # Left behind by a crash before the rename
+    with open(os.path.join(os.path.dirname(store.chunk_path(chunk_id)), partial), "wb") as f:
+        f.write(b"ke")
+    assert list(store.all_chunks()) == [chunk_id]
+    assert store.unreferenced({chunk_id}) == [partial]
+    assert store.remove(partial) == 2
+    assert list(store.all_chunks(temporary=True)) == []
+
+
+def test_backup_chunked(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("testfile1", value="a" * 5000) \
+        .file("testfile2", value="b" * 5000) \
+        .up() \
+        .dir("dest1") \
+        .build()
+    MetaRecord.create_new(filetree.relpath("dest1"), layout=layout_chunks).save()
+
+    first = run_backup(filetree).last_record
+    assert not os.path.exists(filetree.relpath("dest1", first.folder))
+    with open(filetree.relpath("testdir1/testfile2"), "w") as f:
+        f.write("c" * 5000)
+    second = run_backup(filetree).last_record
+    mr = MetaRecord.load_from(filetree.relpath("dest1"))
+    store = mr.chunk_store()
+    assert len(list(store.all_chunks())) == 3
+    unchanged, changed = second.get_file("testdir1/testfile1"), second.get_file("testdir1/testfile2")
+    assert unchanged.chunks == first.get_file("testdir1/testfile1").chunks
+    assert unchanged.source == first.name
+    assert changed.source == second.name
+    mr.restore_file(changed, filetree.relpath("restored"))
+    assert filetree.content("restored") == ["c" * 5000]
+
+    orphan = store.put(b"not used by any file")
+    cln = Cleaner(mr)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    assert cln.orphan_chunks == [orphan]
+    cln.perform_clean()
+    cln.wait_for_completion()
+    assert not store.has(orphan)
+    assert len(list(store.all_chunks())) == 3
+
+    with pytest.raises(ValueError):  # The chunks of each file are only listed in its record
+        Rebuilder(mr)
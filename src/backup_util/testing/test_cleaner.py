@@ -1,3 +1,4 @@
+import datetime
 import logging
 import os
 
@@ -97,3 +98,97 @@ def test_delete(filetree):
     assert os.path.exists(filetree.relpath("rec_b_data/Dir A/tfa_1.txt"))
     assert not os.path.exists(filetree.relpath("rec_b_data/Dir A/tfa_2.txt"))
     assert not os.path.exists(filetree.relpath("rec_b_data/Dir B/tfb_1.txt"))
+
+
+def test_incremental_clean(filetree):
+    filetree \
+        .dir("rec_a_data") \
+        .file("tf_1.txt", value="testfile_data_1") \
+        .file("tf_2.txt", value="testfile_data_2") \
+        .root() \
+        .dir("rec_b_data") \
+        .file("tf_1.txt", value="testfile_data_1") \
+        .file("tf_2.txt", value="testfile_data_2_chg") \
+        .root() \
+        .dir("rec_c_data") \
+        .file("tf_1.txt", value="testfile_data_1") \
+        .file("tf_2.txt", value="testfile_data_2_chg") \
+        .build()
+    mr = MetaRecord.create_new(filetree.path)
+    for i, name in enumerate(["a", "b"]):
+        rec = Record(filetree.path, f"Rec {name.upper()}", f"rec_{name}_data",
+                     timestamp=datetime.datetime(2020, 1, i + 1))
+        rec.add_file(filetree.relpath(f"rec_{name}_data/tf_1.txt"), "tf_1.txt")
+        rec.add_file(filetree.relpath(f"rec_{name}_data/tf_2.txt"), "tf_2.txt")
+        rec.save(mr)
+    mr.save()
+    cln = Cleaner(mr)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    assert [(r.name, files) for r, files in cln.to_delete] == [("Rec B", ["tf_1.txt"])]
+    cln.perform_clean()
+    cln.wait_for_completion()
+
+    mr = MetaRecord.load_from(filetree.path)
+    cln = Cleaner(mr)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    assert cln.to_delete == []
+
+    rec = Record(filetree.path, "Rec C", "rec_c_data", timestamp=datetime.datetime(2020, 1, 3))
+    rec.add_file(filetree.relpath("rec_c_data/tf_1.txt"), "tf_1.txt")
+    rec.add_file(filetree.relpath("rec_c_data/tf_2.txt"), "tf_2.txt")
+    rec.save(mr)
+    mr.save()
+    cln = Cleaner(mr)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    assert cln.pending_pairs == {("Rec B", "Rec C")}
+    assert [(r.name, sorted(files)) for r, files in cln.to_delete] == [("Rec C", ["tf_1.txt", "tf_2.txt"])]
+
+    cln = Cleaner(mr, incremental=False)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    assert cln.pending_pairs == {("Rec A", "Rec B"), ("Rec B", "Rec C")}
+
+
+def test_clean_batch(filetree):
+    filetree \
+        .dir("rec_a_data") \
+        .dir("Dir A") \
+        .dir("Dir C") \
+        .file("tfc_1.txt", value="testfile_data_3") \
+        .up() \
+        .file("tfa_1.txt", value="testfile_data_1") \
+        .root() \
+        .dir("rec_b_data") \
+        .dir("Dir A") \
+        .dir("Dir C") \
+        .file("tfc_1.txt", value="testfile_data_3") \
+        .up() \
+        .file("tfa_1.txt", value="testfile_data_1") \
+        .build()
+    mr = MetaRecord.create_new(filetree.path)
+    for i, name in enumerate(["a", "b"]):
+        rec = Record(filetree.path, f"Rec {name.upper()}", f"rec_{name}_data",
+                     timestamp=datetime.datetime(2020, 1, i + 1))
+        rec.add_file(filetree.relpath(f"rec_{name}_data/Dir A/tfa_1.txt"), "Dir A/tfa_1.txt")
+        rec.add_file(filetree.relpath(f"rec_{name}_data/Dir A/Dir C/tfc_1.txt"), "Dir A/Dir C/tfc_1.txt")
+        rec.save(mr)
+    mr.save()
+    cln = Cleaner(mr, delete_workers=2)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    assert cln.delete_size == len("testfile_data_1") + len("testfile_data_3")
+    updates = cln.perform_clean()
+    cln.wait_for_completion()
+    assert cln.reclaimed_bytes == len("testfile_data_1") + len("testfile_data_3")
+    last = [u for u in updates.queue if u.is_minor()][-1]
+    assert last.has_bytes() and last.bytes_done == last.bytes_total == cln.delete_size
+    assert not os.path.exists(filetree.relpath("rec_b_data/Dir A"))
+    assert os.path.exists(filetree.relpath("rec_b_data"))
+    assert os.path.exists(filetree.relpath("rec_a_data/Dir A/Dir C/tfc_1.txt"))
+    mr = MetaRecord.load_from(filetree.path)
+    assert sorted(e.name for e in mr.records) == ["Rec A", "Rec B"]
+    assert mr.latest.name == "Rec B"
+    assert {f.source for f in Record.load_from(filetree.path, "Rec B").files} == {"Rec A"}
@@ -0,0 +1,168 @@
+import datetime
+import logging
+import os
+import random
+import shutil
+
+import pytest
+
+from backup_util.managed import MetaRecord, Rebuilder
+from backup_util.managed.compression import compress_and_hash, decompress_file, hash_compressed, is_compressible, \
+    compressed_ext, codec_zlib, codec_lzma, codec_bz2, min_compress_size
+from backup_util.managed.cleaner import Cleaner
+from backup_util.managed.records import record_folder, Record
+from backup_util.testing.FileTree import FileTree
+from backup_util.testing.testutils import run_backup
+from backup_util.utils.datautils import hash_file
+
+log = logging.getLogger(__name__)
+
+text = "".join(f"2020-06-10 12:00:{i % 60:02} INFO request {i} served\n" for i in range(1000))
+
+
+@pytest.fixture()
+def filetree(tmp_path):
+    return FileTree(str(tmp_path))
+
+
+def random_text(size: int, seed: int) -> str:
+    rnd = random.Random(seed)
+    return "".join(chr(rnd.randint(33, 126)) for _ in range(size))
+
+
+def test_is_compressible(filetree):
+    filetree \
+        .file("app.log", value=text) \
+        .file("small.log", value=text[:min_compress_size - 1]) \
+        .file("archive.gz", value=text) \
+        .file("noise.bin", value=random_text(len(text), 1)) \
+        .build()
+    assert is_compressible(filetree.relpath("app.log"), len(text))
+    assert not is_compressible(filetree.relpath("small.log"), min_compress_size - 1)
+    assert not is_compressible(filetree.relpath("archive.gz"), len(text))
+    # Printable noise still has some redundancy, so only a ratio close to 1 rejects it
+    assert not is_compressible(filetree.relpath("noise.bin"), len(text), ratio=0.5)
+
+
+@pytest.mark.parametrize("codec", [codec_zlib, codec_lzma, codec_bz2])
+def test_compress_round_trip(filetree, codec):
+    filetree.file("app.log", value=text).build()
+    src = filetree.relpath("app.log")
+    file_hash, method = compress_and_hash(src, filetree.relpath("stored"), codec)
+    stored = filetree.relpath(f"stored{compressed_ext}")
+    assert method == codec
+    assert file_hash == hash_file(src)
+    assert os.path.getsize(stored) < len(text) / 5
+    assert os.stat(stored).st_mtime_ns == os.stat(src).st_mtime_ns
+    assert hash_compressed(stored, codec) == (file_hash, len(text))
+    decompress_file(stored, filetree.relpath("restored"), codec)
+    assert "".join(filetree.content("restored")) == text
+
+
+def test_backup_compressed(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("app.log", value=text) \
+        .file("archive.gz", value=text) \
+        .file("other.log", value=text + "other") \
+        .up() \
+        .dir("dest1") \
+        .build()
+    first = run_backup(filetree, file_compression=codec_lzma).last_record
+    mr = MetaRecord.load_from(filetree.relpath("dest1"))
+    assert mr.compresses_files()
+    data = filetree.relpath("dest1", first.folder, "testdir1")
+    assert sorted(os.listdir(data)) == ["app.log" + compressed_ext, "archive.gz", "other.log" + compressed_ext]
+    log_file = first.get_file("testdir1/app.log")
+    assert log_file.codec == codec_lzma and first.get_file("testdir1/archive.gz").codec is None
+    assert log_file.hash == hash_file(filetree.relpath("testdir1/app.log"))
+    mr.restore_file(log_file, filetree.relpath("restored"))
+    assert "".join(filetree.content("restored")) == text
+
+    with open(filetree.relpath("testdir1/other.log"), "a") as f:
+        f.write("changed")
+    second = run_backup(filetree, file_compression=codec_lzma, hardlink=True).last_record
+    mr = MetaRecord.load_from(filetree.relpath("dest1"))
+    unchanged, changed = second.get_file("testdir1/app.log"), second.get_file("testdir1/other.log")
+    assert unchanged.codec == codec_lzma and unchanged.source == second.name
+    assert os.path.samefile(mr.resolve_file(unchanged), os.path.join(data, "app.log" + compressed_ext))
+    assert changed.codec == codec_lzma and changed.source == second.name
+    mr.restore_file(changed, filetree.relpath("restored"))
+    assert "".join(filetree.content("restored")) == text + "otherchanged"
+
+
+def test_rebuild_compressed(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("app.log", value=text) \
+        .file("archive.gz", value=text) \
+        .up() \
+        .dir("dest1") \
+        .build()
+    rec = run_backup(filetree, file_compression=codec_lzma).last_record
+    shutil.rmtree(filetree.relpath("dest1", record_folder))
+    mr = MetaRecord.create_new(filetree.relpath("dest1"), file_compression=codec_lzma)
+    mr.save()
+    rb = Rebuilder(mr)
+    rb.generate_records()
+    rb.wait_for_completion()
+    rebuilt = MetaRecord.load_from(filetree.relpath("dest1")).load_latest_record()
+    assert sorted(f.file for f in rebuilt.files) == ["testdir1/app.log", "testdir1/archive.gz"]
+    for f in rebuilt.files:
+        assert (f.hash, f.codec) == (rec.get_file(f.file).hash, rec.get_file(f.file).codec)
+    assert rebuilt.get_file("testdir1/app.log").size is None
+
+
+def test_clean_compressed(filetree):
+    filetree \
+        .file("app.log", value=text) \
+        .dir("dest1") \
+        .dir("data_a") \
+        .up() \
+        .dir("data_b") \
+        .build()
+    mr = MetaRecord.create_new(filetree.relpath("dest1"), file_compression=codec_lzma)
+    for name, folder, day in (("Rec A", "data_a", 1), ("Rec B", "data_b", 2)):
+        rec = Record(mr.path, name, folder, datetime.datetime(2020, 1, day), hash_algorithm=mr.hash_algorithm)
+        file_hash, codec = compress_and_hash(filetree.relpath("app.log"), filetree.relpath("dest1", folder, "app.log"),
+                                             codec_lzma, mr.hash_algorithm)
+        rec.add_file(filetree.relpath("app.log"), "app.log", file_hash=file_hash).codec = codec
+        rec.save(mr)
+    mr.save()
+    cln = Cleaner(mr)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    cln.perform_clean()
+    cln.wait_for_completion()
+    assert not filetree.exists(os.path.join("dest1", "data_b", "app.log" + compressed_ext))
+    cleaned = Record.load_from(mr.path, "Rec B").get_file("app.log")
+    assert (cleaned.source, cleaned.codec) == ("Rec A", codec_lzma)
+    mr.restore_file(cleaned, filetree.relpath("restored"))
+    assert "".join(filetree.content("restored")) == text
+
+
+def test_stored_names_do_not_collide(filetree):
+    names = {"a.log": text, "a.log.compressed": text + "raw", "a.log.compressed.stored": text + "escaped",
+             "b.compressed": "short"}
+    source = filetree.dir("testdir1")
+    for name, value in names.items():
+        source.file(name, value=value)
+    filetree.dir("dest1").build()
+    rec = run_backup(filetree, file_compression=codec_lzma).last_record
+    mr = MetaRecord.load_from(filetree.relpath("dest1"))
+    assert len(os.listdir(filetree.relpath("dest1", rec.folder, "testdir1"))) == len(names)
+    for name, value in names.items():
+        mr.restore_file(rec.get_file(f"testdir1/{name}"), filetree.relpath("restored"))
+        assert "".join(filetree.content("restored")) == value
+
+    # The rebuilder reads the codec from the stored files, so raw files with compressed names are hashed as they are
+    shutil.rmtree(filetree.relpath("dest1", record_folder))
+    mr = MetaRecord.create_new(filetree.relpath("dest1"), file_compression=codec_lzma)
+    mr.save()
+    rb = Rebuilder(mr)
+    rb.generate_records()
+    rb.wait_for_completion()
+    rebuilt = MetaRecord.load_from(filetree.relpath("dest1")).load_latest_record()
+    assert sorted(f.file for f in rebuilt.files) == sorted(f"testdir1/{name}" for name in names)
+    for f in rebuilt.files:
+        assert (f.hash, f.codec) == (rec.get_file(f.file).hash, rec.get_file(f.file).codec)
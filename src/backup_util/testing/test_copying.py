@@ -0,0 +1,115 @@
+import errno
+import os
+
+import pytest
+
+from backup_util.Backup import Backup
+from backup_util.testing.FileTree import FileTree
+from backup_util.utils import copying
+from backup_util.utils.copying import copy_file, copy_file_and_hash, CopyStats, copy_methods, copy_range, \
+    copy_sendfile, copy_userspace
+from backup_util.utils.datautils import hash_file
+
+
+@pytest.fixture()
+def filetree(tmp_path):
+    return FileTree(str(tmp_path))
+
+
+@pytest.fixture()
+def source(filetree):
+    filetree.dir("src").build()
+    path = filetree.relpath("src", "data.bin")
+    with open(path, "wb") as f:
+        f.write(os.urandom(3 * 1024 * 1024 + 17))
+    os.utime(path, ns=(1_000_000_000, 2_000_000_000))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def forget_unsupported(monkeypatch):
+    monkeypatch.setattr(copying, "_unsupported", {})
+
+
+def assert_same(src: str, dest: str):
+    with open(src, "rb") as a, open(dest, "rb") as b:
+        assert a.read() == b.read()
+    assert os.stat(dest).st_mtime_ns == os.stat(src).st_mtime_ns
+
+
+@pytest.mark.parametrize("method", copy_methods)
+def test_copy_file_methods(source, method):
+    device = os.stat(source).st_dev
+    copying._unsupported[(device, device)] = set(copy_methods[:copy_methods.index(method)])
+    dest = source + ".copy"
+    used = copy_file(source, dest)
+    assert copy_methods.index(used) >= copy_methods.index(method)  # Earlier methods are not tried
+    assert_same(source, dest)
+
+
+@pytest.mark.skipif(not hasattr(os, "copy_file_range"), reason="copy_file_range is not available")
+def test_copy_file_falls_back(source, monkeypatch):
+    calls = []
+
+    def unsupported(*args):
+        calls.append(args)
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(copying, "_reflink", lambda *args: False)
+    monkeypatch.setattr(os, "copy_file_range", unsupported)
+    assert copy_file(source, source + ".1") in (copy_sendfile, copy_userspace)
+    assert_same(source, source + ".1")
+    assert copy_file(source, source + ".2") in (copy_sendfile, copy_userspace)
+    assert len(calls) == 1  # Not tried again between the same devices
+    assert_same(source, source + ".2")
+
+
+@pytest.mark.skipif(not hasattr(os, "copy_file_range"), reason="copy_file_range is not available")
+def test_copy_file_no_data_reported(source, monkeypatch):
+    monkeypatch.setattr(copying, "_reflink", lambda *args: False)
+    monkeypatch.setattr(os, "copy_file_range", lambda *args: 0)  # Like files on procfs or some FUSE filesystems
+    assert copy_file(source, source + ".copy") in (copy_sendfile, copy_userspace)
+    assert_same(source, source + ".copy")
+
+
+def test_copy_file_empty(filetree):
+    filetree.dir("src").file("empty", "").build()
+    copy_file(filetree.relpath("src", "empty"), filetree.relpath("src", "empty.copy"))
+    assert os.path.getsize(filetree.relpath("src", "empty.copy")) == 0
+
+
+def test_copy_file_and_hash(source):
+    file_hash, method = copy_file_and_hash(source, source + ".copy", "sha256")
+    assert file_hash == hash_file(source, "sha256")
+    assert method in copy_methods
+    assert_same(source, source + ".copy")
+
+
+def test_copy_stats():
+    stats = CopyStats()
+    assert stats.summary() is None
+    stats.add(copy_userspace, 1024 ** 2)
+    stats.add(copy_range, 0)
+    stats.add(copy_range, 2 * 1024 ** 2)
+    assert stats.summary() == "2 copy_file_range (2.0 MiB) / 1 userspace (1.0 MiB)"
+
+
+def test_backup_small_and_large_files(filetree):
+    tree = filetree.dir("testdir1")
+    for i in range(20):
+        tree.file(f"small{i}", value=f"small file {i}")
+    filetree.dir("dest1").build()
+    with open(filetree.relpath("testdir1", "large"), "wb") as f:
+        f.write(os.urandom(1024 * 1024))
+    b = Backup(False, copy_workers=4, small_file_size=1024)
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    data_queue = b.execute()
+    b.wait_for_completion()
+    for name in os.listdir(filetree.relpath("testdir1")):
+        assert_same(filetree.relpath("testdir1", name), filetree.relpath("dest1", "testdir1", name))
+    updates = []
+    while not data_queue.empty():
+        updates.append(data_queue.get_nowait())
+    assert updates[-1].message.startswith("Complete [21 scanned, 21 copied")
+    assert any(m in updates[-1].message for m in copy_methods)
@@ -0,0 +1,76 @@
+import os
+import shutil
+
+import pytest
+
+from backup_util.Backup import Backup
+from backup_util.testing.FileTree import FileTree
+from backup_util.utils.benchmark import make_rules, make_names
+from backup_util.utils.exclusions import Exclusions, ignore_file_name
+
+
+@pytest.fixture()
+def filetree(tmp_path):
+    return FileTree(str(tmp_path))
+
+
+@pytest.mark.parametrize("path,is_dir,excluded", [
+    ("x.pyc", False, True),
+    ("sub/x.pyc", False, True),
+    ("keep.pyc", False, False),  # Re-included by a later rule
+    ("node_modules", True, True),
+    ("sub/node_modules", True, True),
+    ("build", True, True),
+    ("sub/build", True, False),  # Anchored to the root
+    ("docs/c.tmp", False, True),
+    ("docs/a/b/c.tmp", False, True),
+    ("c.tmp", False, False),
+    ("cache", True, True),
+    ("cache", False, False),  # Only directories
+    ("#notes", False, True),
+    ("other.txt", False, False)
+])
+def test_rules(path, is_dir, excluded):
+    exclusions = Exclusions(["# comment", "", "*.pyc", "node_modules", "/build", "docs/**/*.tmp", "cache/",
+                             "!keep.pyc", "\\#notes"])
+    assert exclusions.matches(path, is_dir) == excluded
+
+
+def test_same_as_ignore_patterns(tmp_path):
+    rules = make_rules(100)
+    names = make_names(2000, rules)
+    expected = shutil.ignore_patterns(*rules)(str(tmp_path), names)
+    assert len(expected) > 0
+    assert Exclusions(rules).for_tree(str(tmp_path))(str(tmp_path), names) == set(expected)
+
+
+def test_backup_ignore_file(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file(ignore_file_name, "*.log\n/out/\n") \
+        .file("keep.txt") \
+        .file("skip.log") \
+        .dir("out") \
+        .file("generated") \
+        .up() \
+        .dir("sub") \
+        .file(ignore_file_name, "!important.log\n") \
+        .file("important.log") \
+        .file("other.log") \
+        .dir("out") \
+        .file("kept") \
+        .root() \
+        .dir("dest1") \
+        .build()
+    b = Backup(False)
+    b.add_source(filetree.relpath("testdir1"))
+    b.add_exception("*.txt")
+    b.add_exception("!keep.txt")
+    b.set_destination(filetree.relpath("dest1"))
+    b.execute()
+    b.wait_for_completion()
+    copied = sorted(os.path.relpath(os.path.join(dirpath, f), filetree.relpath("dest1", "testdir1"))
+                    for dirpath, dirnames, filenames in os.walk(filetree.relpath("dest1", "testdir1"))
+                    for f in filenames)
+    assert copied == sorted([ignore_file_name, "keep.txt", os.path.join("sub", ignore_file_name),
+                             os.path.join("sub", "important.log"), os.path.join("sub", "out", "kept")])
@@ -1,3 +1,4 @@
+import importlib
 import logging
 import os
 from time import sleep
@@ -5,9 +6,12 @@ from time import sleep
 import pytest
 
 from backup_util.exception.ValidationException import ValidationException
-from backup_util.managed import ManagedBackup
+from backup_util.managed import ManagedBackup, MetaRecord
+from backup_util.managed.cleaner import Cleaner
+from backup_util.managed.journal import RunJournal
 from backup_util.testing.FileTree import FileTree
-from backup_util.testing.testutils import list_files
+from backup_util.testing.testutils import list_files, run_backup
+from backup_util.utils.datautils import hash_file
 
 log = logging.getLogger(__name__)
 
@@ -143,3 +147,291 @@ def test_backup_twice_nochange(filetree):
     assert rec.files[0].source != rec.name
     assert not os.path.exists(filetree.relpath("dest1", rec.folder, rec.files[0].file))
     print("BREAK")
+
+
+def test_backup_twice_skips_rehash(filetree, monkeypatch):
+    filetree \
+        .dir("testdir1") \
+        .file("testfile1") \
+        .file("testfile2") \
+        .up() \
+        .dir("dest1") \
+        .build()
+    hashed = []
+    managed_module = importlib.import_module("backup_util.managed.ManagedBackup")
+
+    def counting(func):
+        def wrapper(path, *args, **kwargs):
+            hashed.append(path)
+            return func(path, *args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(managed_module, "hash_file", counting(managed_module.hash_file))
+    monkeypatch.setattr(managed_module, "copy_file_and_hash", counting(managed_module.copy_file_and_hash))
+
+    first = run_backup(filetree).last_record
+    assert len(hashed) == 2
+    hashed.clear()
+    second = run_backup(filetree).last_record
+    assert len(hashed) == 0
+    assert all(f.source == first.name for f in second.files)
+    third = run_backup(filetree, paranoid=True).last_record
+    assert len(hashed) == 2
+    assert all(f.source == first.name for f in third.files)
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_backup_parallel_hashing(filetree, processes):
+    tree = filetree.dir("testdir1")
+    for i in range(40):
+        tree.file(f"testfile{i:02}", value=f"content of file {i}")
+    filetree.dir("dest1").build()
+    b = ManagedBackup(dry_run=False, hash_workers=4, hash_processes=processes)
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    b.execute()
+    b.wait_for_completion()
+    rec = b.last_record
+    # Records list files in traversal order, which is sorted, regardless of which worker finishes first
+    expected = [os.path.join("testdir1", f"testfile{i:02}") for i in range(40)]
+    assert [f.file for f in rec.files] == expected
+    for f in rec.files:
+        assert os.path.exists(filetree.relpath("dest1", rec.folder, f.file))
+
+
+def test_backup_touched_file_not_stored(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("testfile1", value="same") \
+        .file("testfile2", value="before") \
+        .up() \
+        .dir("dest1") \
+        .build()
+
+    first = run_backup(filetree).last_record
+    for name, value in [("testfile1", "same"), ("testfile2", "after")]:
+        with open(filetree.relpath("testdir1", name), "w") as f:
+            f.write(value)
+    second = run_backup(filetree).last_record
+    same, changed = second.get_file("testdir1/testfile1"), second.get_file("testdir1/testfile2")
+    assert same.source == first.name
+    assert not os.path.exists(filetree.relpath("dest1", second.folder, same.file))
+    assert changed.source == second.name
+    assert filetree.content(os.path.join("dest1", second.folder, changed.file)) == ["after"]
+
+
+def test_backup_keeps_destination_algorithm(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("testfile1") \
+        .up() \
+        .dir("dest1") \
+        .build()
+    MetaRecord.create_new(filetree.relpath("dest1"), "sha256").save()
+    b = ManagedBackup(dry_run=False, hash_algorithm="blake2s")
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    b.execute()
+    b.wait_for_completion()
+    rec = b.last_record
+    assert rec.hash_algorithm == "sha256"
+    assert rec.files[0].hash == hash_file(filetree.relpath("testdir1/testfile1"), "sha256")
+
+
+def test_backup_rehashes_after_algorithm_change(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("same", value="same") \
+        .file("changed", value="before") \
+        .up() \
+        .dir("dest1") \
+        .build()
+    MetaRecord.create_new(filetree.relpath("dest1"), "sha256").save()
+
+    first = run_backup(filetree).last_record
+    mr = MetaRecord.load_from(filetree.relpath("dest1"))
+    mr.hash_algorithm = "blake2b"
+    mr.save()
+    with open(filetree.relpath("testdir1/changed"), "w") as f:
+        f.write("after")
+    second = run_backup(filetree).last_record
+    assert second.hash_algorithm == "blake2b"
+    same, changed = second.get_file("testdir1/same"), second.get_file("testdir1/changed")
+    assert same.hash == hash_file(filetree.relpath("testdir1/same"), "blake2b")
+    assert same.source == first.name  # Not copied again
+    assert not os.path.exists(filetree.relpath("dest1", second.folder, same.file))
+    assert changed.source == second.name
+    assert changed.hash == hash_file(filetree.relpath("testdir1/changed"), "blake2b")
+
+
+def test_backup_hardlink_unchanged(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("testfile1") \
+        .up() \
+        .dir("dest1") \
+        .build()
+
+    first = run_backup(filetree, hardlink=True).last_record
+    second = run_backup(filetree, hardlink=True).last_record
+    fd = second.files[0]
+    assert fd.source == second.name
+    first_copy = filetree.relpath("dest1", first.folder, fd.file)
+    second_copy = filetree.relpath("dest1", second.folder, fd.file)
+    assert os.path.samefile(first_copy, second_copy)
+    assert os.stat(second_copy).st_nlink == 2
+    cln = Cleaner(MetaRecord.load_from(filetree.relpath("dest1")))
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    assert cln.file_count() == 0  # Removing links would not reclaim anything
+
+
+def test_backup_cancel_leaves_partial_record(filetree, monkeypatch):
+    for i in range(10):
+        filetree.dir("testdir1").file(f"testfile{i}", value=f"data {i}")
+    filetree.root().dir("dest1").build()
+    backup_module = importlib.import_module("backup_util.Backup")
+    scan_tree = backup_module.scan_tree
+    b = ManagedBackup(dry_run=False, hash_workers=1)
+
+    def cancelling(*args):  # Walked by the backup thread, so the cancel point is fixed
+        for index, entry in enumerate(scan_tree(*args)):
+            if index == 3:
+                b.cancel()
+            yield entry
+
+    monkeypatch.setattr(backup_module, "scan_tree", cancelling)
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    data_queue = b.execute()
+    b.wait_for_completion()
+    updates = []
+    while not data_queue.empty():
+        updates.append(data_queue.get_nowait())
+    assert updates[-1].message == "Cancelled"
+    assert updates[-1].is_minor()  # Not shown as 100%
+    rec = b.last_record
+    assert rec.partial
+    assert 3 <= len(rec.files) < 10
+    for f in rec.files:
+        assert os.path.exists(os.path.join(rec.data_path(), f.file))
+    mr = MetaRecord.load_from(filetree.relpath("dest1"))
+    assert mr.load_latest_record().partial
+
+
+def test_backup_resumes_journal(filetree, monkeypatch):
+    for i in range(10):
+        filetree.dir("testdir1").file(f"testfile{i}", value=f"data {i}")
+    filetree.root().dir("dest1").build()
+    managed_module = importlib.import_module("backup_util.managed.ManagedBackup")
+    copy_file_and_hash = managed_module.copy_file_and_hash
+    save = managed_module.Record.save
+
+    def crash(*args, **kwargs):
+        raise RuntimeError("Crashed before the record was saved")
+
+    monkeypatch.setattr(managed_module.Record, "save", crash)
+    b = ManagedBackup(dry_run=False, hash_workers=1)
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    b.execute()
+    assert isinstance(b.thread.join(), RuntimeError)
+    journal_path = RunJournal.find_unfinished(filetree.relpath("dest1"))
+    header, done = RunJournal.read(journal_path)
+    assert len(done) == 10
+    with open(journal_path, "rb+") as file:  # The last entry was cut off by the crash
+        file.truncate(os.path.getsize(journal_path) - 10)
+
+    copied = []
+
+    def counting(src, dest, *args, **kwargs):
+        copied.append(src)
+        return copy_file_and_hash(src, dest, *args, **kwargs)
+
+    monkeypatch.setattr(managed_module.Record, "save", save)
+    monkeypatch.setattr(managed_module, "copy_file_and_hash", counting)
+    b = ManagedBackup(dry_run=False, hash_workers=1)
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    b.execute()
+    b.wait_for_completion()
+    assert len(copied) == 1
+    rec = b.last_record
+    assert rec.name == header["name"]
+    assert rec.folder == header["folder"]
+    assert len(rec.files) == 10
+    for f in rec.files:
+        assert f.hash == hash_file(os.path.join(rec.data_path(), f.file), rec.hash_algorithm)
+    assert RunJournal.find_unfinished(filetree.relpath("dest1")) is None
+    assert sorted(os.listdir(filetree.relpath("dest1"))) == sorted([rec.folder, "records"])
+
+
+def test_backup_discards_journal_without_header(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("testfile1", value="data") \
+        .up() \
+        .dir("dest1") \
+        .build()
+    MetaRecord.create_new(filetree.relpath("dest1")).save()
+    journal_path = RunJournal.journal_path(filetree.relpath("dest1"), "Backup for 2020-01-01_00-00-00")
+    with open(journal_path, "w"):  # Crashed before the header was synced
+        pass
+    b = ManagedBackup(dry_run=False)
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    b.execute()
+    b.wait_for_completion()
+    assert not os.path.exists(journal_path)
+    assert RunJournal.find_unfinished(filetree.relpath("dest1")) is None
+    assert b.last_record.get_file("testdir1/testfile1") is not None
+
+
+def test_backup_resume_checks_stored_files(filetree, monkeypatch):
+    for i in range(4):
+        filetree.dir("testdir1").file(f"testfile{i}", value=f"data {i}")
+    filetree.root().dir("dest1").build()
+    managed_module = importlib.import_module("backup_util.managed.ManagedBackup")
+    copy_file_and_hash = managed_module.copy_file_and_hash
+    sync_paths = managed_module.sync_paths
+    save = managed_module.Record.save
+    synced = []
+
+    def crash(*args, **kwargs):
+        raise RuntimeError("Crashed before the record was saved")
+
+    def recording(paths):
+        synced.extend(paths)
+        sync_paths(paths)
+
+    monkeypatch.setattr(managed_module.Record, "save", crash)
+    monkeypatch.setattr(managed_module, "sync_paths", recording)
+    b = ManagedBackup(dry_run=False, hash_workers=1)
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    b.execute()
+    assert isinstance(b.thread.join(), RuntimeError)
+    header, done = RunJournal.read(RunJournal.find_unfinished(filetree.relpath("dest1")))
+    data = filetree.relpath("dest1", header["folder"], "testdir1")
+    assert sorted(synced) == sorted(os.path.join(data, f"testfile{i}") for i in range(4))
+
+    # The journal reached the disk but the data of two files did not
+    with open(os.path.join(data, "testfile0"), "w"):
+        pass
+    os.remove(os.path.join(data, "testfile1"))
+    copied = []
+
+    def counting(src, dest, *args, **kwargs):
+        copied.append(os.path.basename(src))
+        return copy_file_and_hash(src, dest, *args, **kwargs)
+
+    monkeypatch.setattr(managed_module.Record, "save", save)
+    monkeypatch.setattr(managed_module, "copy_file_and_hash", counting)
+    b = ManagedBackup(dry_run=False, hash_workers=1)
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    b.execute()
+    b.wait_for_completion()
+    assert sorted(copied) == ["testfile0", "testfile1"]
+    for f in b.last_record.files:
+        assert f.hash == hash_file(os.path.join(b.last_record.data_path(), f.file), b.last_record.hash_algorithm)
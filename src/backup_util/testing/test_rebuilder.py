@@ -1,12 +1,16 @@
 import datetime
+import importlib
 import logging
+import os
 from random import randint
 
 import pytest
 
 from backup_util.managed import Rebuilder, MetaRecord
-from backup_util.managed.records import record_ext, Record
+from backup_util.managed.cleaner import Cleaner
+from backup_util.managed.records import record_ext, record_folder, Record
 from backup_util.testing.FileTree import FileTree
+from backup_util.utils.datautils import hash_file
 
 log = logging.getLogger(__name__)
 
@@ -56,3 +60,131 @@ def test_gen_records(filetree):
         filetree.exists(path)
         loaded_rec = Record.load_from(filetree.path, r.name)
         assert loaded_rec == r
+
+
+def test_gen_records_parallel(filetree):
+    for i in range(20):
+        filetree.dir("Dir A").file(f"testfile-{i}.txt", value=f"data {i}")
+    filetree.build()
+    mr = MetaRecord.create_new(filetree.path)
+    mr.save()
+    rb = Rebuilder(mr, hash_workers=4)
+    rb.generate_records()
+    rb.wait_for_completion()
+    rec = rb.records()[0]
+    assert len(rec.files) == 20
+    for f in rec.files:
+        assert f.hash == hash_file(filetree.relpath("Dir A", f.file))
+
+
+def test_gen_records_reuse(filetree, monkeypatch):
+    for d in ["Dir A", "Dir B"]:
+        filetree.dir(d).file("same.txt", value="same data").file("changed.txt", value=f"data of {d}").up()
+    filetree.build()
+    for name in ["same.txt", "changed.txt"]:  # Copies keep their modification time
+        stat = os.stat(filetree.relpath("Dir A", name))
+        os.utime(filetree.relpath("Dir B", name), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.utime(filetree.relpath("Dir B", "changed.txt"), ns=(0, 0))
+    mr = MetaRecord.create_new(filetree.path)
+    mr.save()
+    rb = Rebuilder(mr, hash_workers=1)
+    rb.configure_directory("Dir A", name="Rec A", timestamp=datetime.datetime(2020, 1, 1))
+    rb.configure_directory("Dir B", name="Rec B", timestamp=datetime.datetime(2020, 1, 2))
+    rebuilder_module = importlib.import_module("backup_util.managed.rebuilder")
+    hashed = []
+
+    def counting_hash(path, algorithm):
+        hashed.append(os.path.relpath(path, filetree.path))
+        return hash_file(path, algorithm)
+
+    monkeypatch.setattr(rebuilder_module, "hash_file", counting_hash)
+    rb.generate_records()
+    rb.wait_for_completion()
+    assert sorted(hashed) == sorted([os.path.join("Dir A", "same.txt"), os.path.join("Dir A", "changed.txt"),
+                                     os.path.join("Dir B", "changed.txt")])
+    rec_b = Record.load_from(filetree.path, "Rec B")
+    assert rec_b.get_file("same.txt").source == "Rec A"
+    assert rec_b.get_file("changed.txt").source == "Rec B"
+
+    cln = Cleaner(MetaRecord.load_from(filetree.path))
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    assert [(e.name, files) for e, files in cln.to_delete] == [("Rec B", ["same.txt"])]
+
+
+def test_gen_records_resume(filetree):
+    for i, d in enumerate(["Dir A", "Dir B", "Dir C", "Dir D"]):
+        filetree.dir(d).file("same.txt", value="same data").file("changed.txt", value=f"data of {d}").up()
+    filetree.build()
+    mr = MetaRecord.create_new(filetree.path)
+    mr.save()
+    rb = Rebuilder(mr)
+    for i, d in enumerate(["Dir A", "Dir B", "Dir C", "Dir D"]):
+        rb.configure_directory(d, name=f"Rec {d[-1]}", timestamp=datetime.datetime(2020, 1, i + 1),
+                               included=d == "Dir A")
+    rb.generate_records()
+    rb.wait_for_completion()
+    assert [e.name for e in MetaRecord.load_from(filetree.path).records] == ["Rec A"]
+
+    mr = MetaRecord.load_from(filetree.path)
+    rb = Rebuilder(mr, folder_workers=3)
+    discovered = {r.folder: (r.name, included) for r, included in rb.directories}
+    assert discovered["Dir A"] == ("Rec A", False)
+    assert discovered["Dir B"][1]
+    for i, d in enumerate(["Dir B", "Dir C", "Dir D"]):
+        rb.configure_directory(d, name=f"Rec {d[-1]}", timestamp=datetime.datetime(2020, 1, i + 2))
+    rb.generate_records()
+    rb.wait_for_completion()
+    mr = MetaRecord.load_from(filetree.path)
+    assert sorted(e.name for e in mr.records) == ["Rec A", "Rec B", "Rec C", "Rec D"]
+    for name in ["Rec B", "Rec C", "Rec D"]:
+        rec = Record.load_from(filetree.path, name)
+        assert rec.get_file("same.txt").source == "Rec A"
+        assert rec.get_file("changed.txt").source == name
+
+
+def test_gen_records_failure_stops_scans(filetree, monkeypatch):
+    for d in ["Dir A", "Dir B", "Dir C"]:
+        filetree.dir(d).file("file.txt", value=f"data of {d}").up()
+    filetree.build()
+    mr = MetaRecord.create_new(filetree.path)
+    mr.save()
+    rb = Rebuilder(mr, folder_workers=2)
+    for i, d in enumerate(["Dir A", "Dir B", "Dir C"]):
+        rb.configure_directory(d, name=f"Rec {d[-1]}", timestamp=datetime.datetime(2020, 1, i + 1))
+
+    def failing(*args, **kwargs):
+        raise RuntimeError("Disk full")
+
+    monkeypatch.setattr(Rebuilder, "_commit_record", failing)
+    rb.generate_records()
+    with pytest.raises(RuntimeError):
+        rb.wait_for_completion()
+    assert rb.token.is_cancelled()  # Scans still running stop at their next check
+
+
+def test_discover_dirs_legacy_entries(filetree):
+    for d in ["Dir A", "Dir B", "Dir C"]:
+        filetree.dir(d).file("data.txt", value=f"data of {d}").up()
+    filetree.build()
+    mr = MetaRecord.create_new(filetree.path)
+    for i, d in enumerate(["Dir A", "Dir B"]):
+        rec = Record(filetree.path, f"Rec {d[-1]}", d, datetime.datetime(2020, 1, i + 1))
+        rec.add_file(filetree.relpath(d, "data.txt"), "data.txt")
+        rec.save(mr)
+    for entry in mr.records:  # Saved before folders were tracked
+        entry.folder = None
+    mr.save()
+    os.remove(filetree.relpath(record_folder, f"Rec B{record_ext}"))
+
+    mr = MetaRecord.load_from(filetree.path)
+    rb = Rebuilder(mr)
+    discovered = {r.folder: (r.name, included) for r, included in rb.directories}
+    assert discovered["Dir A"] == ("Rec A", False)
+    assert discovered["Dir B"][1] and discovered["Dir C"][1]  # The record of Dir B cannot be read
+    rb.configure_directory("Dir B", name="Rec B2", timestamp=datetime.datetime(2020, 1, 2))
+    rb.configure_directory("Dir C", name="Rec C", timestamp=datetime.datetime(2020, 1, 3))
+    rb.generate_records()
+    rb.wait_for_completion()
+    assert Record.load_from(filetree.path, "Rec C").get_file("data.txt").hash == \
+        hash_file(filetree.relpath("Dir C", "data.txt"), mr.hash_algorithm)
@@ -1,12 +1,18 @@
+import hashlib
 import logging
 import os
 from time import sleep
 
 import pytest
 
-from backup_util.managed import MetaRecord, Record
-from backup_util.managed.records import record_ext, record_folder, metarecord_name
+from backup_util.managed import MetaRecord, Record, FileData, NoRecordError
+from backup_util.managed.compact import compact_record_ext, format_compact, format_json
+from backup_util.managed.converter import RecordConverter
+from backup_util.managed.records import record_ext, record_folder, metarecord_name, diff_added, diff_changed, \
+    diff_removed, diff_unchanged
 from backup_util.testing.FileTree import FileTree
+from backup_util.utils.datautils import copy_and_hash, hash_file
+from backup_util.utils.threading import JobCancelled
 
 log = logging.getLogger(__name__)
 
@@ -111,3 +117,206 @@ def test_diff_records(filetree):
     assert len(uchg) == 1
     assert chg[0][1] == rec2.files[0]
     assert chg[1][1] == rec2.files[1]
+
+
+def test_record_file_index(filetree):
+    filetree.dir("source_data").file("junkA").file("junkB").build()
+    rec = Record(filetree.path, "Rec A", "Rec A Data")
+    rec.add_file(filetree.relpath("source_data/junkA"), "source_data/junkA")
+    assert rec.get_file("source_data/junkA") is rec.files[0]
+    assert rec.get_file("source_data/junkB") is None
+    rec.add_file(filetree.relpath("source_data/junkB"), "source_data/junkB")  # Index is kept up to date
+    assert rec.get_file("source_data/junkB") is rec.files[1]
+    assert len(rec.file_index()) == 2
+
+
+def test_record_stat_data(filetree):
+    filetree.dir("source_data").file("junkA").build()
+    mr = MetaRecord.create_new(filetree.path)
+    rec = Record(filetree.path, "Rec A", "Rec A Data")
+    fd = rec.add_file(filetree.relpath("source_data/junkA"), "source_data/junkA")
+    stat = os.stat(filetree.relpath("source_data/junkA"))
+    assert fd.stat_matches(stat)
+    rec.save(mr)
+    mr.save()
+    loaded = Record.load_from(rec.path, rec.name).files[0]
+    assert loaded.size == stat.st_size
+    assert loaded.mtime_ns == stat.st_mtime_ns
+    assert loaded.stat_matches(stat)
+    os.utime(filetree.relpath("source_data/junkA"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert not loaded.stat_matches(os.stat(filetree.relpath("source_data/junkA")))
+
+
+def test_copy_and_hash(filetree):
+    filetree.dir("source_data").file("junkA", value="some data").up().dir("dest").build()
+    src = filetree.relpath("source_data/junkA")
+    dest = filetree.relpath("dest/junkA")
+    assert copy_and_hash(src, dest) == hash_file(src)
+    assert filetree.content("dest/junkA") == ["some data"]
+    assert os.stat(src).st_mtime_ns == os.stat(dest).st_mtime_ns
+
+
+def test_record_hash_algorithm(filetree):
+    filetree.dir("source_data").file("junkA").build()
+    mr = MetaRecord.create_new(filetree.path, "sha256")
+    mr.save()
+    assert MetaRecord.load_from(filetree.path).hash_algorithm == "sha256"
+    rec = Record(filetree.path, "Rec A", "Rec A Data", hash_algorithm=mr.hash_algorithm)
+    fd = rec.add_file(filetree.relpath("source_data/junkA"), "junkA")
+    assert fd.hash == hash_file(filetree.relpath("source_data/junkA"), "sha256")
+    rec.save(mr)
+    assert Record.load_from(filetree.path, rec.name).hash_algorithm == "sha256"
+    rec2 = Record(filetree.path, "Rec B", "Rec B Data", hash_algorithm="blake2b")
+    rec2.add_file(filetree.relpath("source_data/junkA"), "junkA")
+    add, chg, rm, uchg = rec.file_diff(rec2)  # Digests of different algorithms can't be compared
+    assert len(chg) == 1 and len(uchg) == 0
+    with pytest.raises(ValueError):
+        MetaRecord.create_new(filetree.path, "crc32")
+
+
+def test_load_legacy_records(filetree):
+    filetree \
+        .dir("records") \
+        .file(metarecord_name, value='{"records": []}') \
+        .file(f"Rec A{record_ext}", value='{"name": "Rec A", "folder": "Rec A Data", '
+                                          '"timestamp": "2020-06-10T00:00:00", "files": []}') \
+        .build()
+    assert MetaRecord.load_from(filetree.path).hash_algorithm == "sha256"
+    assert Record.load_from(filetree.path, "Rec A").hash_algorithm == "sha256"
+
+
+def test_hash_file_strategies(filetree):
+    filetree.dir("source_data").file("junkA", value="0123456789" * 10000).file("empty", value="").build()
+    for name in ["junkA", "empty"]:
+        path = filetree.relpath("source_data", name)
+        with open(path, "rb") as f:
+            expected = hashlib.blake2b(f.read()).hexdigest()
+        assert hash_file(path) == expected
+        assert hash_file(path, block_size=4096) == expected
+        assert hash_file(path, block_size=7) == expected
+        assert hash_file(path, mmap_threshold=0) == expected
+
+
+def test_metarecord_resolve_file(filetree):
+    mr = MetaRecord.create_new(filetree.path)
+    rec = Record(filetree.path, "Rec A", "Rec A Data")
+    rec.files.append(FileData("Dir/file.txt", "hash", "Rec A"))
+    rec.save(mr)
+    mr.save()
+    loaded = MetaRecord.load_from(filetree.path)
+    assert loaded.folder_of("Rec A") == "Rec A Data"
+    assert loaded.resolve_file(rec.files[0]) == filetree.relpath("Rec A Data", "Dir/file.txt")
+    with pytest.raises(NoRecordError):
+        loaded.folder_of("Rec Z")
+
+
+def test_compact_record_round_trip(filetree):
+    filetree.dir("source_data").file("junkA").file("junkB").build()
+    mr = MetaRecord.create_new(filetree.path)
+    mr.record_format = format_compact
+    rec = Record(filetree.path, "Rec A", "Rec A Data")
+    rec.add_file(filetree.relpath("source_data/junkA"), "source_data/junkA")
+    rec.add_file(filetree.relpath("source_data/junkB"), "source_data/junkB", source="Rec 0")
+    rec.files.append(FileData("legacy", "not-a-hex-digest", "Rec 0"))
+    rec.files.append(FileData("chunked", rec.files[0].hash, "Rec A", 10, 20, 30, [rec.files[0].hash] * 2))
+    rec.files.append(FileData("packed", rec.files[0].hash, "Rec A", 10, 20, 30, segment=["seg", 4096, 10]))
+    rec.files.append(FileData("compressed", rec.files[0].hash, "Rec A", 10, 20, 30, codec="lzma"))
+    rec.save(mr)
+    mr.save()
+    assert filetree.exists(os.path.join(record_folder, f"Rec A{compact_record_ext}"))
+    assert not filetree.exists(os.path.join(record_folder, f"Rec A{record_ext}"))
+    loaded = Record.load_from(filetree.path, "Rec A")
+    assert loaded == rec
+    for original, copy in zip(rec.files, loaded.files):
+        assert (original.size, original.mtime_ns, original.inode, original.chunks, original.segment, original.codec) \
+               == (copy.size, copy.mtime_ns, copy.inode, copy.chunks, copy.segment, copy.codec)
+
+
+def test_convert_records(filetree):
+    filetree.dir("source_data").file("junkA").build()
+    mr = MetaRecord.create_new(filetree.path)
+    rec = Record(filetree.path, "Rec A", "Rec A Data")
+    rec.add_file(filetree.relpath("source_data/junkA"), "source_data/junkA")
+    rec.save(mr)
+    mr.save()
+    for compression in ["none", "zlib", "lzma"]:
+        mr.convert_records(format_compact, compression)
+        assert MetaRecord.load_from(filetree.path).record_format == format_compact
+        assert Record.load_from(filetree.path, "Rec A") == rec
+    mr.convert_records("json")
+    assert filetree.exists(os.path.join(record_folder, f"Rec A{record_ext}"))
+    assert not filetree.exists(os.path.join(record_folder, f"Rec A{compact_record_ext}"))
+    assert Record.load_from(filetree.path, "Rec A") == rec
+
+
+def test_convert_records_stopped(filetree):
+    filetree.dir("source_data").file("junkA").build()
+    mr = MetaRecord.create_new(filetree.path)
+    rec = Record(filetree.path, "Rec A", "Rec A Data")
+    rec.add_file(filetree.relpath("source_data/junkA"), "source_data/junkA")
+    rec.save(mr)
+    mr.save()
+
+    def stop(converted):
+        raise JobCancelled()
+
+    with pytest.raises(JobCancelled):
+        mr.convert_records(format_compact, on_record=stop)
+    assert mr.record_format == format_json
+    assert MetaRecord.load_from(filetree.path).record_format == format_json
+    assert Record.load_from(filetree.path, "Rec A") == rec
+
+def test_convert_records_in_background(filetree):
+    filetree.dir("source_data").file("junkA").build()
+    mr = MetaRecord.create_new(filetree.path)
+    rec = Record(filetree.path, "Rec A", "Rec A Data")
+    rec.add_file(filetree.relpath("source_data/junkA"), "source_data/junkA")
+    rec.save(mr)
+    mr.save()
+    converter = RecordConverter(mr, format_compact)
+    updates = converter.convert()
+    converter.wait_for_completion()
+    assert [u.message for u in updates.queue] == ["Converted Rec A", "Complete!"]
+    assert filetree.exists(os.path.join(record_folder, f"Rec A{compact_record_ext}"))
+    assert Record.load_from(filetree.path, "Rec A") == rec
+
+
+def test_iter_diff(filetree):
+    old = Record(filetree.path, "Rec A", "Rec A Data", files=[
+        FileData("same", "01", "Rec A"),
+        FileData("changed", "02", "Rec A"),
+        FileData("removed", "03", "Rec A")
+    ])
+    new = Record(filetree.path, "Rec B", "Rec B Data", files=[
+        FileData("added", "04", "Rec B"),
+        FileData("changed", "05", "Rec B"),
+        FileData("same", "01", "Rec A")
+    ])
+    diff = [(kind, o.file if o else None, n.file if n else None) for kind, o, n in old.iter_diff(new)]
+    assert diff == [
+        (diff_unchanged, "same", "same"),
+        (diff_changed, "changed", "changed"),
+        (diff_removed, "removed", None),
+        (diff_added, None, "added")
+    ]
+    add, chg, rm, uchg = old.file_diff(new)
+    assert [f.file for f in add] == ["added"]
+    assert [(o.hash, n.hash) for o, n in chg] == [("02", "05")]
+    assert [f.file for f in rm] == ["removed"]
+    assert [(o.file, n.file) for o, n in uchg] == [("same", "same")]
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_record_loader(filetree, processes):
+    filetree.dir("records").build()
+    mr = MetaRecord.create_new(filetree.path)
+    names = [f"Rec {i}" for i in range(6)]
+    for i, name in enumerate(names):
+        Record(filetree.path, name, f"{name} Data", files=[FileData(f"file_{i}", f"{i:02}", name)]).save(mr)
+    mr.save()
+    loader = mr.loader(workers=3, processes=processes)
+    assert [r.name for r in loader.load_all(names)] == names
+    assert [r.name for r in loader.iter_records(reversed(names), prefetch=2)] == list(reversed(names))
+    pairs = list(loader.iter_pairs(names))
+    assert [(a.name, b.name) for a, b in pairs] == list(zip(names, names[1:]))
+    assert all(pairs[i][1] is pairs[i + 1][0] for i in range(len(pairs) - 1))
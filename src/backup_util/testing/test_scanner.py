@@ -0,0 +1,44 @@
+import os
+import shutil
+
+import pytest
+
+from backup_util.testing.FileTree import FileTree
+from backup_util.utils.scanner import scan_tree
+
+
+@pytest.fixture()
+def filetree(tmp_path):
+    return FileTree(str(tmp_path))
+
+
+def test_scan_order(filetree):
+    filetree.dir("src").file("b").file("a").dir("sub").file("c").up().dir("empty").build()
+    entries = list(scan_tree(filetree.relpath("src")))
+    assert [(e.relpath, e.is_dir) for e in entries] == [
+        ("a", False), ("b", False), ("empty", True), ("sub", True), (os.path.join("sub", "c"), False)]
+    for e in entries:
+        assert e.path == filetree.relpath("src", e.relpath)
+        assert e.stat.st_size == os.stat(e.path).st_size
+
+
+def test_scan_prunes_ignored(filetree):
+    filetree.dir("src").file("keep.txt").file("skip.tmp").dir("cache").file("inner.txt").build()
+    listed = []
+
+    def ignore(path, names):
+        listed.append(os.path.relpath(path, filetree.relpath("src")))
+        return shutil.ignore_patterns("*.tmp", "cache")(path, names)
+
+    assert [e.relpath for e in scan_tree(filetree.relpath("src"), ignore)] == ["keep.txt"]
+    assert listed == ["."]  # The excluded directory was never listed
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink") or os.name == "nt", reason="Symbolic links need privileges")
+def test_scan_symlinks(filetree):
+    filetree.dir("src").file("file").dir("sub").file("inner").build()
+    os.symlink(filetree.relpath("src", "file"), filetree.relpath("src", "link"))
+    os.symlink(filetree.relpath("missing"), filetree.relpath("src", "dangling"))
+    os.symlink(filetree.relpath("src"), filetree.relpath("src", "sub", "loop"))
+    entries = {e.relpath: e.is_dir for e in scan_tree(filetree.relpath("src"))}
+    assert entries == {"file": False, "link": False, "sub": True, os.path.join("sub", "inner"): False}
@@ -0,0 +1,246 @@
+import datetime
+import importlib
+import logging
+import os
+import shutil
+
+import pytest
+
+from backup_util.managed import ManagedBackup, MetaRecord, Rebuilder, RunJournal
+from backup_util.managed.cleaner import Cleaner
+from backup_util.managed.records import record_folder, Record
+from backup_util.managed.segments import SegmentStore
+from backup_util.testing.FileTree import FileTree
+from backup_util.testing.testutils import run_backup
+from backup_util.utils.datautils import hash_file
+
+log = logging.getLogger(__name__)
+
+
+@pytest.fixture()
+def filetree(tmp_path):
+    return FileTree(str(tmp_path))
+
+
+def test_store_read_and_restore(filetree):
+    filetree.build()
+    store = SegmentStore(filetree.path)
+    writer = store.writer(max_size=10)
+    first = writer.append(b"a" * 8, "data_1", "a.txt", {"hash": "aa"})
+    second = writer.append(b"b" * 8, "data_1", "b.txt")  # Does not fit, so a new segment is started
+    third = writer.append(b"c" * 2, "data_2", "c.txt")
+    writer.close()
+    assert first[0] != second[0]
+    assert second[0] == third[0] and third[1] == 8
+    assert store.read(third) == b"cc"
+    store.restore_file(first, filetree.relpath("restored"))
+    assert filetree.content("restored") == ["a" * 8]
+    assert sorted(store.all_segments()) == sorted([first[0], second[0]])
+    assert store.index(first[0]) == [{"folder": "data_1", "file": "a.txt", "offset": 0, "length": 8, "hash": "aa"}]
+    found = store.entries_by_folder({"data_2"})
+    assert list(found) == ["data_2"] and [e["file"] for _, e in found["data_2"]] == ["c.txt"]
+    assert store.remove(first[0]) > 8
+    assert list(store.all_segments()) == [second[0]]
+
+
+def test_backup_packed(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("small1", value="a" * 100) \
+        .file("small2", value="b" * 100) \
+        .file("large", value="c" * 5000) \
+        .up() \
+        .dir("dest1") \
+        .build()
+    first = run_backup(filetree, pack_threshold=1024).last_record
+    mr = MetaRecord.load_from(filetree.relpath("dest1"))
+    assert mr.packs_files()
+    assert sorted(os.listdir(filetree.relpath("dest1", first.folder, "testdir1"))) == ["large"]
+    small = first.get_file("testdir1/small1")
+    assert small.segment is not None and first.get_file("testdir1/large").segment is None
+    mr.restore_file(small, filetree.relpath("restored"))
+    assert filetree.content("restored") == ["a" * 100]
+
+    with open(filetree.relpath("testdir1/small2"), "w") as f:
+        f.write("d" * 100)
+    second = run_backup(filetree, pack_threshold=1024).last_record
+    unchanged, changed = second.get_file("testdir1/small1"), second.get_file("testdir1/small2")
+    assert unchanged.segment == small.segment and unchanged.source == first.name
+    assert changed.source == second.name and changed.segment[0] != small.segment[0]
+    assert changed.hash == hash_file(filetree.relpath("testdir1/small2"))
+    mr.restore_file(changed, filetree.relpath("restored"))
+    assert filetree.content("restored") == ["d" * 100]
+
+
+def test_rebuild_packed(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("small", value="a" * 100) \
+        .file("large", value="c" * 5000) \
+        .up() \
+        .dir("dest1") \
+        .build()
+    rec = run_backup(filetree, pack_threshold=1024).last_record
+    shutil.rmtree(filetree.relpath("dest1", record_folder))
+    mr = MetaRecord.create_new(filetree.relpath("dest1"), pack_threshold=1024)
+    mr.save()
+    rb = Rebuilder(mr)
+    assert [r.folder for r in rb.records()] == [rec.folder]
+    rb.generate_records()
+    rb.wait_for_completion()
+    rebuilt = MetaRecord.load_from(filetree.relpath("dest1")).load_latest_record()
+    assert sorted(f.file for f in rebuilt.files) == ["testdir1/large", "testdir1/small"]
+    assert rebuilt.get_file("testdir1/small").segment == rec.get_file("testdir1/small").segment
+    assert rebuilt.get_file("testdir1/small").hash == rec.get_file("testdir1/small").hash
+
+
+def test_clean_compacts_segments(filetree):
+    filetree \
+        .dir("testdir1") \
+        .file("dup", value="a" * 900) \
+        .file("new", value="b" * 100) \
+        .up() \
+        .dir("dest1") \
+        .build()
+    mr = MetaRecord.create_new(filetree.relpath("dest1"), pack_threshold=1024)
+    store = mr.segment_store()
+    segments = []
+    for name, folder, day, files in (("Rec A", "data_a", 1, ["dup"]), ("Rec B", "data_b", 2, ["dup", "new"])):
+        rec = Record(mr.path, name, folder, datetime.datetime(2020, 1, day), hash_algorithm=mr.hash_algorithm)
+        writer = store.writer()
+        for file in files:
+            path = filetree.relpath("testdir1", file)
+            with open(path, "rb") as f:
+                rec.add_file(path, file).segment = writer.append(f.read(), folder, file)
+        writer.close()
+        segments.append(writer.segment_id)
+        rec.save(mr)
+    mr.save()
+    cln = Cleaner(mr)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    cln.perform_clean()
+    cln.wait_for_completion()
+    assert cln.reclaimed_bytes >= 900
+
+    # The copy of dup in the second segment is not used any more, so the segment is rewritten without it
+    assert list(store.all_segments()) != [] and segments[1] not in store.all_segments()
+    kept = Record.load_from(mr.path, "Rec B")
+    assert kept.get_file("dup").segment[0] == segments[0]
+    for name, value in (("dup", "a" * 900), ("new", "b" * 100)):
+        f = kept.get_file(name)
+        assert f.segment[0] in store.all_segments()
+        mr.restore_file(f, filetree.relpath("restored"))
+        assert filetree.content("restored") == [value]
+
+
+def test_clean_keeps_unrecorded_segments(filetree, monkeypatch):
+    filetree \
+        .dir("testdir1") \
+        .file("small1", value="a" * 100) \
+        .file("small2", value="b" * 100) \
+        .up() \
+        .dir("dest1") \
+        .build()
+    run_backup(filetree, pack_threshold=1024)
+    with open(filetree.relpath("testdir1/small2"), "w") as f:
+        f.write("c" * 100)
+    managed_module = importlib.import_module("backup_util.managed.ManagedBackup")
+    save = managed_module.Record.save
+
+    def crash(*args, **kwargs):
+        raise RuntimeError("Crashed before the record was saved")
+
+    monkeypatch.setattr(managed_module.Record, "save", crash)
+    b = ManagedBackup(dry_run=False, pack_threshold=1024)
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    b.execute()
+    assert isinstance(b.thread.join(), RuntimeError)
+    monkeypatch.setattr(managed_module.Record, "save", save)
+
+    mr = MetaRecord.load_from(filetree.relpath("dest1"))
+    segments = sorted(mr.segment_store().all_segments())
+    assert len(segments) == 2
+    cln = Cleaner(mr)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    cln.perform_clean()
+    cln.wait_for_completion()
+    assert sorted(mr.segment_store().all_segments()) == segments
+
+    os.remove(RunJournal.find_unfinished(mr.path))  # Without the journal, the folder still has no record
+    cln = Cleaner(mr)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    cln.perform_clean()
+    cln.wait_for_completion()
+    assert sorted(mr.segment_store().all_segments()) == segments
+
+
+def test_resume_after_clean(filetree, monkeypatch):
+    filetree \
+        .dir("testdir1") \
+        .file("small1", value="a" * 100) \
+        .file("small2", value="b" * 100) \
+        .up() \
+        .dir("dest1") \
+        .build()
+    run_backup(filetree, pack_threshold=1024)
+    with open(filetree.relpath("testdir1/small2"), "w") as f:
+        f.write("c" * 100)
+    managed_module = importlib.import_module("backup_util.managed.ManagedBackup")
+    save = managed_module.Record.save
+
+    def crash(*args, **kwargs):
+        raise RuntimeError("Crashed before the record was saved")
+
+    monkeypatch.setattr(managed_module.Record, "save", crash)
+    b = ManagedBackup(dry_run=False, pack_threshold=1024)
+    b.add_source(filetree.relpath("testdir1"))
+    b.set_destination(filetree.relpath("dest1"))
+    b.execute()
+    assert isinstance(b.thread.join(), RuntimeError)
+    monkeypatch.setattr(managed_module.Record, "save", save)
+
+    mr = MetaRecord.load_from(filetree.relpath("dest1"))
+    cln = Cleaner(mr)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    cln.perform_clean()
+    cln.wait_for_completion()
+
+    rec = run_backup(filetree, pack_threshold=1024).last_record
+    mr = MetaRecord.load_from(filetree.relpath("dest1"))
+    for name, value in (("small1", "a" * 100), ("small2", "c" * 100)):
+        mr.restore_file(rec.get_file(f"testdir1/{name}"), filetree.relpath("restored"))
+        assert filetree.content("restored") == [value]
+
+
+def test_clean_moves_to_packed_copy(filetree):
+    filetree \
+        .dir("dest1") \
+        .dir("data_b") \
+        .file("small", value="a" * 100) \
+        .build()
+    mr = MetaRecord.create_new(filetree.relpath("dest1"), pack_threshold=1024)
+    path = filetree.relpath("dest1", "data_b", "small")
+    writer = mr.segment_store().writer()
+    older = Record(mr.path, "Rec A", "data_a", datetime.datetime(2020, 1, 1), hash_algorithm=mr.hash_algorithm)
+    older.add_file(path, "small").segment = writer.append(b"a" * 100, "data_a", "small")
+    writer.close()
+    newer = Record(mr.path, "Rec B", "data_b", datetime.datetime(2020, 1, 2), hash_algorithm=mr.hash_algorithm)
+    newer.add_file(path, "small")
+    older.save(mr)
+    newer.save(mr)
+    mr.save()
+    cln = Cleaner(mr)
+    cln.generate_diffs()
+    cln.wait_for_completion()
+    cln.perform_clean()
+    cln.wait_for_completion()
+    assert not os.path.exists(path)
+    cleaned = Record.load_from(mr.path, "Rec B").get_file("small")
+    assert cleaned.source == "Rec A" and cleaned.segment == older.get_file("small").segment
+    mr.restore_file(cleaned, filetree.relpath("restored"))
+    assert filetree.content("restored") == ["a" * 100]
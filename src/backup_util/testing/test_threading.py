@@ -0,0 +1,65 @@
+import logging
+from queue import Queue
+from threading import Thread
+
+import pytest
+
+from backup_util.utils.threading import ProgressReporter, counter_scanned, counter_copied, counter_bytes, \
+    CancelToken, JobCancelled
+
+log = logging.getLogger(__name__)
+
+
+def drain(queue: Queue) -> list:
+    updates = []
+    while not queue.empty():
+        updates.append(queue.get_nowait())
+    return updates
+
+
+def test_progress_reporter_coalesces():
+    queue = Queue()
+    progress = ProgressReporter(queue, interval=3600)
+    for i in range(1000):
+        progress.count(counter_scanned, message=f"file {i}")
+        progress.count(counter_copied)
+        progress.count(counter_bytes, 10)
+    updates = drain(queue)
+    assert len(updates) == 1  # Only the first change is posted within an interval
+    progress.flush()
+    updates = drain(queue)
+    assert len(updates) == 1
+    assert updates[0].is_minor()
+    assert updates[0].message.startswith("file 999")
+    assert updates[0].counters[counter_scanned] == 1000
+    assert updates[0].counters[counter_bytes] == 10000
+    progress.flush()
+    assert queue.empty()  # Nothing changed since the last post
+
+
+def test_progress_reporter_interval():
+    queue = Queue()
+    progress = ProgressReporter(queue, interval=0)
+    for i in range(5):
+        progress.update(f"file {i}")
+    assert [u.message.split(" [")[0] for u in drain(queue)] == [f"file {i}" for i in range(5)]
+
+
+def test_cancel_token_pause_and_cancel():
+    token = CancelToken()
+    token.check()
+    token.pause()
+    assert token.is_paused()
+    checked = []
+    waiter = Thread(target=lambda: checked.append(token.check()))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()  # Blocked while paused
+    token.resume()
+    waiter.join(5)
+    assert checked == [None]
+    token.pause()
+    token.cancel()  # Wakes a paused job so it can stop
+    assert not token.is_paused()
+    with pytest.raises(JobCancelled):
+        token.check()
@@ -1,4 +1,8 @@
 import os
+from time import sleep
+
+from backup_util.managed import ManagedBackup
+from backup_util.testing.FileTree import FileTree
 
 
 # From https://stackoverflow.com/questions/9727673/list-directory-tree-structure-in-python
@@ -12,3 +16,22 @@ def list_files(startpath: str) -> str:
         for f in files:
             res += '{}{}\n'.format(subindent, f)
     return res
+
+
+def run_backup(filetree: FileTree, source: str = "testdir1", destination: str = "dest1", **options) -> ManagedBackup:
+    """
+    Run a managed backup of a folder of a file tree and wait for it to finish
+
+    :param filetree: the file tree holding the source and destination
+    :param source: the source folder, relative to the file tree
+    :param destination: the destination folder, relative to the file tree
+    :param options: keyword arguments passed to `ManagedBackup`
+    :return: the finished backup
+    """
+    b = ManagedBackup(dry_run=False, **options)
+    b.add_source(filetree.relpath(source))
+    b.set_destination(filetree.relpath(destination))
+    b.execute()
+    b.wait_for_completion()
+    sleep(1)  # Data folders are named by the second
+    return b
@@ -1,10 +1,11 @@
 import queue
 from queue import Queue
 from tkinter import BOTTOM, X, TOP, StringVar, W, DoubleVar, RIGHT, BooleanVar, LEFT, filedialog as filedialog
-from tkinter.ttk import Frame, Label, Button, Checkbutton, Progressbar
+from tkinter.ttk import Frame, Label, Button, Checkbutton, Progressbar, Spinbox, Combobox
 from typing import Union
 
 from backup_util.Backup import Backup
+from backup_util.utils.datautils import hash_algorithms
 from backup_util.utils.threading import AsyncUpdate
 from backup_util.managed import ManagedBackup
 from backup_util.exception.ValidationException import ValidationException
@@ -31,6 +32,11 @@ class ActionFrame(Frame):
         self.lbl_statmin = Label(self.frm_prog, textvariable=self.var_statmin)
         self.lbl_statmin.pack(anchor=W)
 
+        self.var_throughput = StringVar()
+        self.var_throughput.set("")
+        self.lbl_throughput = Label(self.frm_prog, textvariable=self.var_throughput)
+        self.lbl_throughput.pack(anchor=W)
+
         self.var_prog = DoubleVar()
         self.var_prog.set(0)
         self.prog_stat = Progressbar(self.frm_prog, maximum=100, variable=self.var_prog)
@@ -49,11 +55,43 @@ class ActionFrame(Frame):
         self.btn_run = Button(self.frm_btns, text="Run", command=do_backup)
         self.btn_run.pack(side=RIGHT)
 
+        self.btn_cancel = Button(self.frm_btns, text="Cancel", command=self.cancel_backup)
+        self.btn_cancel.pack(side=RIGHT)
+
+        self.btn_pause = Button(self.frm_btns, text="Pause", command=self.toggle_pause)
+        self.btn_pause.pack(side=RIGHT)
+
         self.var_dry = BooleanVar()
         self.var_dry.set(True)
         self.chk_dry = Checkbutton(self.frm_btns, text="Dry Run", variable=self.var_dry, onvalue=True, offvalue=False)
         self.chk_dry.pack(side=RIGHT)
 
+        self.var_paranoid = BooleanVar()
+        self.var_paranoid.set(False)
+        self.chk_paranoid = Checkbutton(self.frm_btns, text="Full Rehash", variable=self.var_paranoid, onvalue=True,
+                                        offvalue=False)
+        self.chk_paranoid.pack(side=RIGHT)
+
+        self.chk_prescan = Checkbutton(self.frm_btns, text="Pre-scan", variable=self.model.var_prescan, onvalue=True,
+                                       offvalue=False)
+        self.chk_prescan.pack(side=RIGHT)
+
+        self.chk_processes = Checkbutton(self.frm_btns, text="Processes", variable=self.model.var_hash_processes,
+                                         onvalue=True, offvalue=False)
+        self.chk_processes.pack(side=RIGHT)
+
+        self.spn_workers = Spinbox(self.frm_btns, from_=1, to=64, width=4, textvariable=self.model.var_hash_workers)
+        self.spn_workers.pack(side=RIGHT)
+        self.lbl_workers = Label(self.frm_btns, text="Hash Workers")
+        self.lbl_workers.pack(side=RIGHT)
+
+        # Only used for destinations that are not managed yet, managed ones keep the algorithm of their metarecord
+        self.cmb_algorithm = Combobox(self.frm_btns, values=hash_algorithms, width=8, state="readonly",
+                                      textvariable=self.model.var_hash_algorithm)
+        self.cmb_algorithm.pack(side=RIGHT)
+        self.lbl_algorithm = Label(self.frm_btns, text="Hash")
+        self.lbl_algorithm.pack(side=RIGHT)
+
         self.btn_run = Button(self.frm_btns, text="Load", command=self.load_backup)
         self.btn_run.pack(side=LEFT)
 
@@ -61,18 +99,25 @@ class ActionFrame(Frame):
         self.btn_run.pack(side=LEFT)
 
         self.bk: Union[Backup, None] = None
+        self.byte_progress = False
 
     def load_backup(self):
         file: str = filedialog.askopenfilename(title="Save Configuration",
                                                filetypes=(("JSON files", "*.json"), ("All Files", "*.*")))
         if file is not None and len(file.strip()) > 0:
             src, exc, dest, dry, wrap = Backup.load_from_json(file)
+            options = Backup.load_options_from_json(file)
             self.model.lstvar_src.set(src)
             self.model.lstvar_exc.set(exc)
             self.model.var_dest.set(dest)
             self.var_dry.set(dry)
             self.model.var_wrap.set(wrap)
             self.model.var_managed.set(MetaRecord.is_managed(dest))
+            self.model.var_hash_workers.set(options["hash_workers"])
+            self.model.var_hash_processes.set(options["hash_processes"])
+            self.model.var_hardlink.set(options["hardlink"])
+            self.model.var_prescan.set(options["prescan"])
+            self.model.var_hash_algorithm.set(options["hash_algorithm"])
 
     def save_backup(self):
         file: str = filedialog.asksaveasfilename(title="Save Configuration",
@@ -84,14 +129,27 @@ class ActionFrame(Frame):
                                 self.model.lstvar_exc.get(),
                                 self.model.var_dest.get(),
                                 self.var_dry.get(),
-                                self.model.var_wrap.get())
+                                self.model.var_wrap.get(),
+                                self.model.var_hash_workers.get(),
+                                self.model.var_hash_processes.get(),
+                                self.model.var_hardlink.get(),
+                                self.model.var_prescan.get(),
+                                self.model.var_hash_algorithm.get())
 
     def run_backup(self, sources: list, exceptions: list, destination: str, managed: bool):
         self.var_prog.set(0)
         self.var_stat.set("Ready")
+        self.var_throughput.set("")
+        self.byte_progress = False
         self.bk = \
-            Backup(dry_run=self.var_dry.get(), use_wrapper=self.model.var_wrap.get()) if not managed else \
-            ManagedBackup(dry_run=self.var_dry.get())
+            Backup(dry_run=self.var_dry.get(), use_wrapper=self.model.var_wrap.get(),
+                   prescan=self.model.var_prescan.get()) if not managed else \
+            ManagedBackup(dry_run=self.var_dry.get(), paranoid=self.var_paranoid.get(),
+                          hash_workers=self.model.var_hash_workers.get(),
+                          hash_processes=self.model.var_hash_processes.get(),
+                          hash_algorithm=self.model.var_hash_algorithm.get(),
+                          hardlink=self.model.var_hardlink.get(),
+                          prescan=self.model.var_prescan.get())
         for s in sources:
             self.bk.add_source(s)
         for e in exceptions:
@@ -103,15 +161,36 @@ class ActionFrame(Frame):
         except ValidationException as e:
             self.var_stat.set(e.args[0])
 
+    def cancel_backup(self):
+        if self.bk is not None and self.bk.is_running():
+            self.bk.cancel()
+            self.var_stat.set("Cancelling...")
+
+    def toggle_pause(self):
+        if self.bk is None or not self.bk.is_running():
+            return
+        if self.bk.is_paused():
+            self.bk.resume()
+            self.btn_pause.configure(text="Pause")
+        else:
+            self.bk.pause()
+            self.btn_pause.configure(text="Resume")
+
     def listen_for_result(self, data_queue: Queue):
         try:
             while not data_queue.empty():
                 res: AsyncUpdate = data_queue.get_nowait()
                 if not res.is_minor():
                     self.var_stat.set(f"[{res.get_completion()}%] {res.message}")
-                    self.var_prog.set(res.get_completion())
+                    if not self.byte_progress:
+                        self.var_prog.set(res.get_completion())
                 else:
                     self.var_statmin.set(f"|> {res.message}")
+                    if res.bytes_done is not None:
+                        self.var_throughput.set(res.describe_throughput())
+                    if res.has_bytes():  # Bytes are finer grained than the number of sources done
+                        self.byte_progress = True
+                        self.var_prog.set(res.get_byte_completion())
         except queue.Empty:
             pass
         finally:
@@ -119,3 +198,4 @@ class ActionFrame(Frame):
                 self.after(100, lambda: self.listen_for_result(data_queue))
             else:
                 self.bk = None
+                self.btn_pause.configure(text="Pause")
@@ -26,36 +26,57 @@ class CleanDialog(Frame):
         self.btn_include = Button(self.frm_btns, text="Perform Clean", command=self._perform_clean)
         self.btn_include.pack(side=RIGHT, anchor=W)
 
+        self.btn_pause = Button(self.frm_btns, text="Pause", command=self._toggle_pause)
+        self.btn_pause.pack(side=RIGHT, anchor=W)
+
+        self.btn_cancel = Button(self.frm_btns, text="Cancel", command=self._cancel)
+        self.btn_cancel.pack(side=RIGHT, anchor=W)
+
         self.frm_status = StatusFrame(self)
         self.frm_status.pack(side=TOP, anchor=N, fill=X, expand=True)
 
         self.cleaner = Cleaner(mr)
+        self.byte_progress = False
         self._setup_tree()
 
     def _perform_clean(self):
         res = askyesno("Folder Manager - Clean", f"Perform clean on {self.cleaner.file_count()} files?")
         if res:
+            self.byte_progress = False
             queue = self.cleaner.perform_clean()
             self.listen_for_result(queue)
         else:
             showinfo("Folder Manager - Clean", "Aborting cleanup")
 
+    def _cancel(self):
+        if self.cleaner.is_running():
+            self.cleaner.cancel()
+            self.frm_status.set_major("Cancelling...")
+
+    def _toggle_pause(self):
+        if not self.cleaner.is_running():
+            return
+        if self.cleaner.is_paused():
+            self.cleaner.resume()
+            self.btn_pause.configure(text="Pause")
+        else:
+            self.cleaner.pause()
+            self.btn_pause.configure(text="Resume")
+
     def listen_for_result(self, data_queue: Queue, on_complete: Optional[Callable] = None):
         try:
             while not data_queue.empty():
                 res: AsyncUpdate = data_queue.get_nowait()
-                if not res.is_minor():
-                    self.frm_status.set_major(f"[{res.get_completion()}%] {res.message}")
-                    self.frm_status.set_progress(res.get_completion())
-                else:
-                    self.frm_status.set_minor(f"|> {res.message}")
+                self.byte_progress = self.frm_status.show_update(res, self.byte_progress)
         except Empty:
             pass
         finally:
             if self.cleaner.thread is not None and (self.cleaner.thread.is_alive() or not data_queue.empty()):
                 self.after(100, lambda: self.listen_for_result(data_queue, on_complete))
-            elif on_complete is not None:
-                on_complete()
+            else:
+                self.btn_pause.configure(text="Pause")
+                if on_complete is not None:
+                    on_complete()
 
     def _setup_tree(self):
         queue = self.cleaner.generate_diffs()
@@ -65,6 +86,8 @@ class CleanDialog(Frame):
                 parent = self.tree.insert("", END, text=r.name)
                 for f in files:
                     self.tree.insert(parent, END, text=f)
+            if len(self.cleaner.orphan_chunks) > 0:
+                self.tree.insert("", END, text=f"{len(self.cleaner.orphan_chunks)} unreferenced chunks")
 
         self.listen_for_result(queue, update_table)
 
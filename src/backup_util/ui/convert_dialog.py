@@ -0,0 +1,52 @@
+from queue import Queue, Empty
+from tkinter import TOP, N, BOTH, Toplevel, BOTTOM, S, RIGHT, W, X
+from tkinter.ttk import Frame, Button
+
+from backup_util.managed import MetaRecord
+from backup_util.managed.converter import RecordConverter
+from backup_util.utils.threading import AsyncUpdate
+from .status_frame import StatusFrame
+
+
+class ConvertDialog(Frame):
+    def __init__(self, root, mr: MetaRecord, record_format: str):
+        super().__init__(root, padding=10)
+        self.pack(side=TOP, anchor=N, fill=BOTH, expand=True)
+        self.metarecord = mr
+
+        self.frm_btns = Frame(self, padding=5)
+        self.frm_btns.pack(side=BOTTOM, anchor=S)
+
+        self.btn_cancel = Button(self.frm_btns, text="Cancel", command=self._cancel)
+        self.btn_cancel.pack(side=RIGHT, anchor=W)
+
+        self.frm_status = StatusFrame(self)
+        self.frm_status.pack(side=TOP, anchor=N, fill=X, expand=True)
+
+        self.converter = RecordConverter(mr, record_format)
+        self.listen_for_result(self.converter.convert())
+
+    def _cancel(self):
+        if self.converter.is_running():
+            self.converter.cancel()
+            self.frm_status.set_major("Cancelling...")
+
+    def listen_for_result(self, data_queue: Queue):
+        try:
+            while not data_queue.empty():
+                res: AsyncUpdate = data_queue.get_nowait()
+                self.frm_status.show_update(res)
+        except Empty:
+            pass
+        finally:
+            if self.converter.thread is not None and (self.converter.thread.is_alive() or not data_queue.empty()):
+                self.after(100, lambda: self.listen_for_result(data_queue))
+            else:
+                self.btn_cancel.configure(text="Close", command=self.master.destroy)
+
+    @staticmethod
+    def create_dialog(mr: MetaRecord, record_format: str) -> Toplevel:
+        window = Toplevel()
+        ConvertDialog(window, mr, record_format)
+        window.title("MetaRecord Converter")
+        return window
@@ -18,6 +18,10 @@ class DestinationFrame(LabelFrame):
                                     offvalue=False)
         self.chk_wrap.pack()
 
+        self.chk_hardlink = Checkbutton(self, text="Hard Link Unchanged Files", variable=self.model.var_hardlink,
+                                        onvalue=True, offvalue=False, state="disabled")
+        self.chk_hardlink.pack()
+
         self.btn_dest_browse = Button(self, text="Browse", command=self.set_dest)
         self.btn_dest_browse.pack()
 
@@ -33,9 +37,11 @@ class DestinationFrame(LabelFrame):
         val = self.model.var_managed.get()
         if val:
             self.chk_wrap.configure(state="disabled")
+            self.chk_hardlink.configure(state="normal")
             self.btn_make_managed.configure(text="Already Managed", state="disabled")
         else:
             self.chk_wrap.configure(state="normal")
+            self.chk_hardlink.configure(state="disabled")
             self.btn_make_managed.configure(text="Manage This Folder", state="normal")
 
     def set_dest(self):
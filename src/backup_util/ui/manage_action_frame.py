@@ -3,6 +3,9 @@ from tkinter.messagebox import askyesno
 from tkinter.ttk import Frame, Button, LabelFrame
 
 from backup_util.managed import MetaRecord
+from backup_util.managed.records import layout_chunks, layout_files
+from backup_util.managed.segments import default_pack_threshold
+from backup_util.managed.compression import codec_none, codec_zlib
 from .ui_model import ManageUIModel
 
 
@@ -25,7 +28,18 @@ class ManageActionFrame(LabelFrame):
         elif dest is not None:
             res = askyesno("Folder Manager - Choose Folder", "This folder is not managed yet.\nWould you like to manage this folder?")
             if res:
-                mr = MetaRecord.create_new(dest)
+                chunked = askyesno("Folder Manager - Choose Folder",
+                                   "Store backups as deduplicated chunks?\nChunked folders can only be restored with "
+                                   "this utility.")
+                packed = not chunked and askyesno("Folder Manager - Choose Folder",
+                                                  "Pack small files into segment files?\nPacked files can only be "
+                                                  "restored with this utility.")
+                compressed = not chunked and askyesno("Folder Manager - Choose Folder",
+                                                      "Compress files that are not compressed already?\nCompressed "
+                                                      "files can only be restored with this utility.")
+                mr = MetaRecord.create_new(dest, layout=layout_chunks if chunked else layout_files,
+                                           pack_threshold=default_pack_threshold if packed else 0,
+                                           file_compression=codec_zlib if compressed else codec_none)
                 mr.save()
                 self.model.var_metarecord.set(mr)
             else:
@@ -31,30 +31,51 @@ class RebuildDialog(Frame):
         self.btn_gen = Button(self.frm_btns, text="Generate Records", command=self._generate)
         self.btn_gen.pack(side=RIGHT, anchor=W)
 
+        self.btn_pause = Button(self.frm_btns, text="Pause", command=self._toggle_pause)
+        self.btn_pause.pack(side=RIGHT, anchor=W)
+
+        self.btn_cancel = Button(self.frm_btns, text="Cancel", command=self._cancel)
+        self.btn_cancel.pack(side=RIGHT, anchor=W)
+
         self.frm_status = StatusFrame(self)
         self.frm_status.pack(side=TOP, anchor=N, fill=X, expand=True)
 
-        self.rebuilder = Rebuilder(mr)
+        self.rebuilder = Rebuilder(mr, prescan=True)
+        self.byte_progress = False
         self._setup_tree()
 
     def _generate(self):
+        self.byte_progress = False
         queue = self.rebuilder.generate_records()
         self.listen_for_result(queue)
 
+    def _cancel(self):
+        if self.rebuilder.is_running():
+            self.rebuilder.cancel()
+            self.frm_status.set_major("Cancelling...")
+
+    def _toggle_pause(self):
+        if not self.rebuilder.is_running():
+            return
+        if self.rebuilder.is_paused():
+            self.rebuilder.resume()
+            self.btn_pause.configure(text="Pause")
+        else:
+            self.rebuilder.pause()
+            self.btn_pause.configure(text="Resume")
+
     def listen_for_result(self, data_queue: Queue):
         try:
             while not data_queue.empty():
                 res: AsyncUpdate = data_queue.get_nowait()
-                if not res.is_minor():
-                    self.frm_status.set_major(f"[{res.get_completion()}%] {res.message}")
-                    self.frm_status.set_progress(res.get_completion())
-                else:
-                    self.frm_status.set_minor(f"|> {res.message}")
+                self.byte_progress = self.frm_status.show_update(res, self.byte_progress)
         except queue.Empty:
             pass
         finally:
             if self.rebuilder.thread is not None and (self.rebuilder.thread.is_alive() or not data_queue.empty()):
                 self.after(100, lambda: self.listen_for_result(data_queue))
+            else:
+                self.btn_pause.configure(text="Pause")
 
     def _toggle_include(self):
         for item in self.tree.selection():
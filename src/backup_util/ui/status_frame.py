@@ -1,6 +1,8 @@
 from tkinter import StringVar, W, DoubleVar, X
 from tkinter.ttk import Frame, Label, Progressbar
 
+from backup_util.utils.threading import AsyncUpdate
+
 
 class StatusFrame(Frame):
     def __init__(self, root):
@@ -15,6 +17,11 @@ class StatusFrame(Frame):
         self.lbl_statmin = Label(self, textvariable=self.var_statmin)
         self.lbl_statmin.pack(anchor=W)
 
+        self.var_throughput = StringVar()
+        self.var_throughput.set("")
+        self.lbl_throughput = Label(self, textvariable=self.var_throughput)
+        self.lbl_throughput.pack(anchor=W)
+
         self.var_prog = DoubleVar()
         self.var_prog.set(0)
         self.prog_stat = Progressbar(self, maximum=100, variable=self.var_prog)
@@ -28,3 +35,28 @@ class StatusFrame(Frame):
 
     def set_progress(self, progress):
         self.var_prog.set(progress)
+
+    def set_throughput(self, message):
+        self.var_throughput.set(message)
+
+    def show_update(self, res: AsyncUpdate, byte_progress: bool = False) -> bool:
+        """
+        Show an update from a threaded job. Once an update carries byte totals, the progress bar follows bytes instead
+        of the coarse major progress.
+
+        :param res: the update
+        :param byte_progress: if the progress bar already follows bytes
+        :return: if the progress bar follows bytes after this update
+        """
+        if not res.is_minor():
+            self.set_major(f"[{res.get_completion()}%] {res.message}")
+            if not byte_progress:
+                self.set_progress(res.get_completion())
+        else:
+            self.set_minor(f"|> {res.message}")
+            if res.bytes_done is not None:
+                self.set_throughput(res.describe_throughput())
+            if res.has_bytes():
+                self.set_progress(res.get_byte_completion())
+                return True
+        return byte_progress
@@ -1,9 +1,13 @@
 from tkinter import X, LEFT, BOTH, TOP, N, END
+from tkinter.messagebox import askyesno, showerror
 from tkinter.ttk import Frame, Button, LabelFrame, Treeview
 
 from backup_util.utils.tkutils import load_image
 from backup_util.managed import MetaRecord
+from backup_util.managed.compact import format_compact
+from backup_util.managed.records import layout_chunks
 from .clean_dialog import CleanDialog
+from .convert_dialog import ConvertDialog
 from .rebuild_dialog import RebuildDialog
 from .ui_model import ManageUIModel
 
@@ -29,7 +33,13 @@ class TreeFrame(LabelFrame):
         self.frm_src_btns.pack(fill=X)
 
         def show_rebuilder():
-            RebuildDialog.create_dialog(self.model.var_metarecord.get())
+            mr: MetaRecord = self.model.var_metarecord.get()
+            if mr.layout == layout_chunks:
+                showerror("Folder Manager - Import Previous Backups",
+                          "Backups stored as chunks cannot be imported again, the chunks of each file are only listed "
+                          "in its record.")
+                return
+            RebuildDialog.create_dialog(mr)
 
         self.btn_src_add = Button(self.frm_src_btns, text="Import Previous Backups", command=show_rebuilder)
         self.btn_src_add.pack(side=LEFT)
@@ -40,6 +50,16 @@ class TreeFrame(LabelFrame):
         self.btn_src_add = Button(self.frm_src_btns, text="Remove Redundant Files", command=show_clean)
         self.btn_src_add.pack(side=LEFT)
 
+        def compact_records():
+            mr: MetaRecord = self.model.var_metarecord.get()
+            if askyesno("Folder Manager - Compact Records",
+                        f"Convert {len(mr.records)} records to the compact format?\n"
+                        "Compact records are smaller and faster to load but are not human readable."):
+                ConvertDialog.create_dialog(mr, format_compact)
+
+        self.btn_compact = Button(self.frm_src_btns, text="Compact Records", command=compact_records)
+        self.btn_compact.pack(side=LEFT)
+
         self.model.var_metarecord.trace_add(self._metarecord_changed)
 
     def do_pack(self):
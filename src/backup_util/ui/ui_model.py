@@ -1,5 +1,7 @@
-from tkinter import StringVar, BooleanVar, Variable
+from tkinter import StringVar, BooleanVar, Variable, IntVar
 
+from backup_util.utils.datautils import default_hash_algorithm
+from backup_util.utils.threading import default_workers
 from backup_util.utils.tkutils import WatchedVariable
 
 
@@ -20,6 +22,21 @@ class ConfigUIModel:
         self.var_managed = BooleanVar()
         self.var_managed.set(False)
 
+        self.var_hash_workers = IntVar()
+        self.var_hash_workers.set(default_workers())
+
+        self.var_hash_processes = BooleanVar()
+        self.var_hash_processes.set(False)
+
+        self.var_hardlink = BooleanVar()
+        self.var_hardlink.set(False)
+
+        self.var_prescan = BooleanVar()
+        self.var_prescan.set(False)
+
+        self.var_hash_algorithm = StringVar()
+        self.var_hash_algorithm.set(default_hash_algorithm)
+
 
 class ManageUIModel:
     def __init__(self):
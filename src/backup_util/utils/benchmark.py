@@ -0,0 +1,163 @@
+"""
+Micro-benchmarks for the I/O heavy parts of backups. Run with `python -m backup_util.utils.benchmark <name>` from the
+`src` folder, e.g. `python -m backup_util.utils.benchmark hash --size 512`.
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import List, Optional, Callable, Tuple
+
+from backup_util.utils.datautils import hash_file, new_hasher, default_hash_algorithm
+from backup_util.utils.exclusions import Exclusions
+
+default_block_sizes = [4 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def _legacy_hash_file(path: str, algorithm: str) -> str:
+    hasher = new_hasher(algorithm)
+    with open(path, "rb") as f:
+        for byte_block in iter(lambda: f.read(4096), b""):
+            hasher.update(byte_block)
+        return hasher.hexdigest()
+
+
+def _time(func: Callable[[], object], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_hash(path: str, algorithm: str = default_hash_algorithm, block_sizes: Optional[List[int]] = None,
+               repeat: int = 3) -> List[Tuple[str, float]]:
+    """
+    Measure hashing throughput of a file for several read strategies. The best of `repeat` runs is kept, so the file
+    is normally served from the page cache and the results show the CPU and syscall cost of each strategy.
+
+    :param path: the file to hash
+    :param algorithm: the hash algorithm to use
+    :param block_sizes: the buffer sizes to try with `readinto`
+    :param repeat: the number of runs of each strategy
+    :return: a list of (strategy, GB/s)
+    """
+    size = os.path.getsize(path)
+    gigabytes = size / (1024 ** 3)
+    results = [("read(4096) [legacy]", gigabytes / _time(lambda: _legacy_hash_file(path, algorithm), repeat))]
+    for block_size in block_sizes if block_sizes is not None else default_block_sizes:
+        elapsed = _time(lambda: hash_file(path, algorithm, block_size, mmap_threshold=None), repeat)
+        results.append((f"readinto({block_size // 1024} KiB)", gigabytes / elapsed))
+    results.append(("mmap", gigabytes / _time(lambda: hash_file(path, algorithm, mmap_threshold=0), repeat)))
+    return results
+
+
+def make_rules(count: int) -> List[str]:
+    """
+    Make exclusion rules shaped like real ones: directory names, extensions and a few other globs
+
+    :param count: the number of rules
+    :return: the rules
+    """
+    rules = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            rules.append(f"cache_{i}")
+        elif kind == 1:
+            rules.append(f"*.ext{i}")
+        elif kind == 2:
+            rules.append(f"tmp{i}_*")
+        else:
+            rules.append(f"build{i}?")
+    return rules
+
+
+def make_names(count: int, rules: List[str], seed: int = 0) -> List[str]:
+    """
+    Make file names of which about one in ten is excluded by the rules of `make_rules`
+
+    :param count: the number of names
+    :param rules: the rules the excluded names are made for
+    :param seed: the seed of the random generator
+    :return: the names
+    """
+    rand = random.Random(seed)
+    names = []
+    for i in range(count):
+        if rand.random() < 0.1:
+            names.append(rand.choice(rules).replace("*", "x").replace("?", "1"))
+        else:
+            names.append(f"file_{i}.{rand.choice(['txt', 'py', 'jpg', 'log'])}")
+    return names
+
+
+def bench_exclusions(rules: List[str], names: List[str], repeat: int = 3) -> List[Tuple[str, float]]:
+    """
+    Measure how fast names are excluded with `shutil.ignore_patterns` and with the compiled `Exclusions`
+
+    :param rules: the exclusion rules
+    :param names: the names of one directory
+    :param repeat: the number of runs of each matcher
+    :return: a list of (matcher, names per second)
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        ignore_patterns = shutil.ignore_patterns(*rules)
+        exclusions = Exclusions(rules, ignore_file=None)
+        matcher = exclusions.for_tree(tmp)
+        expected = ignore_patterns(tmp, names)
+        if matcher(tmp, names) != set(expected):
+            raise AssertionError("The matchers exclude different names")
+        return [
+            ("ignore_patterns", len(names) / _time(lambda: ignore_patterns(tmp, names), repeat)),
+            ("compile", 1 / _time(lambda: Exclusions(rules, ignore_file=None), repeat)),
+            ("Exclusions", len(names) / _time(lambda: matcher(tmp, names), repeat))
+        ]
+
+
+def _make_file(directory: str, size_mb: int) -> str:
+    path = os.path.join(directory, "hash_bench.bin")
+    chunk = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(chunk)
+    return path
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Backup utility micro-benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    hash_parser = commands.add_parser("hash", help="hashing throughput for several block sizes")
+    hash_parser.add_argument("--path", help="file to hash. A random file is generated if not set")
+    hash_parser.add_argument("--size", type=int, default=256, help="size in MiB of the generated file")
+    hash_parser.add_argument("--algorithm", default=default_hash_algorithm)
+    hash_parser.add_argument("--repeat", type=int, default=3)
+
+    exclusions_parser = commands.add_parser("exclusions", help="exclusion matching speed for many rules")
+    exclusions_parser.add_argument("--rules", type=int, default=300, help="number of rules")
+    exclusions_parser.add_argument("--names", type=int, default=100000, help="number of names matched")
+    exclusions_parser.add_argument("--repeat", type=int, default=3)
+
+    args = parser.parse_args(argv)
+    if args.command == "hash":
+        with tempfile.TemporaryDirectory() as tmp:
+            path = args.path if args.path is not None else _make_file(tmp, args.size)
+            print(f"Hashing {os.path.getsize(path) / (1024 ** 2):.0f} MiB with {args.algorithm}")
+            for name, rate in bench_hash(path, args.algorithm, repeat=args.repeat):
+                print(f"{name:>24}: {rate:6.2f} GB/s")
+    elif args.command == "exclusions":
+        rules = make_rules(args.rules)
+        names = make_names(args.names, rules)
+        print(f"Matching {len(names)} names against {len(rules)} rules")
+        for name, rate in bench_exclusions(rules, names, args.repeat):
+            unit = "compiles/s" if name == "compile" else "names/s"
+            print(f"{name:>24}: {rate:12,.0f} {unit}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import errno
+import os
+import shutil
+import sys
+from threading import Lock
+from typing import Tuple, Dict, Set, Optional
+
+from backup_util.utils.datautils import hash_file, copy_and_hash, default_hash_algorithm, default_block_size
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+copy_reflink = "reflink"
+copy_range = "copy_file_range"
+copy_sendfile = "sendfile"
+copy_userspace = "userspace"
+copy_methods = (copy_reflink, copy_range, copy_sendfile, copy_userspace)
+
+default_small_file_size = 256 * 1024  # Files below this are latency bound and copied on a pool
+default_copy_workers = 8
+
+_FICLONE = 0x40049409  # From linux/fs.h
+_max_chunk = 1024 ** 3
+# Errors meaning a method does not work for these files, so the next one is tried
+_unsupported_errors = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF, errno.ENOTTY, errno.ETXTBSY,
+                       errno.EOPNOTSUPP, getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+                       getattr(errno, "ENOTSOCK", errno.EOPNOTSUPP)}
+
+# Methods that failed between a pair of devices are not tried again for the rest of the process
+_unsupported: Dict[Tuple[int, int], Set[str]] = {}
+_unsupported_lock = Lock()
+
+
+def _available(method: str) -> bool:
+    if method == copy_reflink:
+        return fcntl is not None and sys.platform.startswith("linux")
+    if method == copy_range:
+        return hasattr(os, "copy_file_range")
+    if method == copy_sendfile:
+        return hasattr(os, "sendfile") and sys.platform.startswith("linux")
+    return True
+
+
+def _disable(devices: Tuple[int, int], method: str) -> None:
+    with _unsupported_lock:
+        _unsupported.setdefault(devices, set()).add(method)
+
+
+def _devices(fsrc: int, fdest: int) -> Tuple[int, int]:
+    return os.fstat(fsrc).st_dev, os.fstat(fdest).st_dev
+
+
+def _reflink(fsrc: int, fdest: int, devices: Tuple[int, int]) -> bool:
+    """
+    Make an empty file share the data of another one
+
+    :return: True if the data is shared, False if the filesystem does not support it
+    """
+    if copy_reflink in _unsupported.get(devices, ()) or not _available(copy_reflink):
+        return False
+    try:
+        fcntl.ioctl(fdest, _FICLONE, fsrc)
+        return True
+    except OSError as e:
+        if e.errno not in _unsupported_errors:
+            raise
+        _disable(devices, copy_reflink)
+        return False
+
+
+def _copy_contents(fsrc: int, fdest: int, devices: Tuple[int, int]) -> str:
+    """
+    Copy the contents of an open file to an empty one with the first method that works
+
+    :param fsrc: the file descriptor of the source
+    :param fdest: the file descriptor of the destination
+    :param devices: the devices of the source and destination, used to remember which methods failed between them
+    :return: the method the contents were copied with
+    """
+    if _reflink(fsrc, fdest, devices):
+        return copy_reflink
+    disabled = _unsupported.get(devices, ())
+    offset = 0
+    for method in (copy_range, copy_sendfile):
+        if method in disabled or not _available(method):
+            continue
+        try:
+            while True:  # Until the end of the file, which may have grown since it was listed
+                if method == copy_range:
+                    copied = os.copy_file_range(fsrc, fdest, _max_chunk, offset)
+                else:
+                    copied = os.sendfile(fdest, fsrc, offset, _max_chunk)
+                if copied > 0:
+                    offset += copied
+                elif offset < os.fstat(fsrc).st_size:  # Some filesystems report no data, e.g. procfs and some FUSE
+                    break
+                else:
+                    return method
+        except OSError as e:
+            if e.errno not in _unsupported_errors:
+                raise
+            _disable(devices, method)  # The next method continues from the same offset
+    os.lseek(fsrc, offset, os.SEEK_SET)
+    while True:
+        block = os.read(fsrc, default_block_size)
+        if len(block) == 0:
+            return copy_userspace
+        view = memoryview(block)
+        while len(view) > 0:
+            view = view[os.write(fdest, view):]
+
+
+def copy_file(src: str, dest: str) -> str:
+    """
+    Copy a file and its metadata like `shutil.copy2`, letting the kernel move the data where possible. A reflink is
+    tried first, which shares the data of the source on filesystems supporting it. Otherwise the data is copied with
+    `copy_file_range`, then `sendfile` and finally through a buffer. A method failing because the filesystems do not
+    support it falls back to the next one and is skipped for later files between the same devices.
+
+    :param src: the file to copy
+    :param dest: the path to copy the file to
+    :return: the method the contents were copied with
+    """
+    with open(src, "rb", buffering=0) as fsrc, open(dest, "wb", buffering=0) as fdest:
+        method = _copy_contents(fsrc.fileno(), fdest.fileno(), _devices(fsrc.fileno(), fdest.fileno()))
+    shutil.copystat(src, dest)
+    return method
+
+
+def copy_file_and_hash(src: str, dest: str, algorithm: str = default_hash_algorithm) -> Tuple[str, str]:
+    """
+    Copy a file and its metadata like `shutil.copy2` and hash its contents. As the contents have to be read for the
+    hash anyway, they are only moved by the kernel when the copy is a reflink, which leaves a single read of the
+    source. Otherwise the file is hashed while it is copied through a buffer.
+
+    :param src: the file to copy
+    :param dest: the path to copy the file to
+    :param algorithm: the hash algorithm to use
+    :return: the hash of the contents and the method they were copied with
+    """
+    if _available(copy_reflink):
+        with open(src, "rb", buffering=0) as fsrc, open(dest, "wb", buffering=0) as fdest:
+            cloned = _reflink(fsrc.fileno(), fdest.fileno(), _devices(fsrc.fileno(), fdest.fileno()))
+        if cloned:
+            shutil.copystat(src, dest)
+            return hash_file(src, algorithm), copy_reflink
+    return copy_and_hash(src, dest, algorithm), copy_userspace
+
+
+class CopyStats:
+    """
+    Counts the files and bytes copied with each method. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.files: Dict[str, int] = {}
+        self.bytes: Dict[str, int] = {}
+        self._lock = Lock()
+
+    def add(self, method: str, size: int) -> None:
+        with self._lock:
+            self.files[method] = self.files.get(method, 0) + 1
+            self.bytes[method] = self.bytes.get(method, 0) + size
+
+    def summary(self) -> Optional[str]:
+        """
+        :return: e.g. "12 reflink (3.0 MiB) / 4 userspace (0.1 MiB)", or None if nothing was copied. Methods other
+        than `copy_methods`, like the codecs of compressed files, follow in alphabetical order
+        """
+        methods = [m for m in copy_methods if m in self.files] + sorted(m for m in self.files if m not in copy_methods)
+        parts = [f"{self.files[m]} {m} ({self.bytes[m] / 1024 ** 2:.1f} MiB)" for m in methods]
+        return " / ".join(parts) if len(parts) > 0 else None
@@ -1,9 +1,14 @@
 import datetime
 import hashlib
+import heapq
 import json
+import mmap
 import os
+import shutil
 import sys
-from typing import Any, Tuple, Optional
+from typing import Any, Tuple, Optional, BinaryIO, Iterable, Callable, List
+
+from backup_util.utils.scanner import scan_tree
 
 
 class CustomJSONEncoder(json.JSONEncoder):
@@ -22,12 +27,87 @@ class CustomJSONEncoder(json.JSONEncoder):
         return hasattr(obj, "__jsonify__") and callable(getattr(obj, "__jsonify__"))
 
 
-def hash_file(path: str):
-    sha256_hash = hashlib.sha256()
-    with open(path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+hash_algorithms = ("blake2b", "blake2s", "sha256", "sha512")
+default_hash_algorithm = "blake2b"
+legacy_hash_algorithm = "sha256"  # Used by records created before the algorithm was stored
+
+
+def new_hasher(algorithm: str = default_hash_algorithm):
+    """
+    Create a hash object for one of the supported algorithms
+
+    :param algorithm: the name of the algorithm, one of `hash_algorithms`
+    :return: a new hashlib hash object
+    """
+    if algorithm not in hash_algorithms:
+        raise ValueError(f"Unsupported hash algorithm {algorithm}. Expected one of {hash_algorithms}")
+    return hashlib.new(algorithm)
+
+
+default_block_size = 1024 * 1024
+
+
+def _read_blocks(file: BinaryIO, block_size: int):
+    """
+    Read a file in blocks without allocating a new buffer per block. Each yielded view is only valid until the next
+    block is read.
+
+    :param file: a file opened in binary mode
+    :param block_size: the size of the reusable buffer
+    :return: an iterator of memoryviews of the data read
+    """
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    while True:
+        count = file.readinto(buffer)
+        if not count:
+            break
+        yield view[:count]
+
+
+def hash_file(path: str, algorithm: str = default_hash_algorithm, block_size: int = default_block_size,
+              mmap_threshold: Optional[int] = None):
+    """
+    Hash the contents of a file
+
+    :param path: the file to hash
+    :param algorithm: the hash algorithm to use
+    :param block_size: the size of the buffer the file is read into
+    :param mmap_threshold: files of at least this size are memory mapped instead of read. None disables mapping,
+    which is the default as it is rarely faster than `readinto` with a large buffer
+    :return: the hex digest of the file contents
+    """
+    hasher = new_hasher(algorithm)
+    with open(path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if mmap_threshold is not None and 0 < size and mmap_threshold <= size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hasher.update(mapped)
+        else:
+            for block in _read_blocks(f, block_size):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+
+def copy_and_hash(src: str, dest: str, algorithm: str = default_hash_algorithm,
+                  block_size: int = default_block_size) -> str:
+    """
+    Copy a file and its metadata like `shutil.copy2`, hashing the contents as they are copied so the source is only
+    read once
+
+    :param src: the file to copy
+    :param dest: the path to copy the file to
+    :param algorithm: the hash algorithm to use
+    :param block_size: the size of the buffer the file is read into
+    :return: the hash of the file contents
+    """
+    hasher = new_hasher(algorithm)
+    with open(src, "rb", buffering=0) as fsrc, open(dest, "wb") as fdest:
+        for block in _read_blocks(fsrc, block_size):
+            hasher.update(block)
+            fdest.write(block)
+    shutil.copystat(src, dest)
+    return hasher.hexdigest()
 
 
 def find_match(lst: list, predicate) -> Tuple[Optional[int], Optional[Any]]:
@@ -51,6 +131,91 @@ def path_common_suffix(p1: str, p2: str) -> str:
     return res
 
 
+def tree_size(path: str, ignore: Optional[Callable[[str, List[str]], Iterable[str]]] = None) -> Tuple[int, int]:
+    """
+    Count the files and bytes under a directory without reading any file
+
+    :param path: the root of the tree
+    :param ignore: a function like the ones made by `shutil.ignore_patterns`, taking a directory and the names in it
+    and returning the names to skip
+    :return: the number of files and their total size in bytes
+    """
+    files = 0
+    size = 0
+    for entry in scan_tree(path, ignore):
+        if not entry.is_dir:
+            size += entry.stat.st_size
+            files += 1
+    return files, size
+
+
+def remove_empty_dirs(path: str) -> None:
+    """
+    Remove every empty directory under `path`, including `path` itself if it ends up empty
+
+    :param path: the root of the tree to prune
+    """
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        if len(os.listdir(dirpath)) == 0:
+            os.rmdir(dirpath)
+
+
+def prune_empty_parents(dirs: Iterable[str], root: str) -> int:
+    """
+    Remove directories that are empty, walking up from each of `dirs` until a non-empty directory or `root` is reached.
+    Only the given directories and their parents are looked at, so this is cheap after deleting a few files in a large
+    tree.
+
+    :param dirs: the directories files were removed from
+    :param root: the directory to stop at. It is never removed
+    :return: the number of directories removed
+    """
+    root = os.path.abspath(root)
+    queued = {os.path.abspath(d) for d in dirs}
+    heap = [(-d.count(os.sep), d) for d in queued]
+    heapq.heapify(heap)  # Deepest first, so a parent is only tried once all of its emptied children are gone
+    removed = 0
+    while len(heap) > 0:
+        depth, dirpath = heapq.heappop(heap)
+        if not dirpath.startswith(root + os.sep):
+            continue
+        try:
+            os.rmdir(dirpath)
+        except OSError:  # Not empty or already gone
+            continue
+        removed += 1
+        parent = os.path.dirname(dirpath)
+        if parent not in queued:
+            queued.add(parent)
+            heapq.heappush(heap, (-parent.count(os.sep), parent))
+    return removed
+
+
+def sync_paths(paths: Iterable[str]) -> None:
+    """
+    Flush files and the directories listing them to disk, so files that were written or linked survive a crash.
+    Directories cannot be opened on Windows, so only the files are flushed there.
+
+    :param paths: the files to flush
+    """
+    flags = os.O_RDWR if os.name == "nt" else os.O_RDONLY  # Windows refuses to flush read only handles
+    dirs = set()
+    for path in paths:
+        fd = os.open(path, flags)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        dirs.add(os.path.dirname(path))
+    if os.name != "nt":
+        for dirpath in dirs:
+            fd = os.open(dirpath, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
 def get_data_path(file: str) -> str:
     if hasattr(sys, 'frozen') and hasattr(sys, '_MEIPASS'):
         bundle_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
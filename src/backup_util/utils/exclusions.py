@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import logging
+import os
+import re
+from typing import List, Optional, Iterable, Callable, Dict, Set, Tuple
+
+log = logging.getLogger(__name__)
+
+ignore_file_name = ".backupignore"
+
+_glob_chars = re.compile(r"[*?\[\\]")
+_case_insensitive = os.path.normcase("A") == "a"
+_fold: Callable[[str], str] = str.lower if _case_insensitive else str
+_regex_flags = re.IGNORECASE if _case_insensitive else 0
+
+
+def _translate(glob: str) -> str:
+    """
+    Translate a gitignore glob to a regular expression. `*` and `?` do not match `/`, while `**` matches any number
+    of directories.
+
+    :param glob: the glob to translate
+    :return: the regular expression, without anchors
+    """
+    res = []
+    i = 0
+    n = len(glob)
+    while i < n:
+        c = glob[i]
+        if c == "*":
+            if glob.startswith("**/", i):
+                res.append("(?:.*/)?")
+                i += 3
+                continue
+            if glob.startswith("**", i):
+                res.append(".*")
+                i += 2
+                continue
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            res.append(re.escape(glob[i]))
+        elif c == "[":
+            end = glob.find("]", i + 2 if glob.startswith("[!", i) or glob.startswith("[]", i) else i + 1)
+            if end < 0:
+                res.append("\\[")
+            else:
+                body = glob[i + 1:end].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                elif body.startswith("^"):
+                    body = "\\" + body
+                res.append("[" + body + "]")
+                i = end
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return "".join(res)
+
+
+class _Rule:
+    """
+    One line of an ignore list
+    """
+
+    def __init__(self, line: str):
+        pattern = line
+        self.negated = pattern.startswith("!")
+        if self.negated:
+            pattern = pattern[1:]
+        elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        self.anchored = "/" in pattern
+        self.pattern = pattern.lstrip("/")
+
+
+class _Run:
+    """
+    Consecutive rules with the same effect, merged so a name is tested against all of them at once. Names are looked
+    up in a set for literal rules and with one `str.endswith` call for `*suffix` rules. Other rules are joined into
+    one regular expression for names and one for paths.
+    """
+
+    def __init__(self, negated: bool, dir_only: bool, rules: List[_Rule]):
+        self.negated = negated
+        self.dir_only = dir_only
+        self.literals: Set[str] = set()
+        suffixes = []
+        name_globs = []
+        path_globs = []
+        for rule in rules:
+            if rule.anchored:
+                path_globs.append(_translate(rule.pattern))
+            elif _glob_chars.search(rule.pattern) is None:
+                self.literals.add(_fold(rule.pattern))
+            elif rule.pattern.startswith("*") and _glob_chars.search(rule.pattern, 1) is None:
+                suffixes.append(_fold(rule.pattern[1:]))
+            else:
+                name_globs.append(_translate(rule.pattern))
+        self.suffixes: Optional[Tuple[str, ...]] = tuple(suffixes) if len(suffixes) > 0 else None
+        self.name_regex = re.compile(f"(?:{'|'.join(name_globs)})\\Z", _regex_flags) if len(name_globs) > 0 else None
+        # Anchored rules also match everything under a matched directory
+        self.path_regex = re.compile(f"(?:{'|'.join(path_globs)})(?:/|\\Z)", _regex_flags) \
+            if len(path_globs) > 0 else None
+
+    def matches(self, relpath: str, name: str) -> bool:
+        folded = _fold(name)
+        return folded in self.literals \
+            or (self.suffixes is not None and folded.endswith(self.suffixes)) \
+            or (self.name_regex is not None and self.name_regex.match(name) is not None) \
+            or (self.path_regex is not None and self.path_regex.match(relpath) is not None)
+
+
+class RuleSet:
+    """
+    A compiled list of gitignore-style rules. A rule without a `/` matches names at any depth, a rule with a `/` is
+    anchored to the folder the rules apply to, a trailing `/` limits a rule to directories and a leading `!`
+    re-includes what an earlier rule excluded. Blank lines and lines starting with `#` are skipped.
+
+    The last matching rule wins. Consecutive rules with the same effect are merged, so the cost of a lookup grows with
+    the number of `!` and `dir/` changes in the list rather than with the number of rules.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        """
+        :param patterns: the rules, one per item
+        """
+        rules = []
+        for line in patterns:
+            line = line.rstrip("\r\n")
+            if not line.endswith("\\ "):
+                line = line.rstrip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            rule = _Rule(line)
+            if len(rule.pattern) > 0:
+                rules.append(rule)
+        self.runs: List[_Run] = []
+        start = 0
+        for i in range(1, len(rules) + 1):
+            first = rules[start]
+            if i == len(rules) or (rules[i].negated, rules[i].dir_only) != (first.negated, first.dir_only):
+                self.runs.append(_Run(first.negated, first.dir_only, rules[start:i]))
+                start = i
+        self.runs.reverse()  # Later rules take precedence
+
+    @classmethod
+    def load_from(cls, path: str) -> RuleSet:
+        with open(path, "r", encoding="utf-8") as file:
+            return cls(file.readlines())
+
+    def __len__(self):
+        return len(self.runs)
+
+    def match(self, relpath: str, name: str, is_dir: Callable[[str], bool]) -> Optional[bool]:
+        """
+        Match an entry against the rules
+
+        :param relpath: the path of the entry relative to the folder the rules apply to, separated by `/`
+        :param name: the name of the entry
+        :param is_dir: a function telling if the entry with the given name is a directory. It is only called when a
+        rule limited to directories matches.
+        :return: True if the entry is excluded, False if it is re-included and None if no rule matches
+        """
+        for run in self.runs:
+            if run.matches(relpath, name) and (not run.dir_only or is_dir(name)):
+                return not run.negated
+        return None
+
+
+class Exclusions:
+    """
+    The exclusion rules of a backup. Rules are compiled once; `for_tree` makes the function excluding names while a
+    source is scanned, which also applies the rules of every ignore file found in the scanned folders.
+    """
+
+    def __init__(self, patterns: Iterable[str], ignore_file: Optional[str] = ignore_file_name):
+        """
+        :param patterns: the rules applying to every source
+        :param ignore_file: the name of the files holding more rules for the folder they are in and its subfolders,
+        or None to not look for them
+        """
+        self.rules = RuleSet(patterns)
+        self.ignore_file = ignore_file
+
+    def for_tree(self, root: str) -> TreeMatcher:
+        """
+        :param root: the source about to be scanned
+        :return: a function like the ones made by `shutil.ignore_patterns`
+        """
+        return TreeMatcher(self, root)
+
+    def matches(self, relpath: str, is_dir: bool = False) -> bool:
+        """
+        Match a path against the rules applying to every source, without reading ignore files
+
+        :param relpath: the path relative to the source
+        :param is_dir: True if the path is a directory
+        :return: True if the path is excluded
+        """
+        relpath = relpath.replace(os.sep, "/")
+        return self.rules.match(relpath, relpath.rsplit("/", 1)[-1], lambda name: is_dir) is True
+
+
+class TreeMatcher:
+    """
+    Excludes the names of a folder given the rules of a backup and the ignore files found in the folder and its
+    parents. Ignore files closer to a name take precedence over the ones above them and over the backup rules.
+    """
+
+    def __init__(self, exclusions: Exclusions, root: str):
+        self.exclusions = exclusions
+        self.root = os.path.normpath(root)
+        self.rule_sets: Dict[str, RuleSet] = {self.root: exclusions.rules}
+
+    def _rule_sets(self, path: str) -> List[Tuple[str, RuleSet]]:
+        """
+        :return: the folders with rules applying to `path` and their rules, closest first
+        """
+        found = []
+        current = path
+        while True:
+            if current in self.rule_sets:
+                found.append((current, self.rule_sets[current]))
+            if current == self.root:
+                return found
+            parent = os.path.dirname(current)
+            if parent == current:  # Not under the root
+                return found
+            current = parent
+
+    def __call__(self, path: str, names: List[str]) -> Set[str]:
+        path = os.path.normpath(path)
+        ignore_file = self.exclusions.ignore_file
+        if ignore_file is not None and ignore_file in names:
+            try:
+                self.rule_sets[path] = RuleSet.load_from(os.path.join(path, ignore_file))
+            except (OSError, UnicodeDecodeError) as e:
+                log.error(f"Could not read {os.path.join(path, ignore_file)}: {str(e)}")
+        rule_sets = [(os.path.relpath(path, base).replace(os.sep, "/"), rules)
+                     for base, rules in self._rule_sets(path) if len(rules) > 0]
+        if len(rule_sets) == 0:
+            return set()
+
+        def is_dir(name: str) -> bool:
+            return os.path.isdir(os.path.join(path, name))
+
+        ignored = set()
+        for name in names:
+            for folder, rules in rule_sets:
+                excluded = rules.match(name if folder == "." else f"{folder}/{name}", name, is_dir)
+                if excluded is not None:
+                    if excluded:
+                        ignored.add(name)
+                    break
+        return ignored
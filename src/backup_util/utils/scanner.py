@@ -0,0 +1,83 @@
+import logging
+import os
+import stat as stat_module
+from typing import Iterator, Optional, Callable, List, Iterable
+
+log = logging.getLogger(__name__)
+
+
+class ScanEntry:
+    """
+    A file or directory found by `scan_tree`
+    """
+    __slots__ = ("path", "relpath", "stat", "is_dir")
+
+    def __init__(self, path: str, relpath: str, stat: os.stat_result, is_dir: bool):
+        """
+        :param path: the path of the entry, starting with the scanned root
+        :param relpath: the path of the entry relative to the scanned root
+        :param stat: the stat result of the entry, following symbolic links
+        :param is_dir: True if the entry is a directory
+        """
+        self.path = path
+        self.relpath = relpath
+        self.stat = stat
+        self.is_dir = is_dir
+
+    def __repr__(self):
+        return f"ScanEntry({self.relpath!r}, is_dir={self.is_dir})"
+
+
+def _list_dir(path: str) -> List[os.DirEntry]:
+    with os.scandir(path) as it:
+        return sorted(it, key=lambda e: e.name)
+
+
+def scan_tree(root: str, ignore: Optional[Callable[[str, List[str]], Iterable[str]]] = None) -> Iterator[ScanEntry]:
+    """
+    Walk a tree with `os.scandir`. Every directory is yielded before its contents and the entries of a directory are
+    sorted by name. Excluded directories are never opened and the stat result of each entry is taken once, so
+    consumers should use `ScanEntry.stat` instead of calling `os.stat` again.
+
+    Symbolic links are followed like `shutil.copytree` does without `symlinks`: links to files are yielded as files,
+    links to directories are descended into unless they point at one of their own parents, and dangling links are
+    skipped. Entries that are neither files nor directories are skipped, as are directories that cannot be listed.
+
+    :param root: the directory to walk. It is not yielded itself.
+    :param ignore: a function like the ones made by `shutil.ignore_patterns`, taking a directory and the names in it
+    and returning the names to skip
+    :return: an iterator of the entries under `root`
+    """
+    stack = [(root, "", os.path.realpath(root))]
+    while len(stack) > 0:
+        path, relpath, realpath = stack.pop()
+        try:
+            entries = _list_dir(path)
+        except OSError as e:
+            log.error(f"Could not list {path}: {str(e)}")
+            continue
+        if ignore is not None:
+            ignored = set(ignore(path, [e.name for e in entries]))
+            if len(ignored) > 0:
+                entries = [e for e in entries if e.name not in ignored]
+        subdirs = []
+        for entry in entries:
+            entry_relpath = os.path.join(relpath, entry.name) if len(relpath) > 0 else entry.name
+            try:
+                stat = entry.stat()
+            except OSError:  # Dangling link or removed since listing
+                continue
+            if stat_module.S_ISDIR(stat.st_mode):
+                entry_realpath = os.path.join(realpath, entry.name)
+                if entry.is_symlink():
+                    entry_realpath = os.path.realpath(entry.path)
+                    if realpath == entry_realpath or realpath.startswith(entry_realpath + os.sep):
+                        log.warning(f"Not following {entry.path}, it links to one of its parents")
+                        continue
+                yield ScanEntry(entry.path, entry_relpath, stat, True)
+                subdirs.append((entry.path, entry_relpath, entry_realpath))
+            elif stat_module.S_ISREG(stat.st_mode):
+                yield ScanEntry(entry.path, entry_relpath, stat, False)
+            else:
+                log.debug(f"Skipping {entry.path}, it is not a regular file")
+        stack.extend(reversed(subdirs))
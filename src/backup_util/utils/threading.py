@@ -1,15 +1,41 @@
+from __future__ import annotations
+
 import functools
+import logging
+import os
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
 from queue import Queue
-from typing import Union, Callable
-from threading import Thread
+from datetime import timedelta
+from time import monotonic
+from typing import Union, Callable, Any, Deque, Iterator, Tuple, Optional, Dict
+from threading import Thread, Lock, Event
+
+log = logging.getLogger(__name__)
+
+counter_scanned = "scanned"
+counter_copied = "copied"
+counter_skipped = "skipped"
+counter_bytes = "bytes"
+counter_done_files = "done_files"  # Files finished, whether copied or not
+counter_done_bytes = "done_bytes"
+default_progress_interval = 0.1  # Matches how often the UI polls for updates
+_rate_smoothing = 0.3  # Weight of the latest measurement in the throughput average
 
 
 class AsyncUpdate:
-    def __init__(self, message: str, progress: int = 1, progress_max: int = 1, minor: bool = False):
+    def __init__(self, message: str, progress: int = 1, progress_max: int = 1, minor: bool = False,
+                 counters: Optional[Dict[str, int]] = None, bytes_done: Optional[int] = None,
+                 bytes_total: Optional[int] = None, rate: Optional[float] = None, eta: Optional[float] = None):
         self.progress = progress
         self.progress_max = progress_max
         self.message = message
         self.minor = minor
+        self.counters = counters
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+        self.rate = rate  # Bytes per second
+        self.eta = eta  # Seconds
 
     def get_completion(self) -> float:
         return round(float(self.progress / self.progress_max) * 100, 2)
@@ -17,6 +43,28 @@ class AsyncUpdate:
     def is_minor(self):
         return self.minor
 
+    def has_bytes(self) -> bool:
+        return self.bytes_done is not None and self.bytes_total is not None and self.bytes_total > 0
+
+    def get_byte_completion(self) -> float:
+        return round(min(1.0, self.bytes_done / self.bytes_total) * 100, 2) if self.has_bytes() else 0.0
+
+    def describe_throughput(self) -> str:
+        """
+        Describe the bytes done, throughput and time left of this update
+
+        :return: e.g. "1.2 / 4.0 GiB, 85.3 MB/s, 0:00:34 left", or an empty string if this update has no byte counts
+        """
+        if self.bytes_done is None:
+            return ""
+        parts = [f"{self.bytes_done / 1024 ** 3:.1f} / {self.bytes_total / 1024 ** 3:.1f} GiB"
+                 if self.bytes_total is not None else f"{self.bytes_done / 1024 ** 3:.1f} GiB"]
+        if self.rate is not None:
+            parts.append(f"{self.rate / 1000 ** 2:.1f} MB/s")
+        if self.eta is not None:
+            parts.append(f"{timedelta(seconds=round(self.eta))} left")
+        return ", ".join(parts)
+
 
 class ThrowingThread(Thread):
     def __init__(self, group=None, target=None, name=None,
@@ -37,15 +85,62 @@ class ThrowingThread(Thread):
         return self.exception
 
 
+class JobCancelled(Exception):
+    def __init__(self, *args):
+        super().__init__(*args)
+
+
+class CancelToken:
+    """
+    Lets a threaded job be cancelled, paused and resumed from another thread. The job calls `check` at points where it
+    can safely stop; `check` blocks while paused and raises `JobCancelled` once cancelled.
+    """
+
+    def __init__(self):
+        self._cancelled = Event()
+        self._running = Event()
+        self._running.set()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        self._running.set()  # Wake a paused job so it can stop
+
+    def pause(self) -> None:
+        if not self._cancelled.is_set():
+            self._running.clear()
+
+    def resume(self) -> None:
+        self._running.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def is_paused(self) -> bool:
+        return not self._running.is_set()
+
+    def check(self) -> None:
+        """
+        Wait while paused, then raise `JobCancelled` if the job was cancelled
+        """
+        self._running.wait()
+        if self._cancelled.is_set():
+            raise JobCancelled("The job was cancelled")
+
+
 def threaded_func():
     def outer_wrapper(f):
         @functools.wraps(f)
         def wrapper(self: Threadable, *args, **kwargs):
             data_queue = Queue()
+            self.token = CancelToken()
 
             def _thread_exec():
+                res = None
                 try:
                     res = f(self, data_queue, *args, *kwargs)
+                except JobCancelled:
+                    log.info(f"{f.__name__} was cancelled")
+                    data_queue.put(AsyncUpdate("Cancelled", minor=True))  # Keeps the progress reached so far
                 finally:
                     self.thread = None
                 return res
@@ -60,14 +155,249 @@ class Threadable:
 
     def __init__(self):
         self.thread: Union[Thread, None] = None
+        self.token: CancelToken = CancelToken()
         super().__init__()
 
     def is_running(self):
         return self.thread is not None and self.thread.is_alive()
 
+    def cancel(self) -> None:
+        """
+        Ask the running job to stop at its next safe point
+        """
+        self.token.cancel()
+
+    def pause(self) -> None:
+        self.token.pause()
+
+    def resume(self) -> None:
+        self.token.resume()
+
+    def is_paused(self) -> bool:
+        return self.token.is_paused()
+
     def wait_for_completion(self):
         if self.thread is not None and self.thread.is_alive():
             e = self.thread.join()
             if e is not None:
                 raise e
 
+
+def default_workers() -> int:
+    """
+    Get the default number of workers for a pool on this machine
+
+    :return: the number of workers
+    """
+    return min(8, os.cpu_count() or 1)
+
+
+class OrderedPool:
+    """
+    Runs work on a thread or process pool and hands back results in the order the work was submitted, regardless of
+    the order it completes in. At most `max_pending` items are kept in flight; `collect` blocks on the oldest item once
+    that limit is exceeded.
+    """
+
+    def __init__(self, workers: int = 1, processes: bool = False, max_pending: Optional[int] = None,
+                 executor: Optional[Executor] = None):
+        """
+        :param workers: the number of workers
+        :param processes: run work in processes instead of threads
+        :param max_pending: the number of items kept in flight. Defaults to 8 per worker
+        :param executor: an executor to share with other pools instead of creating one. It is not shut down with
+        this pool
+        """
+        self.workers = max(1, workers)
+        self.max_pending = max_pending if max_pending is not None else self.workers * 8
+        self._owns_executor = executor is None
+        self.executor: Executor = executor if executor is not None else \
+            ProcessPoolExecutor(self.workers) if processes else ThreadPoolExecutor(self.workers)
+        self._pending: Deque[Tuple[Any, Future]] = deque()
+
+    def submit(self, context: Any, fn: Callable, *args, **kwargs) -> None:
+        """
+        Queue `fn` to run on the pool
+
+        :param context: a value handed back with the result to identify the work
+        :param fn: the function to run. Must be picklable when using processes
+        """
+        self._pending.append((context, self.executor.submit(fn, *args, **kwargs)))
+
+    def skip(self, context: Any, result: Any = None) -> None:
+        """
+        Queue an already known result so it is collected in order with the submitted work
+
+        :param context: a value handed back with the result to identify the work
+        :param result: the result of the work
+        """
+        future = Future()
+        future.set_result(result)
+        self._pending.append((context, future))
+
+    def collect(self, wait: bool = False) -> Iterator[Tuple[Any, Future]]:
+        """
+        Yield finished work in submission order. Stops at the first unfinished item unless `wait` is set or too many
+        items are pending.
+
+        :param wait: if True, wait for and yield all pending work
+        :return: an iterator of (context, future) for the finished work
+        """
+        while len(self._pending) > 0 and \
+                (wait or self._pending[0][1].done() or len(self._pending) > self.max_pending):
+            yield self._pending.popleft()
+
+    def shutdown(self) -> None:
+        for context, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._owns_executor:
+            self.executor.shutdown()
+
+    def __enter__(self) -> OrderedPool:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.shutdown()
+
+
+class ProgressReporter:
+    """
+    Aggregates per-file progress into counters and posts at most one minor `AsyncUpdate` per `interval` seconds. Only
+    the latest message is kept between posts, so the queue grows with the run time rather than the number of files.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, data_queue: Queue, interval: float = default_progress_interval):
+        """
+        :param data_queue: the queue to post updates to
+        :param interval: the minimum number of seconds between posts
+        """
+        self.data_queue = data_queue
+        self.interval = interval
+        self.counters: Dict[str, int] = {counter_scanned: 0, counter_copied: 0, counter_skipped: 0, counter_bytes: 0,
+                                         counter_done_files: 0, counter_done_bytes: 0}
+        self.total_files: Optional[int] = None
+        self.total_bytes: Optional[int] = None
+        self.message = ""
+        self._lock = Lock()
+        self._next_post = 0.0
+        self._dirty = False
+        self._rate_time = monotonic()
+        self._rate_done = (0, 0)
+        self._rates: Tuple[Optional[float], Optional[float]] = (None, None)  # Smoothed files and bytes per second
+
+    def update(self, message: str) -> None:
+        """
+        Set the latest message and post it if enough time has passed
+
+        :param message: the message, usually the file being worked on
+        """
+        with self._lock:
+            self.message = message
+            self._dirty = True
+        self.publish()
+
+    def count(self, counter: str, amount: int = 1, message: Optional[str] = None) -> None:
+        """
+        Add to a counter and post if enough time has passed
+
+        :param counter: the name of the counter
+        :param amount: the amount to add
+        :param message: replaces the latest message if set
+        """
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+            if message is not None:
+                self.message = message
+            self._dirty = True
+        self.publish()
+
+    def set_totals(self, files: Optional[int] = None, size: Optional[int] = None) -> None:
+        """
+        Set the amount of work expected, usually from a pre-scan, so updates carry a completion and time left
+
+        :param files: the number of files
+        :param size: the number of bytes
+        """
+        with self._lock:
+            self.total_files = files
+            self.total_bytes = size
+            self._dirty = True
+
+    def advance(self, files: int = 1, size: int = 0, message: Optional[str] = None) -> None:
+        """
+        Mark work as done, whether it was copied, skipped or removed
+
+        :param files: the number of files finished
+        :param size: the number of bytes finished
+        :param message: replaces the latest message if set
+        """
+        with self._lock:
+            self.counters[counter_done_files] += files
+            self.counters[counter_done_bytes] += size
+            if message is not None:
+                self.message = message
+            self._dirty = True
+        self.publish()
+
+    def _update_rates(self, now: float) -> None:
+        elapsed = now - self._rate_time
+        if elapsed <= 0:
+            return
+        done = (self.counters[counter_done_files], self.counters[counter_done_bytes])
+        rates = []
+        for current, previous, rate in zip(done, self._rate_done, self._rates):
+            measured = (current - previous) / elapsed
+            rates.append(measured if rate is None else rate * (1 - _rate_smoothing) + measured * _rate_smoothing)
+        self._rates = tuple(rates)
+        self._rate_time = now
+        self._rate_done = done
+
+    def _eta(self) -> Optional[float]:
+        file_rate, byte_rate = self._rates
+        if self.total_bytes is not None and byte_rate:
+            return max(0, self.total_bytes - self.counters[counter_done_bytes]) / byte_rate
+        if self.total_files is not None and file_rate:
+            return max(0, self.total_files - self.counters[counter_done_files]) / file_rate
+        return None
+
+    def summary(self) -> str:
+        """
+        Describe the counters that were used
+
+        :return: e.g. "120 scanned, 4 copied, 116 skipped, 12.5 MiB"
+        """
+        parts = [f"{self.counters[c]} {c}" for c in (counter_scanned, counter_copied, counter_skipped)
+                 if self.counters[c] > 0]
+        if self.counters[counter_bytes] > 0:
+            parts.append(f"{self.counters[counter_bytes] / 1024 ** 2:.1f} MiB")
+        if self.total_files is not None:
+            parts.append(f"{self.counters[counter_done_files]} of {self.total_files} files")
+        return ", ".join(parts)
+
+    def publish(self, force: bool = False) -> None:
+        """
+        Post the latest message and counters as a minor update
+
+        :param force: post even if the interval has not passed yet. Nothing is posted if nothing changed.
+        """
+        with self._lock:
+            now = monotonic()
+            if not self._dirty or (not force and now < self._next_post):
+                return
+            self._next_post = now + self.interval
+            self._dirty = False
+            self._update_rates(now)
+            summary = self.summary()
+            message = f"{self.message} [{summary}]" if summary else self.message
+            update = AsyncUpdate(message, minor=True, counters=dict(self.counters),
+                                 bytes_done=self.counters[counter_done_bytes], bytes_total=self.total_bytes,
+                                 rate=self._rates[1], eta=self._eta())
+        self.data_queue.put(update)
+
+    def flush(self) -> None:
+        """
+        Post any progress that was held back
+        """
+        self.publish(True)